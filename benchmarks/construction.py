@@ -0,0 +1,65 @@
+"""
+Benchmark the import of garminconnect and the construction of Garmin
+instances, the fixed cost every short-lived worker pays.
+
+Importing garminconnect is dominated by garth and pydantic, so the import
+figure mostly tracks those; the check below only makes sure the optional
+modules garminconnect imports on first use stay out of it.
+
+    python benchmarks/construction.py [--repeat 20] [--number 2000]
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+from pathlib import Path
+
+# Benchmark the working tree, not an installed release.
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def import_time(statement: str, repeat: int) -> float:
+    """Return the median seconds a fresh interpreter takes for 'statement'."""
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True, cwd=ROOT)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    baseline = import_time("pass", args.repeat)
+    package = import_time("import garminconnect", args.repeat)
+    print(f"import garminconnect   {(package - baseline) * 1e3:8.2f} ms")
+
+    import garminconnect
+
+    lazy = [
+        name
+        for name in ("withings_sync.fit", "sqlite3")
+        if name in sys.modules
+    ]
+    print(f"eagerly imported       {', '.join(lazy) or 'nothing optional'}")
+
+    session = garminconnect.Garmin.shared_session()
+    for label, construct in (
+        ("Garmin()", lambda: garminconnect.Garmin()),
+        ("Garmin(session=...)", lambda: garminconnect.Garmin(session=session)),
+    ):
+        seconds = min(timeit.repeat(construct, number=args.number, repeat=5))
+        print(f"{label:22} {seconds / args.number * 1e6:8.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""
+Benchmark typical workloads offline, replaying the recorded responses of
+tests/cassettes (plus synthetic activity data) through a local transport
+with simulated network latency. Results are written as JSON to compare
+releases.
+
+    python benchmarks/replay.py [--latency 0.02] [--jitter 0.01]
+        [--output results.json] [--compare previous.json] [workload ...]
+"""
+
+import argparse
+import io
+import json
+import math
+import platform
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from importlib import metadata
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+import yaml
+from requests.adapters import BaseAdapter
+
+# Benchmark the working tree, not an installed release.
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from garth.auth_tokens import OAuth1Token, OAuth2Token  # noqa: E402
+
+import garminconnect  # noqa: E402
+
+CASSETTES = ROOT / "tests" / "cassettes"
+RESULTS = Path(__file__).resolve().parent / "results"
+DISPLAY_NAME = "mtamizi"
+DATE = "2023-07-01"
+
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+ID_PATTERN = re.compile(r"/\d+(?=/|$)")
+
+
+def route_key(method: str, url: str) -> Tuple[str, str]:
+    """Return the method and path of 'url' with dates and ids generalized."""
+
+    path = urlsplit(url).path
+    path = ID_PATTERN.sub("/{id}", DATE_PATTERN.sub("{date}", path))
+    return method.upper(), path
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport answering requests from recorded or synthetic responses after
+    'latency' seconds, give or take up to 'jitter' seconds.
+    """
+
+    def __init__(self, latency: float, jitter: float, seed: int = 0):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self.routes: Dict[Tuple[str, str], Callable] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def record(self, path: Path):
+        """Serve the responses of the cassette at 'path'."""
+
+        for interaction in yaml.safe_load(path.read_text())["interactions"]:
+            request = interaction["request"]
+            response = interaction["response"]
+            body = response["body"]["string"]
+            if isinstance(body, str):
+                body = body.encode()
+            headers = {
+                name: values[0]
+                for name, values in response["headers"].items()
+                if name.lower() not in ("content-encoding", "content-length")
+            }
+            self.routes.setdefault(
+                route_key(request["method"], request["uri"]),
+                recorded(response["status"]["code"], headers, body),
+            )
+
+    def route(self, method: str, path: str, handler: Callable):
+        """Serve 'handler(request)' -> (status, headers, body) for 'path'."""
+
+        self.routes[route_key(method, path)] = handler
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.uniform(
+                -self.jitter, self.jitter
+            )
+        time.sleep(max(0.0, delay))
+
+        handler = self.routes.get(route_key(request.method, request.url))
+        if handler is None:
+            status, headers, body = 404, {}, b"{}"
+        else:
+            status, headers, body = handler(request)
+
+        response = requests.Response()
+        response.status_code = status
+        response.headers.update(headers)
+        response.raw = io.BytesIO(body)
+        response.url = request.url
+        response.request = request
+        response.reason = "OK" if status < 400 else "Error"
+        return response
+
+    def close(self):
+        pass
+
+
+def recorded(status: int, headers: Dict[str, str], body: bytes) -> Callable:
+    """Return a handler answering with a recorded response."""
+
+    return lambda request: (status, headers, body)
+
+
+def json_route(payload: Callable[[Dict[str, List[str]]], Any]) -> Callable:
+    """Return a handler answering with 'payload(query params)' as JSON."""
+
+    def handler(request):
+        params = parse_qs(urlsplit(request.url).query)
+        body = json.dumps(payload(params)).encode()
+        return 200, {"Content-Type": "application/json"}, body
+
+    return handler
+
+
+def synthetic_routes(adapter: ReplayAdapter, activities: int, samples: int):
+    """Serve a searchable activity list and large activity details."""
+
+    listing = [
+        {
+            "activityId": 10_000_000 + n,
+            "activityName": f"Run {n}",
+            "startTimeLocal": f"2023-{n % 12 + 1:02}-01 07:00:00",
+            "distance": 10_000.0,
+        }
+        for n in range(activities)
+    ]
+
+    def search(params):
+        start = int(params.get("start", ["0"])[0])
+        limit = int(params.get("limit", ["20"])[0])
+        return listing[start : start + limit]
+
+    keys = ["directTimestamp", "directHeartRate", "directSpeed"] + [
+        f"directMetric{n}" for n in range(12)
+    ]
+    details = {
+        "activityId": 10_000_000,
+        "metricDescriptors": [
+            {"metricsIndex": i, "key": key, "unit": {"key": "unit"}}
+            for i, key in enumerate(keys)
+        ],
+        "activityDetailMetrics": [
+            {
+                "metrics": [1688205600000.0 + s * 1000]
+                + [float(s % 200) if s % 97 else None for _ in keys[1:]]
+            }
+            for s in range(samples)
+        ],
+    }
+
+    adapter.route(
+        "GET",
+        "/activitylist-service/activities/search/activities",
+        json_route(search),
+    )
+    adapter.route(
+        "GET",
+        "/activity-service/activity/1/details",
+        json_route(lambda params: details),
+    )
+
+
+def client(adapter: ReplayAdapter) -> garminconnect.Garmin:
+    """Return a logged in Garmin instance talking to 'adapter'."""
+
+    api = garminconnect.Garmin()
+    api.garth.sess.mount("https://", adapter)
+    api.garth.oauth1_token = OAuth1Token("token", "secret")
+    far = int(time.time()) + 365 * 24 * 3600
+    api.garth.oauth2_token = OAuth2Token(
+        "scope", "jti", "Bearer", "access", "refresh", 3600, far, 3600, far
+    )
+    api.display_name = DISPLAY_NAME
+    return api
+
+
+def wellness_day(api):
+    for getter in (
+        api.get_user_summary,
+        api.get_heart_rates,
+        api.get_all_day_stress,
+        api.get_respiration_data,
+        api.get_spo2_data,
+        api.get_hrv_data,
+    ):
+        getter(DATE)
+
+
+def range_backfill(api):
+    end = (date.fromisoformat(DATE) + timedelta(days=364)).isoformat()
+    fetched = api.fetch_range("heart_rates", DATE, end, workers=16)
+    assert not fetched["errors"], fetched["errors"]
+
+
+def activity_pagination(api):
+    activities = api.get_activities_by_date("2023-01-01", "2023-12-31")
+    assert activities
+
+
+def details_decoding(api):
+    api.get_activity_details_arrays(1)
+
+
+def bulk_downloads(api):
+    with tempfile.TemporaryDirectory() as directory:
+        result = api.archive_activities(
+            directory,
+            activity_ids=range(10_000_000, 10_000_050),
+            formats=(api.ActivityDownloadFormat.TCX,),
+            workers=8,
+        )
+    assert not result["failed"], result["failed"]
+
+
+# name -> (workload, iterations)
+WORKLOADS: Dict[str, Tuple[Callable, int]] = {
+    "wellness_day": (wellness_day, 20),
+    "range_backfill": (range_backfill, 3),
+    "activity_pagination": (activity_pagination, 10),
+    "details_decoding": (details_decoding, 10),
+    "bulk_downloads": (bulk_downloads, 3),
+}
+
+
+def percentile(timings: List[float], q: float) -> float:
+    """Return the 'q' percentile (nearest rank) of 'timings'."""
+
+    ordered = sorted(timings)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+def run(name: str, args) -> Dict[str, Any]:
+    workload, iterations = WORKLOADS[name]
+    adapter = ReplayAdapter(args.latency, args.jitter)
+    for cassette in sorted(CASSETTES.glob("*.yaml")):
+        adapter.record(cassette)
+    synthetic_routes(adapter, args.activities, args.samples)
+    api = client(adapter)
+
+    workload(api)  # warm up
+    adapter.requests = 0
+    timings = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        began = time.perf_counter()
+        workload(api)
+        timings.append(time.perf_counter() - began)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "iterations": iterations,
+        "requests": adapter.requests,
+        "p50_ms": round(percentile(timings, 50) * 1e3, 3),
+        "p99_ms": round(percentile(timings, 99) * 1e3, 3),
+        "ops_per_s": round(iterations / elapsed, 3),
+        "requests_per_s": round(adapter.requests / elapsed, 3),
+    }
+
+
+def version() -> str:
+    try:
+        return metadata.version("garminconnect")
+    except metadata.PackageNotFoundError:
+        return "dev"
+
+
+def compare(results: Dict[str, Any], previous: Dict[str, Any]):
+    for name, result in results["workloads"].items():
+        before = previous.get("workloads", {}).get(name)
+        if not before:
+            continue
+        change = result["p50_ms"] / before["p50_ms"] - 1
+        print(f"{name:22} p50 {change:+.1%} vs {previous['version']}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "workloads", nargs="*", help=f"some of {', '.join(WORKLOADS)}"
+    )
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--activities", type=int, default=2000)
+    parser.add_argument("--samples", type=int, default=10_000)
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--compare", type=Path)
+    args = parser.parse_args(argv)
+    unknown = set(args.workloads) - set(WORKLOADS)
+    if unknown:
+        parser.error(f"unknown workloads {', '.join(sorted(unknown))}")
+
+    results = {
+        "version": version(),
+        "python": platform.python_version(),
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "workloads": {},
+    }
+    for name in args.workloads or WORKLOADS:
+        result = results["workloads"][name] = run(name, args)
+        print(
+            f"{name:22} p50 {result['p50_ms']:9.1f} ms  "
+            f"p99 {result['p99_ms']:9.1f} ms  "
+            f"{result['ops_per_s']:8.2f} ops/s  "
+            f"{result['requests_per_s']:8.1f} req/s"
+        )
+
+    output = args.output or RESULTS / f"replay-{results['version']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2) + "\n")
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,249 +1,932 @@
 """Python 3 API wrapper for Garmin Connect."""
 
+import base64
+import copy
+import dataclasses
+import functools
+import hashlib
+import inspect
+import itertools
+import json
 import logging
 import os
-from datetime import date, datetime, timezone
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
 from enum import Enum, auto
-from typing import Any, Dict, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from urllib.parse import urljoin
 
 import garth
-from withings_sync import fit
+import requests
+from garth.auth_tokens import OAuth1Token, OAuth2Token
+from garth.exc import GarthHTTPError
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .cache import MemoryCache, ResponseCache
+from .graphql import MAX_FIELDS, GraphQLBatch
+from .hooks import RequestHook, RequestInfo
+from .metrics import Metrics, endpoint_template
+from .ratelimit import RateLimiter, retry_after
+
+if TYPE_CHECKING:
+    from .details import ActivityDetails
+    from .timeseries import TimeSeries
 
 logger = logging.getLogger(__name__)
 
 # Temp fix for API change!
 garth.http.USER_AGENT = {"User-Agent": "GCM-iOS-5.7.2.1"}
 
+# Size of the HTTP connection pool of every Garmin instance, also the upper
+# bound for the number of concurrent requests one instance will make.
+POOL_SIZE = 20
 
-class Garmin:
-    """Class for fetching data from Garmin Connect."""
+# Page sizes tried by paginated getters: start at the largest and halve when
+# the server rejects it, but never go below the size the web app uses.
+MAX_PAGE_SIZE = 1000
+MIN_PAGE_SIZE = 20
+# Page size of the lazy iterators, small enough to keep early exits cheap.
+ITER_PAGE_SIZE = 100
+
+# Statuses Garth retries by itself. 429 Too Many Requests is left out and
+# retried by Garmin.request instead, to honour Retry-After and to hold back
+# every request sharing the same rate limiter.
+STATUS_FORCELIST = (408, 500, 502, 503, 504)
+# Retries of a request answered with 429, waiting for its Retry-After or
+# else exponentially longer starting at RETRY_BACKOFF seconds.
+MAX_RETRIES = 4
+RETRY_BACKOFF = 1.0
+
+# File in the token store directory keeping the profile read at login.
+PROFILE_FILE = "profile.json"
+
+# Largest FIT file add_body_compositions uploads, about 10000 records.
+FIT_MAX_SIZE = 256 * 1024
+
+# Weigh-ins are stored in grams. Samples at the same second within this
+# many grams of each other are considered the same weigh-in.
+WEIGHT_UNIT_GRAMS = {"kg": 1000.0, "lbs": 453.59237}
+WEIGHT_TOLERANCE = 10.0
+
+
+def _status_code(error: Exception) -> Optional[int]:
+    """Return the HTTP status code of a failed request, if there is one."""
+
+    response = getattr(getattr(error, "error", None), "response", None)
+    return getattr(response, "status_code", None)
+
+
+def _response_size(response: Any, kwargs: Dict[str, Any]) -> int:
+    """Return the body size of 'response', without reading a stream."""
+
+    if kwargs.get("stream"):
+        return int(response.headers.get("Content-Length") or 0)
+    return len(response.content)
+
+
+def _request_size(kwargs: Dict[str, Any]) -> int:
+    """Return the body size of a request sent with 'kwargs'."""
+
+    if kwargs.get("json") is not None:
+        return len(json.dumps(kwargs["json"]))
+    data = kwargs.get("data")
+    if isinstance(data, (bytes, str)):
+        return len(data)
+    size = 0
+    for value in (kwargs.get("files") or {}).values():
+        fp = value[1] if isinstance(value, tuple) else value
+        if isinstance(fp, bytes):
+            size += len(fp)
+        elif hasattr(fp, "seek"):
+            position = fp.tell()
+            size += fp.seek(0, os.SEEK_END) - position
+            fp.seek(position)
+    return size
+
+
+def _rewind_files(kwargs: Dict[str, Any]):
+    """Seek the files of a request back to the start before a retry."""
+
+    for value in (kwargs.get("files") or {}).values():
+        fp = value[1] if isinstance(value, tuple) else value
+        if hasattr(fp, "seek"):
+            fp.seek(0)
+
+
+def _record_dict(record: Any) -> Dict[str, Any]:
+    """Return a record given as a dict or dataclass as a new dict."""
+
+    if dataclasses.is_dataclass(record) and not isinstance(record, type):
+        return dataclasses.asdict(record)
+    return dict(record)
+
+
+def _date_range(start, end) -> List[str]:
+    """Return all dates from 'start' to 'end' (inclusive) as 'YYYY-MM-DD'."""
+
+    first = date.fromisoformat(str(start))
+    last = date.fromisoformat(str(end))
+    if last < first:
+        raise ValueError(f"End date {end} is before start date {start}")
+
+    return [
+        (first + timedelta(days=n)).isoformat()
+        for n in range((last - first).days + 1)
+    ]
+
+
+def _outcomes(
+    items: Iterable, results: Dict[Any, Any], errors: Dict[Any, Exception]
+) -> List[Any]:
+    """
+    Return the result or exception of every item, in order, from the two
+    dicts returned by _fan_out.
+    """
+
+    return [
+        results[item] if item in results else errors[item] for item in items
+    ]
+
+
+def _memoize(ttl: float):
+    """
+    Cache the result of a Garmin method in its instance's 'metadata_cache'
+    for 'ttl' seconds, keyed by method name and arguments. Cached results
+    are shared between callers and must not be modified.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            cache = self.metadata_cache
+            if cache is None:
+                return func(self, *args, **kwargs)
+
+            key = (func.__name__, args, tuple(sorted(kwargs.items())))
+            hit, value = cache.get(key)
+            if hit:
+                return _resolved(value) if self._is_async else value
+
+            value = func(self, *args, **kwargs)
+            if inspect.isawaitable(value):
+                return _store_result(cache, key, value, ttl)
+            cache.set(key, value, ttl)
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def _flight_key(kind: str, path: str, kwargs: Dict[str, Any]) -> Optional[str]:
+    """
+    Return the key identifying identical reads of 'path', or None for
+    requests which must not be shared (writes, bodies, custom headers).
+    """
+
+    if kwargs.get("method", "GET") != "GET":
+        return None
+    if kwargs.keys() - {"method", "params"}:
+        return None
+    params = json.dumps(kwargs.get("params") or {}, sort_keys=True)
+    return f"{kind} {path} {params}"
+
+
+def _page_params(
+    url: str, params: Dict[str, str], offset: int, size: int
+) -> Dict[str, str]:
+    """Return the 'params' of the page of 'size' items at 'offset'."""
+
+    logger.debug(f"Requesting {url} items {offset} to {offset+size}")
+    return {**params, "start": str(offset), "limit": str(size)}
+
+
+def _copy_exception(error: BaseException) -> BaseException:
+    """Return a shallow copy of 'error', with its traceback so far."""
+
+    try:
+        clone = copy.copy(error)
+    except TypeError:
+        # E.g. (frozen) dataclass exceptions, which args cannot rebuild.
+        clone = error.__class__.__new__(error.__class__)
+        clone.__dict__.update(error.__dict__)
+        object.__setattr__(clone, "args", error.args)
+    return clone.with_traceback(error.__traceback__)
+
+
+class _PooledSession(requests.Session):
+    """A Session of Garmin.shared_session, which knows its pool size."""
+
+    def __init__(self, pool_size: int):
+        super().__init__()
+        # Read back by Garmin to size its concurrent fetches.
+        self.pool_size = pool_size
+
+
+class _SingleFlight:
+    """
+    Share one call between all threads asking for the same key while it
+    is in flight. Every caller receives the same result object (which must
+    not be modified) or a copy of the same exception, chained to it.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Optional[str], func: Callable, *args) -> Any:
+        if key is None:
+            return func(*args)
+
+        with self._lock:
+            in_flight = self._calls.get(key)
+            if in_flight is None:
+                future: Future = Future()
+                self._calls[key] = future
+        if in_flight is not None:
+            error = in_flight.exception()
+            if error is None:
+                return in_flight.result()
+            # Raising the shared exception in every thread would mutate its
+            # __traceback__ from all of them at once.
+            raise _copy_exception(error) from error
+
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(_copy_exception(e))
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+async def _resolved(value):
+    return value
+
+
+async def _store_result(cache: MemoryCache, key, awaitable, ttl: float):
+    value = await awaitable
+    cache.set(key, value, ttl)
+    return value
+
+
+@functools.lru_cache(maxsize=None)
+def _file_mode() -> int:
+    """Return the mode open() gives new files under the process umask."""
+
+    # The umask can only be read by setting it, so only do it once.
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+class _DownloadWriter:
+    """
+    Write a download to a path or a writable file object, counting its
+    size and SHA-256. Paths are written to a temporary file in the same
+    directory which replaces the destination only when writing succeeded.
+    """
+
+    def __init__(self, dest):
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._tmp_path: Optional[str] = None
+        if hasattr(dest, "write"):
+            self.path = None
+            self._file = dest
+        else:
+            self.path = os.path.abspath(os.path.expanduser(dest))
+            fd, self._tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.path),
+                prefix=f".{os.path.basename(self.path)}.",
+                suffix=".part",
+            )
+            self._file = os.fdopen(fd, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._tmp_path is None:
+            return
+        self._file.close()
+        if exc_type is None:
+            # mkstemp creates the file readable by its owner only.
+            os.chmod(self._tmp_path, _file_mode())
+            os.replace(self._tmp_path, self.path)
+        else:
+            os.unlink(self._tmp_path)
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+        self._sha256.update(chunk)
+        self.size += len(chunk)
+
+    def result(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "size": self.size,
+            "sha256": self._sha256.hexdigest(),
+        }
+
+
+class _ArchiveManifest:
+    """
+    Append-only JSON Lines record of the files an archive run completed,
+    so a rerun can skip them. A torn last line from a crash is ignored.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry["file"]] = entry
+
+    def is_done(self, filename: str, directory: str) -> bool:
+        entry = self.entries.get(filename)
+        path = os.path.join(directory, filename)
+        return (
+            entry is not None
+            and os.path.exists(path)
+            and os.path.getsize(path) == entry["size"]
+        )
+
+    def add(self, entry: Dict[str, Any]):
+        with self._lock:
+            self.entries[entry["file"]] = entry
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+class _GarminBase:
+    """
+    The endpoints and state shared by Garmin and AsyncGarmin. Methods
+    sending requests return what request, connectapi or download return:
+    results in Garmin, awaitables in AsyncGarmin.
+    """
+
+    _is_async = False
+
+    # Implemented by Garmin as blocking calls, by AsyncGarmin as coroutines.
+    request: Callable[..., Any]
+    connectapi: Callable[..., Any]
+    download: Callable[..., Any]
+    get_user_summary: Callable[..., Any]
+    _paginate: Callable[..., Any]
+    _iter_pages: Callable[..., Any]
+    _series: Callable[..., Any]
+
+    # Endpoints, shared by all instances. Instances (or subclasses) can
+    # override single endpoints by assigning them.
+    garmin_connect_social_profile_url = "/userprofile-service/socialProfile"
+    garmin_connect_user_settings_url = (
+        "/userprofile-service/userprofile/user-settings"
+    )
+    garmin_connect_userprofile_settings_url = (
+        "/userprofile-service/userprofile/settings"
+    )
+    garmin_connect_devices_url = "/device-service/deviceregistration/devices"
+    garmin_connect_device_url = "/device-service/deviceservice"
+
+    garmin_connect_primary_device_url = (
+        "/web-gateway/device-info/primary-training-device"
+    )
+
+    garmin_connect_solar_url = "/web-gateway/solar"
+    garmin_connect_weight_url = "/weight-service"
+    garmin_connect_daily_summary_url = "/usersummary-service/usersummary/daily"
+    garmin_connect_metrics_url = "/metrics-service/metrics/maxmet/daily"
+    garmin_connect_daily_hydration_url = (
+        "/usersummary-service/usersummary/hydration/daily"
+    )
+    garmin_connect_set_hydration_url = (
+        "usersummary-service/usersummary/hydration/log"
+    )
+    garmin_connect_daily_stats_steps_url = (
+        "/usersummary-service/stats/steps/daily"
+    )
+    garmin_connect_personal_record_url = (
+        "/personalrecord-service/personalrecord/prs"
+    )
+    garmin_connect_earned_badges_url = "/badge-service/badge/earned"
+    garmin_connect_adhoc_challenges_url = (
+        "/adhocchallenge-service/adHocChallenge/historical"
+    )
+    garmin_connect_adhoc_challenge_url = (
+        "/adhocchallenge-service/adHocChallenge/"
+    )
+    garmin_connect_badge_challenges_url = (
+        "/badgechallenge-service/badgeChallenge/completed"
+    )
+    garmin_connect_available_badge_challenges_url = (
+        "/badgechallenge-service/badgeChallenge/available"
+    )
+    garmin_connect_non_completed_badge_challenges_url = (
+        "/badgechallenge-service/badgeChallenge/non-completed"
+    )
+    garmin_connect_inprogress_virtual_challenges_url = (
+        "/badgechallenge-service/virtualChallenge/inProgress"
+    )
+    garmin_connect_daily_sleep_url = (
+        "/wellness-service/wellness/dailySleepData"
+    )
+    garmin_connect_daily_stress_url = "/wellness-service/wellness/dailyStress"
+    garmin_connect_hill_score_url = "/metrics-service/metrics/hillscore"
+
+    garmin_connect_daily_body_battery_url = (
+        "/wellness-service/wellness/bodyBattery/reports/daily"
+    )
+
+    garmin_connect_body_battery_events_url = (
+        "/wellness-service/wellness/bodyBattery/events"
+    )
+
+    garmin_connect_blood_pressure_endpoint = (
+        "/bloodpressure-service/bloodpressure/range"
+    )
+
+    garmin_connect_set_blood_pressure_endpoint = (
+        "/bloodpressure-service/bloodpressure"
+    )
+
+    garmin_connect_endurance_score_url = (
+        "/metrics-service/metrics/endurancescore"
+    )
+    garmin_connect_menstrual_calendar_url = (
+        "/periodichealth-service/menstrualcycle/calendar"
+    )
+
+    garmin_connect_menstrual_dayview_url = (
+        "/periodichealth-service/menstrualcycle/dayview"
+    )
+    garmin_connect_pregnancy_snapshot_url = (
+        "periodichealth-service/menstrualcycle/pregnancysnapshot"
+    )
+    garmin_connect_goals_url = "/goal-service/goal/goals"
+
+    garmin_connect_rhr_url = "/userstats-service/wellness/daily"
+
+    garmin_connect_hrv_url = "/hrv-service/hrv"
+
+    garmin_connect_training_readiness_url = (
+        "/metrics-service/metrics/trainingreadiness"
+    )
+
+    garmin_connect_race_predictor_url = (
+        "/metrics-service/metrics/racepredictions"
+    )
+    garmin_connect_training_status_url = (
+        "/metrics-service/metrics/trainingstatus/aggregated"
+    )
+    garmin_connect_user_summary_chart = (
+        "/wellness-service/wellness/dailySummaryChart"
+    )
+    garmin_connect_floors_chart_daily_url = (
+        "/wellness-service/wellness/floorsChartData/daily"
+    )
+    garmin_connect_heartrates_daily_url = (
+        "/wellness-service/wellness/dailyHeartRate"
+    )
+    garmin_connect_daily_respiration_url = (
+        "/wellness-service/wellness/daily/respiration"
+    )
+    garmin_connect_daily_spo2_url = "/wellness-service/wellness/daily/spo2"
+    garmin_connect_daily_intensity_minutes = (
+        "/wellness-service/wellness/daily/im"
+    )
+    garmin_all_day_stress_url = "/wellness-service/wellness/dailyStress"
+    garmin_daily_events_url = "/wellness-service/wellness/dailyEvents"
+    garmin_connect_activities = (
+        "/activitylist-service/activities/search/activities"
+    )
+    garmin_connect_activities_baseurl = "/activitylist-service/activities/"
+    garmin_connect_activity = "/activity-service/activity"
+    garmin_connect_activity_types = "/activity-service/activity/activityTypes"
+    garmin_connect_activity_fordate = "/mobile-gateway/heartRate/forDate"
+    garmin_connect_fitnessstats = "/fitnessstats-service/activity"
+    garmin_connect_fitnessage = "/fitnessage-service/fitnessage"
+
+    garmin_connect_fit_download = "/download-service/files/activity"
+    garmin_connect_tcx_download = "/download-service/export/tcx/activity"
+    garmin_connect_gpx_download = "/download-service/export/gpx/activity"
+    garmin_connect_kml_download = "/download-service/export/kml/activity"
+    garmin_connect_csv_download = "/download-service/export/csv/activity"
+
+    garmin_connect_upload = "/upload-service/upload"
+
+    garmin_connect_gear = "/gear-service/gear/filterGear"
+    garmin_connect_gear_baseurl = "/gear-service/gear/"
+
+    garmin_request_reload_url = "/wellness-service/wellness/epoch/request"
+
+    garmin_workouts = "/workout-service"
+
+    garmin_connect_delete_activity_url = "/activity-service/activity"
+
+    garmin_graphql_endpoint = "graphql-gateway/graphql"
 
     def __init__(
-        self, email=None, password=None, is_cn=False, prompt_mfa=None
+        self,
+        email=None,
+        password=None,
+        is_cn=False,
+        prompt_mfa=None,
+        cache: Optional[ResponseCache] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        session: Optional[requests.Session] = None,
+        base_url: Optional[str] = None,
+        metrics: Optional[Metrics] = None,
+        hooks: Iterable[RequestHook] = (),
     ):
-        """Create a new class instance."""
+        """
+        Create a new class instance.
+        Pass a ResponseCache as 'cache' to keep responses for past days and
+        finished activities on disk, and a RateLimiter as 'rate_limiter' to
+        throttle requests (share one to throttle several instances).
+        Pass a Session from Garmin.shared_session() as 'session' to share
+        its connection pool between many instances.
+        Pass 'base_url' (e.g. "http://127.0.0.1:8080") to send the API
+        requests to another server, such as a StandInServer.
+        Pass a Metrics as 'metrics' to record the calls, latency, sizes,
+        retries and statuses of every endpoint (share one to aggregate
+        several instances), and RequestHooks as 'hooks' to call them
+        around every request.
+        """
         self.username = email
         self.password = password
         self.is_cn = is_cn
         self.prompt_mfa = prompt_mfa
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        # Called around every request, see _attempt.
+        self.hooks: List[RequestHook] = [
+            *([metrics] if metrics is not None else []),
+            *hooks,
+        ]
+        self.max_retries = MAX_RETRIES
+        self.base_url = base_url.rstrip("/") if base_url else None
+        # Near-static account metadata, see _memoize. Set to None to disable.
+        self.metadata_cache: Optional[MemoryCache] = MemoryCache()
+
+        domain = "garmin.cn" if is_cn else "garmin.com"
+        if session is None:
+            self.garth = garth.Client(
+                domain=domain,
+                pool_connections=POOL_SIZE,
+                pool_maxsize=POOL_SIZE,
+            )
+            self.garth.configure(status_forcelist=STATUS_FORCELIST)
+        else:
+            # Passed to garth.Client, the session would get an adapter of
+            # its own mounted while other instances send requests on it.
+            self.garth = garth.Client(domain=domain)
+            self.garth.sess = session
+            session.headers.update(garth.http.USER_AGENT)
+            self.garth.status_forcelist = STATUS_FORCELIST
+            self.garth.pool_maxsize = getattr(
+                session, "pool_size", DEFAULT_POOLSIZE
+            )
+        self._mount_base_url()
 
-        self.garmin_connect_user_settings_url = (
-            "/userprofile-service/userprofile/user-settings"
-        )
-        self.garmin_connect_userprofile_settings_url = (
-            "/userprofile-service/userprofile/settings"
-        )
-        self.garmin_connect_devices_url = (
-            "/device-service/deviceregistration/devices"
-        )
-        self.garmin_connect_device_url = "/device-service/deviceservice"
+        self.display_name: Optional[str] = None
+        self.full_name: Optional[str] = None
+        self.unit_system: Optional[str] = None
 
-        self.garmin_connect_primary_device_url = (
-            "/web-gateway/device-info/primary-training-device"
-        )
+        # Largest page size the server accepted, by paginated endpoint.
+        self._page_sizes: Dict[str, int] = {}
+        # Paginated endpoints whose short pages were found to be the last
+        # one, rather than capped by the server.
+        self._short_page_ends: Set[str] = set()
+        # Reads in flight, shared by concurrent identical calls.
+        self._flights = _SingleFlight()
 
-        self.garmin_connect_solar_url = "/web-gateway/solar"
-        self.garmin_connect_weight_url = "/weight-service"
-        self.garmin_connect_daily_summary_url = (
-            "/usersummary-service/usersummary/daily"
-        )
-        self.garmin_connect_metrics_url = (
-            "/metrics-service/metrics/maxmet/daily"
-        )
-        self.garmin_connect_daily_hydration_url = (
-            "/usersummary-service/usersummary/hydration/daily"
-        )
-        self.garmin_connect_set_hydration_url = (
-            "usersummary-service/usersummary/hydration/log"
-        )
-        self.garmin_connect_daily_stats_steps_url = (
-            "/usersummary-service/stats/steps/daily"
-        )
-        self.garmin_connect_personal_record_url = (
-            "/personalrecord-service/personalrecord/prs"
-        )
-        self.garmin_connect_earned_badges_url = "/badge-service/badge/earned"
-        self.garmin_connect_adhoc_challenges_url = (
-            "/adhocchallenge-service/adHocChallenge/historical"
-        )
-        self.garmin_connect_adhoc_challenges_url = (
-            "/adhocchallenge-service/adHocChallenge/historical"
-        )
-        self.garmin_connect_adhoc_challenge_url = (
-            "/adhocchallenge-service/adHocChallenge/"
-        )
-        self.garmin_connect_badge_challenges_url = (
-            "/badgechallenge-service/badgeChallenge/completed"
-        )
-        self.garmin_connect_available_badge_challenges_url = (
-            "/badgechallenge-service/badgeChallenge/available"
-        )
-        self.garmin_connect_non_completed_badge_challenges_url = (
-            "/badgechallenge-service/badgeChallenge/non-completed"
-        )
-        self.garmin_connect_inprogress_virtual_challenges_url = (
-            "/badgechallenge-service/virtualChallenge/inProgress"
-        )
-        self.garmin_connect_daily_sleep_url = (
-            "/wellness-service/wellness/dailySleepData"
-        )
-        self.garmin_connect_daily_stress_url = (
-            "/wellness-service/wellness/dailyStress"
-        )
-        self.garmin_connect_hill_score_url = (
-            "/metrics-service/metrics/hillscore"
-        )
+    def _mount_base_url(self):
+        """Send requests for 'base_url' through the pool of the session."""
 
-        self.garmin_connect_daily_body_battery_url = (
-            "/wellness-service/wellness/bodyBattery/reports/daily"
-        )
+        if self.base_url is not None:
+            session = self.garth.sess
+            adapter = session.get_adapter("https://")
+            # Mounting reorders the adapters, only do it once per session.
+            if session.adapters.get(self.base_url) is not adapter:
+                session.mount(self.base_url, adapter)
 
-        self.garmin_connect_body_battery_events_url = (
-            "/wellness-service/wellness/bodyBattery/events"
-        )
+    def _api_url(self, path: str) -> str:
+        """Return the url of 'path' on the connectapi domain or 'base_url'."""
 
-        self.garmin_connect_blood_pressure_endpoint = (
-            "/bloodpressure-service/bloodpressure/range"
-        )
+        if self.base_url is None:
+            return urljoin(f"https://connectapi.{self.garth.domain}", path)
+        return f"{self.base_url}/{path.lstrip('/')}"
 
-        self.garmin_connect_set_blood_pressure_endpoint = (
-            "/bloodpressure-service/bloodpressure"
-        )
+    def _invalidate_cache(self, fragment: str):
+        """Drop cached responses affected by a change to 'fragment'."""
 
-        self.garmin_connect_endurance_score_url = (
-            "/metrics-service/metrics/endurancescore"
-        )
-        self.garmin_connect_menstrual_calendar_url = (
-            "/periodichealth-service/menstrualcycle/calendar"
-        )
+        if self.cache is not None:
+            self.cache.invalidate(fragment)
 
-        self.garmin_connect_menstrual_dayview_url = (
-            "/periodichealth-service/menstrualcycle/dayview"
-        )
-        self.garmin_connect_pregnancy_snapshot_url = (
-            "periodichealth-service/menstrualcycle/pregnancysnapshot"
-        )
-        self.garmin_connect_goals_url = "/goal-service/goal/goals"
+    def clear_metadata_cache(self, *methods: str):
+        """
+        Drop memoized metadata of the given method names, e.g.
+        "get_devices", or of all methods if none are given.
+        """
 
-        self.garmin_connect_rhr_url = "/userstats-service/wellness/daily"
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(*methods)
 
-        self.garmin_connect_hrv_url = "/hrv-service/hrv"
+    def cache_stats(self) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Return the statistics of the metadata and response caches."""
 
-        self.garmin_connect_training_readiness_url = (
-            "/metrics-service/metrics/trainingreadiness"
-        )
+        return {
+            "metadata": (
+                self.metadata_cache.stats() if self.metadata_cache else None
+            ),
+            "responses": self.cache.stats() if self.cache else None,
+        }
 
-        self.garmin_connect_race_predictor_url = (
-            "/metrics-service/metrics/racepredictions"
-        )
-        self.garmin_connect_training_status_url = (
-            "/metrics-service/metrics/trainingstatus/aggregated"
-        )
-        self.garmin_connect_user_summary_chart = (
-            "/wellness-service/wellness/dailySummaryChart"
-        )
-        self.garmin_connect_floors_chart_daily_url = (
-            "/wellness-service/wellness/floorsChartData/daily"
-        )
-        self.garmin_connect_heartrates_daily_url = (
-            "/wellness-service/wellness/dailyHeartRate"
-        )
-        self.garmin_connect_daily_respiration_url = (
-            "/wellness-service/wellness/daily/respiration"
-        )
-        self.garmin_connect_daily_spo2_url = (
-            "/wellness-service/wellness/daily/spo2"
-        )
-        self.garmin_connect_daily_intensity_minutes = (
-            "/wellness-service/wellness/daily/im"
-        )
-        self.garmin_all_day_stress_url = (
-            "/wellness-service/wellness/dailyStress"
-        )
-        self.garmin_daily_events_url = "/wellness-service/wellness/dailyEvents"
-        self.garmin_connect_activities = (
-            "/activitylist-service/activities/search/activities"
-        )
-        self.garmin_connect_activities_baseurl = (
-            "/activitylist-service/activities/"
-        )
-        self.garmin_connect_activity = "/activity-service/activity"
-        self.garmin_connect_activity_types = (
-            "/activity-service/activity/activityTypes"
-        )
-        self.garmin_connect_activity_fordate = (
-            "/mobile-gateway/heartRate/forDate"
-        )
-        self.garmin_connect_fitnessstats = "/fitnessstats-service/activity"
-        self.garmin_connect_fitnessage = "/fitnessage-service/fitnessage"
+    def _before_request(
+        self, method: str, path: str, attempt: int, kwargs: Dict[str, Any]
+    ) -> RequestInfo:
+        """Return the RequestInfo of a request about to be sent."""
+
+        request = RequestInfo(
+            method,
+            path,
+            endpoint_template(path, self.display_name),
+            kwargs.get("params"),
+            attempt,
+            _request_size(kwargs),
+        )
+        for hook in self.hooks:
+            hook.before_request(request)
+        request.start = time.perf_counter()
+        return request
+
+    def _after_response(
+        self, request: RequestInfo, response: Any, size: int, retries: int
+    ):
+        request.seconds = time.perf_counter() - request.start
+        request.status = response.status_code
+        request.response_bytes = size
+        request.retries = int(request.attempt > 0) + retries
+        for hook in self.hooks:
+            hook.after_response(request, response)
+
+    def _on_error(
+        self, request: RequestInfo, error: Exception, status: Optional[int]
+    ):
+        request.seconds = time.perf_counter() - request.start
+        request.status = status
+        request.retries = int(request.attempt > 0)
+        for hook in self.hooks:
+            hook.on_error(request, error)
 
-        self.garmin_connect_fit_download = "/download-service/files/activity"
-        self.garmin_connect_tcx_download = (
-            "/download-service/export/tcx/activity"
-        )
-        self.garmin_connect_gpx_download = (
-            "/download-service/export/gpx/activity"
-        )
-        self.garmin_connect_kml_download = (
-            "/download-service/export/kml/activity"
-        )
-        self.garmin_connect_csv_download = (
-            "/download-service/export/csv/activity"
-        )
+    def add_hook(self, hook: RequestHook):
+        """Call 'hook' (a RequestHook) around every request from now on."""
+
+        # Replaced rather than changed, requests in flight keep their list.
+        self.hooks = [*self.hooks, hook]
+
+    def remove_hook(self, hook: RequestHook):
+        """Stop calling 'hook'."""
 
-        self.garmin_connect_upload = "/upload-service/upload"
+        self.hooks = [other for other in self.hooks if other is not hook]
 
-        self.garmin_connect_gear = "/gear-service/gear/filterGear"
-        self.garmin_connect_gear_baseurl = "/gear-service/gear/"
+    def _retry_delay(
+        self, error: GarthHTTPError, attempt: int, path: str
+    ) -> float:
+        """
+        Return the seconds to wait before retrying a request that failed
+        with 'error', and hold back the rate limiter as long. Re-raises
+        errors other than 429 and raises GarminConnectTooManyRequestsError
+        when out of retries.
+        """
+
+        if _status_code(error) != 429:
+            raise error
+        if attempt >= self.max_retries:
+            raise GarminConnectTooManyRequestsError(
+                f"Too many requests for {path}"
+            ) from error
+
+        delay = retry_after(error.error.response)
+        if delay is None:
+            delay = RETRY_BACKOFF * 2**attempt
+        logger.debug(f"Rate limited on {path}, retrying in {delay:.1f}s")
+        if self.rate_limiter is not None:
+            self.rate_limiter.backoff(delay)
+        return delay
+
+    def _short_page_is_last(self, url: str, size: int) -> bool:
+        """
+        Return whether a page of 'url' shorter than 'size' items is known
+        to be the last one, rather than one the server silently capped.
+        """
 
-        self.garmin_request_reload_url = (
-            "/wellness-service/wellness/epoch/request"
+        return (
+            self._page_sizes.get(url, 0) >= size
+            or url in self._short_page_ends
         )
 
-        self.garmin_workouts = "/workout-service"
+    def _learn_page_end(self, url: str, size: int, capped: bool):
+        """
+        Remember what the request after a short page of 'size' items of
+        'url' showed: that the server caps its pages at 'size', or that
+        short pages of 'url' are the last one.
+        """
+
+        if capped:
+            self._page_sizes.setdefault(url, size)
+        else:
+            self._short_page_ends.add(url)
 
-        self.garmin_connect_delete_activity_url = "/activity-service/activity"
+    def _page_requests(
+        self, url: str, start: int, limit: Optional[int], workers: int
+    ) -> Generator[List[Tuple[int, int]], List[List[Any]], List[Any]]:
+        """
+        Plan the requests of _paginate. Yields the (offset, size) of the
+        next pages, which can be requested concurrently, and is sent back
+        the list of those pages; an error of the first request is thrown
+        into it. Returns all items.
+        """
 
-        self.garmin_graphql_endpoint = "graphql-gateway/graphql"
+        size = limit or self._page_sizes.get(url, MAX_PAGE_SIZE)
+        while True:
+            try:
+                [page] = yield [(start, size)]
+                break
+            except GarthHTTPError as e:
+                if limit or size <= MIN_PAGE_SIZE or _status_code(e) != 400:
+                    raise
+                size = max(MIN_PAGE_SIZE, size // 2)
+                logger.debug(f"Page size rejected, retrying with {size}")
+
+        items = list(page)
+        if 0 < len(page) < size and not self._short_page_is_last(url, size):
+            # A short first page is either the last one, or the server
+            # silently capped the page size; one more request tells which.
+            size = len(page)
+            [page] = yield [(start + size, size)]
+            items.extend(page)
+            self._learn_page_end(url, size, capped=bool(page))
+        elif not limit and len(page) == size:
+            self._page_sizes[url] = size
+
+        offset = start + len(items)
+        window = 1
+        while len(page) == size:
+            pages = yield [(offset + n * size, size) for n in range(window)]
+            for page in pages:
+                items.extend(page)
+                if len(page) < size:
+                    break
+            offset = offset + window * size
+            # Grow the speculation window so short histories do not
+            # waste requests past their end.
+            window = min(window * 2, workers)
+
+        return items
+
+    def _iter_page_requests(
+        self, url: str, start: int, limit: Optional[int]
+    ) -> Generator[Tuple[int, int], List[Any], None]:
+        """
+        Plan the requests of _iter_pages. Yields the (offset, size) of the
+        next page and is sent back that page, until the last one.
+        """
 
-        self.garth = garth.Client(
-            domain="garmin.cn" if is_cn else "garmin.com",
-            pool_connections=20,
-            pool_maxsize=20,
+        # Never larger than a size the server is known to accept, but kept
+        # small for cheap early exits even when it accepts more.
+        size = limit or min(
+            ITER_PAGE_SIZE, self._page_sizes.get(url, ITER_PAGE_SIZE)
         )
+        # Whether a short page can be trusted to be the last one, rather
+        # than a page the server silently capped.
+        confirmed = self._short_page_is_last(url, size)
+        probing = False
+        offset = start
+        while True:
+            page = yield offset, size
 
-        self.display_name = None
-        self.full_name = None
-        self.unit_system = None
+            offset = offset + len(page)
+            if probing:
+                self._learn_page_end(url, size, capped=bool(page))
+                probing = False
+            if not page or (confirmed and len(page) < size):
+                return
+            if len(page) < size:
+                size = len(page)
+                probing = True
+            confirmed = True
 
-    def connectapi(self, path, **kwargs):
-        return self.garth.connectapi(path, **kwargs)
+    def _day_getter(self, metric: Union[str, Callable]) -> Callable:
+        """Return the per-day getter 'metric' names, see fetch_range."""
 
-    def download(self, path, **kwargs):
-        return self.garth.download(path, **kwargs)
+        if callable(metric):
+            return metric
+        name = metric if metric.startswith("get_") else f"get_{metric}"
+        getter = getattr(self, name, None)
+        if not callable(getter):
+            raise ValueError(f"Unknown metric {metric}")
+        return getter
 
-    def login(self, /, tokenstore: Optional[str] = None):
-        """Log in using Garth."""
-        tokenstore = tokenstore or os.getenv("GARMINTOKENS")
+    def _load_tokens(self, tokenstore: Optional[str] = None):
+        """Load tokens from 'tokenstore' or log in with the credentials."""
 
         if tokenstore:
             if len(tokenstore) > 512:
-                self.garth.loads(tokenstore)
+                oauth1, oauth2 = json.loads(base64.b64decode(tokenstore))
             else:
-                self.garth.load(tokenstore)
+                directory = os.path.expanduser(tokenstore)
+                with open(os.path.join(directory, "oauth1_token.json")) as f:
+                    oauth1 = json.load(f)
+                with open(os.path.join(directory, "oauth2_token.json")) as f:
+                    oauth2 = json.load(f)
+            # Not through garth's load(), which mounts a new adapter on the
+            # session, maybe shared and in use by other instances.
+            self.garth.oauth1_token = OAuth1Token(**oauth1)
+            self.garth.oauth2_token = OAuth2Token(**oauth2)
+            if oauth1.get("domain"):
+                self.garth.domain = oauth1["domain"]
         else:
             self.garth.login(
                 self.username, self.password, prompt_mfa=self.prompt_mfa
             )
 
-        self.display_name = self.garth.profile["displayName"]
-        self.full_name = self.garth.profile["fullName"]
+    def _profile_path(self, tokenstore: Optional[str]) -> Optional[str]:
+        """Return the profile file of a token store directory."""
 
-        settings = self.garth.connectapi(self.garmin_connect_user_settings_url)
-        self.unit_system = settings["userData"]["measurementSystem"]
+        if not tokenstore or len(tokenstore) > 512:
+            return None
+        return os.path.join(os.path.expanduser(tokenstore), PROFILE_FILE)
+
+    def _token_expires_at(self) -> Optional[int]:
+        return getattr(self.garth.oauth2_token, "expires_at", None)
+
+    def _restore_profile(self, path: str, max_age: float) -> bool:
+        """
+        Restore the profile saved at 'path', unless it is older than
+        'max_age' seconds or was saved with other (since refreshed) tokens.
+        """
 
+        try:
+            with open(path) as f:
+                profile = json.load(f)
+            if time.time() - profile["saved_at"] > max_age:
+                return False
+            if profile["token_expires_at"] != self._token_expires_at():
+                return False
+            self.display_name = profile["display_name"]
+            self.full_name = profile["full_name"]
+            self.unit_system = profile["unit_system"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+        logger.debug(f"Restored profile from {path}")
         return True
 
+    def _save_profile(self, path: str):
+        profile = {
+            "display_name": self.display_name,
+            "full_name": self.full_name,
+            "unit_system": self.unit_system,
+            "token_expires_at": self._token_expires_at(),
+            "saved_at": time.time(),
+        }
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), suffix=".part"
+        )
+        with os.fdopen(fd, "w") as f:
+            json.dump(profile, f)
+        os.replace(tmp_path, path)
+
     def get_full_name(self):
         """Return full name."""
 
@@ -262,20 +945,6 @@ class Garmin:
 
         return self.get_user_summary(cdate)
 
-    def get_user_summary(self, cdate: str) -> Dict[str, Any]:
-        """Return user activity summary for 'cdate' format 'YYYY-MM-DD'."""
-
-        url = f"{self.garmin_connect_daily_summary_url}/{self.display_name}"
-        params = {"calendarDate": str(cdate)}
-        logger.debug("Requesting user summary")
-
-        response = self.connectapi(url, params=params)
-
-        if response["privacyProtected"] is True:
-            raise GarminConnectAuthenticationError("Authentication error")
-
-        return response
-
     def get_steps_data(self, cdate):
         """Fetch available steps data 'cDate' format 'YYYY-MM-DD'."""
 
@@ -310,14 +979,6 @@ class Garmin:
 
         return self.connectapi(url, params=params)
 
-    def get_stats_and_body(self, cdate):
-        """Return activity data and body composition (compat for garminconnect)."""
-
-        return {
-            **self.get_stats(cdate),
-            **self.get_body_composition(cdate)["totalAverage"],
-        }
-
     def get_body_composition(
         self, startdate: str, enddate=None
     ) -> Dict[str, Any]:
@@ -334,49 +995,46 @@ class Garmin:
 
         return self.connectapi(url, params=params)
 
-    def add_body_composition(
-        self,
-        timestamp: Optional[str],
-        weight: float,
-        percent_fat: Optional[float] = None,
-        percent_hydration: Optional[float] = None,
-        visceral_fat_mass: Optional[float] = None,
-        bone_mass: Optional[float] = None,
-        muscle_mass: Optional[float] = None,
-        basal_met: Optional[float] = None,
-        active_met: Optional[float] = None,
-        physique_rating: Optional[float] = None,
-        metabolic_age: Optional[float] = None,
-        visceral_fat_rating: Optional[float] = None,
-        bmi: Optional[float] = None,
-    ):
-        dt = datetime.fromisoformat(timestamp) if timestamp else datetime.now()
-        fitEncoder = fit.FitEncoderWeight()
-        fitEncoder.write_file_info()
-        fitEncoder.write_file_creator()
-        fitEncoder.write_device_info(dt)
-        fitEncoder.write_weight_scale(
-            dt,
-            weight=weight,
-            percent_fat=percent_fat,
-            percent_hydration=percent_hydration,
-            visceral_fat_mass=visceral_fat_mass,
-            bone_mass=bone_mass,
-            muscle_mass=muscle_mass,
-            basal_met=basal_met,
-            active_met=active_met,
-            physique_rating=physique_rating,
-            metabolic_age=metabolic_age,
-            visceral_fat_rating=visceral_fat_rating,
-            bmi=bmi,
-        )
-        fitEncoder.finish()
+    @staticmethod
+    def _body_composition_files(
+        records: Iterable[Any], max_size: int = FIT_MAX_SIZE
+    ) -> Iterator[bytes]:
+        """
+        Encode body composition 'records' into FIT files of at most
+        'max_size' bytes, consuming the records only as far as needed.
+        """
 
-        url = self.garmin_connect_upload
-        files = {
-            "file": ("body_composition.fit", fitEncoder.getvalue()),
-        }
-        return self.garth.post("connectapi", url, files=files, api=True)
+        from withings_sync import fit
+
+        encoder = None
+        record_size = 0
+        for record in records:
+            values = _record_dict(record)
+            dt = values.pop("timestamp", None) or datetime.now()
+            if isinstance(dt, str):
+                dt = datetime.fromisoformat(dt)
+
+            # Room for one more record and the 2 byte CRC of finish().
+            if (
+                encoder is not None
+                and encoder.buf.tell() + record_size + 2 > max_size
+            ):
+                encoder.finish()
+                yield encoder.getvalue()
+                encoder = None
+            if encoder is None:
+                encoder = fit.FitEncoderWeight()
+                encoder.write_file_info()
+                encoder.write_file_creator()
+                encoder.write_device_info(dt)
+
+            start = encoder.buf.tell()
+            encoder.write_weight_scale(dt, **values)
+            record_size = encoder.buf.tell() - start
+
+        if encoder is not None:
+            encoder.finish()
+            yield encoder.getvalue()
 
     def add_weigh_in(
         self, weight: int, unitKey: str = "kg", timestamp: str = ""
@@ -396,7 +1054,7 @@ class Garmin:
         }
         logger.debug("Adding weigh-in")
 
-        return self.garth.post("connectapi", url, json=payload)
+        return self.request("POST", url, json=payload)
 
     def add_weigh_in_with_timestamps(
         self,
@@ -434,7 +1092,79 @@ class Garmin:
         logger.debug(f"Adding weigh-in with explicit timestamps: {payload}")
 
         # Make the POST request
-        return self.garth.post("connectapi", url, json=payload)
+        return self.request("POST", url, json=payload)
+
+    @staticmethod
+    def _weigh_in_key(record: Dict[str, Any]) -> Tuple[int, float]:
+        """
+        Return the GMT timestamp in seconds and the weight in grams of a
+        weigh-in as add_weigh_in_with_timestamps would post it.
+        """
+
+        dt = datetime.fromisoformat(record["dateTimestamp"])
+        gmt = record.get("gmtTimestamp")
+        dtGMT = (
+            datetime.fromisoformat(gmt) if gmt else dt.astimezone(timezone.utc)
+        )
+        if dtGMT.tzinfo is None:
+            dtGMT = dtGMT.replace(tzinfo=timezone.utc)
+        grams = (
+            record["weight"] * WEIGHT_UNIT_GRAMS[record.get("unitKey", "kg")]
+        )
+        return int(dtGMT.timestamp()), grams
+
+    def _plan_weigh_ins(
+        self, records: Iterable[Any]
+    ) -> Tuple[List[Dict[str, Any]], Optional[Tuple[str, str]]]:
+        """
+        Return the records as dicts and the date window (padded by a day for
+        time zones) covering them, for import_weigh_ins.
+        """
+
+        records = [_record_dict(record) for record in records]
+        for record in records:
+            if not record.get("dateTimestamp"):
+                raise ValueError(f"Weigh-in without dateTimestamp: {record}")
+        if not records:
+            return records, None
+
+        dates = [
+            datetime.fromisoformat(r["dateTimestamp"]).date() for r in records
+        ]
+        return records, (
+            (min(dates) - timedelta(days=1)).isoformat(),
+            (max(dates) + timedelta(days=1)).isoformat(),
+        )
+
+    def _new_weigh_ins(
+        self, records: List[Dict[str, Any]], existing: Optional[Dict]
+    ) -> List[int]:
+        """
+        Return the indexes of the 'records' matching none of the 'existing'
+        weigh-ins (a get_weigh_ins response) nor an earlier record.
+        """
+
+        known: Dict[int, List[float]] = {}
+        for summary in (existing or {}).get("dailyWeightSummaries") or []:
+            for sample in summary.get("allWeightMetrics") or []:
+                if sample.get("timestampGMT") and sample.get("weight"):
+                    seconds = sample["timestampGMT"] // 1000
+                    known.setdefault(seconds, []).append(sample["weight"])
+
+        new = []
+        for index, record in enumerate(records):
+            seconds, grams = self._weigh_in_key(record)
+            weights = known.setdefault(seconds, [])
+            if any(abs(grams - w) <= WEIGHT_TOLERANCE for w in weights):
+                continue
+            weights.append(grams)
+            new.append(index)
+
+        logger.debug(
+            f"Adding {len(new)} of {len(records)} weigh-ins, "
+            "the others exist"
+        )
+        return new
 
     def get_weigh_ins(self, startdate: str, enddate: str):
         """Get weigh-ins between startdate and enddate using format 'YYYY-MM-DD'."""
@@ -459,36 +1189,44 @@ class Garmin:
         url = f"{self.garmin_connect_weight_url}/weight/{cdate}/byversion/{weight_pk}"
         logger.debug("Deleting weigh-in")
 
-        return self.garth.request(
-            "DELETE",
-            "connectapi",
-            url,
-            api=True,
-        )
+        return self.request("DELETE", url, api=True)
 
-    def delete_weigh_ins(self, cdate: str, delete_all: bool = False):
+    @staticmethod
+    def _weigh_ins_to_delete(
+        daily_weigh_ins: Dict[str, Any], cdate: str, delete_all: bool
+    ) -> List[Dict[str, Any]]:
         """
-        Delete weigh-in for 'cdate' format 'YYYY-MM-DD'.
-        Includes option to delete all weigh-ins for that date.
+        Return the weigh-ins of a get_daily_weigh_ins response which
+        delete_weigh_ins deletes: none of several without 'delete_all'.
         """
 
-        daily_weigh_ins = self.get_daily_weigh_ins(cdate)
         weigh_ins = daily_weigh_ins.get("dateWeightList", [])
-        if not weigh_ins or len(weigh_ins) == 0:
+        if not weigh_ins:
             logger.warning(f"No weigh-ins found on {cdate}")
-            return
+            return []
         elif len(weigh_ins) > 1:
             logger.warning(f"Multiple weigh-ins found for {cdate}")
             if not delete_all:
                 logger.warning(
                     f"Set delete_all to True to delete all {len(weigh_ins)} weigh-ins"
                 )
-                return
+                return []
 
-        for w in weigh_ins:
-            self.delete_weigh_in(w["samplePk"], cdate)
+        return weigh_ins
 
-        return len(weigh_ins)
+    @staticmethod
+    def _weigh_in_samples(
+        weigh_ins: Optional[Dict[str, Any]],
+        predicate: Optional[Callable[[Dict[str, Any]], bool]],
+    ) -> List[Dict[str, Any]]:
+        """Return the samples of a get_weigh_ins response 'predicate' accepts."""
+
+        return [
+            sample
+            for summary in (weigh_ins or {}).get("dailyWeightSummaries") or []
+            for sample in summary.get("allWeightMetrics") or []
+            if predicate is None or predicate(sample)
+        ]
 
     def get_body_battery(
         self, startdate: str, enddate=None
@@ -546,7 +1284,7 @@ class Garmin:
 
         logger.debug("Adding blood pressure")
 
-        return self.garth.post("connectapi", url, json=payload)
+        return self.request("POST", url, json=payload)
 
     def get_blood_pressure(
         self, startdate: str, enddate=None
@@ -569,12 +1307,7 @@ class Garmin:
         url = f"{self.garmin_connect_set_blood_pressure_endpoint}/{cdate}/{version}"
         logger.debug("Deleting blood pressure measurement")
 
-        return self.garth.request(
-            "DELETE",
-            "connectapi",
-            url,
-            api=True,
-        )
+        return self.request("DELETE", url, api=True)
 
     def get_max_metrics(self, cdate: str) -> Dict[str, Any]:
         """Return available max metric data for 'cdate' format 'YYYY-MM-DD'."""
@@ -621,7 +1354,7 @@ class Garmin:
 
         logger.debug("Adding hydration data")
 
-        return self.garth.put("connectapi", url, json=payload)
+        return self.request("PUT", url, json=payload)
 
     def get_hydration_data(self, cdate: str) -> Dict[str, Any]:
         """Return available hydration data 'cdate' format 'YYYY-MM-DD'."""
@@ -674,6 +1407,99 @@ class Garmin:
 
         return self.connectapi(url)
 
+    def get_heart_rates_series(
+        self, startdate: str, enddate=None, workers: int = 8
+    ) -> "TimeSeries":
+        """
+        Return heart rate samples from 'startdate' format 'YYYY-MM-DD'
+        through enddate 'YYYY-MM-DD' as a TimeSeries. Requires numpy.
+        """
+
+        from .timeseries import TimeSeries
+
+        def decode(payload):
+            return TimeSeries.from_payload(
+                payload,
+                "heartRateValues",
+                "heartRateValueDescriptors",
+                "heartrate",
+            )
+
+        return self._series(
+            "get_heart_rates", startdate, enddate, workers, decode
+        )
+
+    def get_stress_series(
+        self, startdate: str, enddate=None, workers: int = 8
+    ) -> "TimeSeries":
+        """
+        Return stress level samples from 'startdate' format 'YYYY-MM-DD'
+        through enddate 'YYYY-MM-DD' as a TimeSeries, with the negative
+        (no measurement) levels as NaN. Requires numpy.
+        """
+
+        from .timeseries import TimeSeries
+
+        def decode(payload):
+            return TimeSeries.from_payload(
+                payload,
+                "stressValuesArray",
+                "stressValueDescriptorsDTOList",
+                "stressLevel",
+                drop_negative=True,
+            )
+
+        return self._series(
+            "get_all_day_stress", startdate, enddate, workers, decode
+        )
+
+    def get_respiration_series(
+        self, startdate: str, enddate=None, workers: int = 8
+    ) -> "TimeSeries":
+        """
+        Return respiration rate samples from 'startdate' format
+        'YYYY-MM-DD' through enddate 'YYYY-MM-DD' as a TimeSeries, with the
+        negative (no measurement) values as NaN. Requires numpy.
+        """
+
+        from .timeseries import TimeSeries
+
+        def decode(payload):
+            return TimeSeries.from_payload(
+                payload,
+                "respirationValuesArray",
+                "respirationValueDescriptorsDTOList",
+                "respiration",
+                drop_negative=True,
+            )
+
+        return self._series(
+            "get_respiration_data", startdate, enddate, workers, decode
+        )
+
+    def get_spo2_series(
+        self, startdate: str, enddate=None, workers: int = 8
+    ) -> "TimeSeries":
+        """
+        Return hourly average SpO2 values from 'startdate' format
+        'YYYY-MM-DD' through enddate 'YYYY-MM-DD' as a TimeSeries.
+        Requires numpy.
+        """
+
+        from .timeseries import TimeSeries
+
+        def decode(payload):
+            return TimeSeries.from_payload(
+                payload,
+                "spO2HourlyAverages",
+                "spO2ValueDescriptorsDTOList",
+                "spo2Reading",
+            )
+
+        return self._series(
+            "get_spo2_data", startdate, enddate, workers, decode
+        )
+
     def get_personal_record(self) -> Dict[str, Any]:
         """Return personal records for current user."""
 
@@ -894,6 +1720,7 @@ class Garmin:
 
             return self.connectapi(url, params=params)
 
+    @_memoize(ttl=60 * 60)
     def get_devices(self) -> List[Dict[str, Any]]:
         """Return available devices for the current user account."""
 
@@ -902,6 +1729,7 @@ class Garmin:
 
         return self.connectapi(url)
 
+    @_memoize(ttl=5 * 60)
     def get_device_settings(self, device_id: str) -> Dict[str, Any]:
         """Return device settings for device with 'device_id'."""
 
@@ -910,6 +1738,7 @@ class Garmin:
 
         return self.connectapi(url)
 
+    @_memoize(ttl=60 * 60)
     def get_primary_training_device(self) -> Dict[str, Any]:
         """Return detailed information around primary training devices, included the specified device and the
         priority of all devices.
@@ -920,31 +1749,13 @@ class Garmin:
 
         return self.connectapi(url)
 
-    def get_device_solar_data(
-        self, device_id: str, startdate: str, enddate=None
-    ) -> Dict[str, Any]:
-        """Return solar data for compatible device with 'device_id'"""
-        if enddate is None:
-            enddate = startdate
-            single_day = True
-        else:
-            single_day = False
-
-        params = {"singleDayView": single_day}
-
-        url = f"{self.garmin_connect_solar_url}/{device_id}/{startdate}/{enddate}"
-
-        return self.connectapi(url, params=params)["deviceSolarInput"]
-
-    def get_device_alarms(self) -> List[Any]:
-        """Get list of active alarms from all devices."""
-
-        logger.debug("Requesting device alarms")
+    @staticmethod
+    def _collect_alarms(settings: Dict[str, Dict[Any, Any]]) -> List[Any]:
+        if settings["errors"]:
+            raise next(iter(settings["errors"].values()))
 
         alarms = []
-        devices = self.get_devices()
-        for device in devices:
-            device_settings = self.get_device_settings(device["deviceId"])
+        for device_settings in settings["results"].values():
             device_alarms = device_settings["alarms"]
             if device_alarms is not None:
                 alarms += device_alarms
@@ -985,8 +1796,9 @@ class Garmin:
 
         url = f"{self.garmin_connect_activity}/{activity_id}"
         payload = {"activityId": activity_id, "activityName": title}
+        self._invalidate_cache(f"activity/{activity_id}")
 
-        return self.garth.put("connectapi", url, json=payload, api=True)
+        return self.request("PUT", url, json=payload, api=True)
 
     def set_activity_type(
         self, activity_id, type_id, type_key, parent_type_id
@@ -1001,12 +1813,13 @@ class Garmin:
             },
         }
         logger.debug(f"Changing activity type: {str(payload)}")
-        return self.garth.put("connectapi", url, json=payload, api=True)
+        self._invalidate_cache(f"activity/{activity_id}")
+        return self.request("PUT", url, json=payload, api=True)
 
     def create_manual_activity_from_json(self, payload):
         url = f"{self.garmin_connect_activity}"
         logger.debug(f"Uploading manual activity: {str(payload)}")
-        return self.garth.post("connectapi", url, json=payload, api=True)
+        return self.request("POST", url, json=payload, api=True)
 
     def create_manual_activity(
         self,
@@ -1043,14 +1856,44 @@ class Garmin:
         }
         return self.create_manual_activity_from_json(payload)
 
-    def get_last_activity(self):
-        """Return last activity."""
+    @staticmethod
+    def _read_sync_state(statefile: str) -> Optional[Dict[str, Any]]:
+        """Return the high-water mark stored in 'statefile', if any."""
 
-        activities = self.get_activities(0, 1)
-        if activities:
-            return activities[-1]
+        statefile = os.path.expanduser(statefile)
+        if not os.path.exists(statefile):
+            return None
+        with open(statefile) as f:
+            return json.load(f)
 
-        return None
+    @staticmethod
+    def _write_sync_state(statefile: str, activity: Dict[str, Any]):
+        """Atomically store 'activity' as the high-water mark."""
+
+        statefile = os.path.expanduser(statefile)
+        state = {
+            "activityId": activity["activityId"],
+            "startTimeGMT": activity["startTimeGMT"],
+        }
+        directory = os.path.dirname(statefile)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{statefile}.tmp", "w") as f:
+            json.dump(state, f, indent=4)
+        os.replace(f"{statefile}.tmp", statefile)
+
+    @staticmethod
+    def _is_synced(
+        activity: Dict[str, Any], state: Optional[Dict[str, Any]]
+    ) -> bool:
+        """Return whether 'activity' is at or below the high-water mark."""
+
+        if state is None:
+            return False
+        return (
+            activity["activityId"] == state["activityId"]
+            or activity["startTimeGMT"] < state["startTimeGMT"]
+        )
 
     def upload_activity(self, activity_path: str):
         """Upload activity in fit format from file."""
@@ -1067,7 +1910,7 @@ class Garmin:
                 "file": (file_base_name, open(activity_path, "rb" or "r")),
             }
             url = self.garmin_connect_upload
-            return self.garth.post("connectapi", url, files=files, api=True)
+            return self.request("POST", url, files=files, api=True)
         else:
             raise GarminConnectInvalidFileFormatError(
                 f"Could not upload {activity_path}"
@@ -1078,16 +1921,17 @@ class Garmin:
 
         url = f"{self.garmin_connect_delete_activity_url}/{activity_id}"
         logger.debug("Deleting activity with id %s", activity_id)
+        self._invalidate_cache(f"activity/{activity_id}")
 
-        return self.garth.request(
-            "DELETE",
-            "connectapi",
-            url,
-            api=True,
-        )
+        return self.request("DELETE", url, api=True)
 
     def get_activities_by_date(
-        self, startdate, enddate=None, activitytype=None, sortorder=None
+        self,
+        startdate,
+        enddate=None,
+        activitytype=None,
+        sortorder=None,
+        workers: int = 4,
     ):
         """
         Fetch available activities between specific dates
@@ -1098,21 +1942,12 @@ class Garmin:
                              multi_sport, fitness_equipment, hiking, walking, other]
         :param sortorder: (Optional) sorting direction. By default, Garmin uses descending order by startLocal field.
                           Use "asc" to get activities from oldest to newest.
+        :param workers: (Optional) Number of pages to request concurrently
         :return: list of JSON activities
         """
 
-        activities = []
-        start = 0
-        limit = 20
-        # mimicking the behavior of the web interface that fetches
-        # 20 activities at a time
-        # and automatically loads more on scroll
         url = self.garmin_connect_activities
-        params = {
-            "startDate": str(startdate),
-            "start": str(start),
-            "limit": str(limit),
-        }
+        params = {"startDate": str(startdate)}
         if enddate:
             params["endDate"] = str(enddate)
         if activitytype:
@@ -1123,17 +1958,37 @@ class Garmin:
         logger.debug(
             f"Requesting activities by date from {startdate} to {enddate}"
         )
-        while True:
-            params["start"] = str(start)
-            logger.debug(f"Requesting activities {start} to {start+limit}")
-            act = self.connectapi(url, params=params)
-            if act:
-                activities.extend(act)
-                start = start + limit
-            else:
-                break
 
-        return activities
+        return self._paginate(url, params, workers=workers)
+
+    def iter_activities(
+        self,
+        startdate=None,
+        enddate=None,
+        activitytype=None,
+        sortorder=None,
+        limit: Optional[int] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate over available activities, optionally between specific
+        dates, fetching one page of 'limit' activities at a time.
+        Takes the same filters as get_activities_by_date.
+        """
+
+        url = self.garmin_connect_activities
+        params = {}
+        if startdate:
+            params["startDate"] = str(startdate)
+        if enddate:
+            params["endDate"] = str(enddate)
+        if activitytype:
+            params["activityType"] = str(activitytype)
+        if sortorder:
+            params["sortOrder"] = str(sortorder)
+
+        logger.debug(f"Iterating activities from {startdate} to {enddate}")
+
+        return self._iter_pages(url, params, limit=limit)
 
     def get_progress_summary_between_dates(
         self, startdate, enddate, metric="distance", groupbyactivities=True
@@ -1162,47 +2017,51 @@ class Garmin:
         )
         return self.connectapi(url, params=params)
 
+    @_memoize(ttl=24 * 60 * 60)
     def get_activity_types(self):
         url = self.garmin_connect_activity_types
         logger.debug("Requesting activity types")
         return self.connectapi(url)
 
-    def get_goals(self, status="active", start=1, limit=30):
+    def get_goals(self, status="active", start=1, limit=None, workers=4):
         """
         Fetch all goals based on status
         :param status: Status of goals (valid options are "active", "future", or "past")
         :type status: str
         :param start: Initial goal index
         :type start: int
-        :param limit: Pagination limit when retrieving goals
+        :param limit: Pagination limit when retrieving goals, by default the
+                      largest page size the server accepts
         :type limit: int
+        :param workers: Number of pages to request concurrently
+        :type workers: int
         :return: list of goals in JSON format
         """
 
-        goals = []
         url = self.garmin_connect_goals_url
-        params = {
-            "status": status,
-            "start": str(start),
-            "limit": str(limit),
-            "sortOrder": "asc",
-        }
+        params = {"status": status, "sortOrder": "asc"}
 
         logger.debug(f"Requesting {status} goals")
-        while True:
-            params["start"] = str(start)
-            logger.debug(
-                f"Requesting {status} goals {start} to {start + limit - 1}"
-            )
-            goals_json = self.connectapi(url, params=params)
-            if goals_json:
-                goals.extend(goals_json)
-                start = start + limit
-            else:
-                break
 
-        return goals
+        return self._paginate(
+            url, params, start=start, limit=limit, workers=workers
+        )
+
+    def iter_goals(
+        self, status="active", start=1, limit: Optional[int] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate over goals based on status ("active", "future", or "past"),
+        fetching one page of 'limit' goals at a time.
+        """
 
+        url = self.garmin_connect_goals_url
+        params = {"status": status, "sortOrder": "asc"}
+        logger.debug(f"Iterating {status} goals")
+
+        return self._iter_pages(url, params, start=start, limit=limit)
+
+    @_memoize(ttl=60 * 60)
     def get_gear(self, userProfileNumber):
         """Return all user gear."""
         url = f"{self.garmin_connect_gear}?userProfilePk={userProfileNumber}"
@@ -1215,6 +2074,7 @@ class Garmin:
         logger.debug("Requesting gear stats for gearUUID %s", gearUUID)
         return self.connectapi(url)
 
+    @_memoize(ttl=60 * 60)
     def get_gear_defaults(self, userProfileNumber):
         url = (
             f"{self.garmin_connect_gear_baseurl}user/"
@@ -1230,7 +2090,8 @@ class Garmin:
             f"{self.garmin_connect_gear_baseurl}{gearUUID}/"
             f"activityType/{activityType}{defaultGearString}"
         )
-        return self.garth.request(method_override, "connectapi", url, api=True)
+        self.clear_metadata_cache("get_gear", "get_gear_defaults")
+        return self.request(method_override, url, api=True)
 
     class ActivityDownloadFormat(Enum):
         """Activity variables."""
@@ -1246,14 +2107,20 @@ class Garmin:
         GPX = auto()
         TCX = auto()
 
-    def download_activity(
+    # File extension of the downloads in each ActivityDownloadFormat.
+    activity_download_extensions = {
+        ActivityDownloadFormat.ORIGINAL: "zip",
+        ActivityDownloadFormat.TCX: "tcx",
+        ActivityDownloadFormat.GPX: "gpx",
+        ActivityDownloadFormat.KML: "kml",
+        ActivityDownloadFormat.CSV: "csv",
+    }
+
+    def _activity_download_url(
         self, activity_id, dl_fmt=ActivityDownloadFormat.TCX
-    ):
-        """
-        Downloads activity in requested format and returns the raw bytes. For
-        "Original" will return the zip file content, up to user to extract it.
-        "CSV" will return a csv of the splits.
-        """
+    ) -> str:
+        """Return the download url of an activity in format 'dl_fmt'."""
+
         activity_id = str(activity_id)
         urls = {
             Garmin.ActivityDownloadFormat.ORIGINAL: f"{self.garmin_connect_fit_download}/{activity_id}",  # noqa
@@ -1264,12 +2131,46 @@ class Garmin:
         }
         if dl_fmt not in urls:
             raise ValueError(f"Unexpected value {dl_fmt} for dl_fmt")
-        url = urls[dl_fmt]
+
+        return urls[dl_fmt]
+
+    def download_activity(
+        self, activity_id, dl_fmt=ActivityDownloadFormat.TCX
+    ):
+        """
+        Downloads activity in requested format and returns the raw bytes. For
+        "Original" will return the zip file content, up to user to extract it.
+        "CSV" will return a csv of the splits.
+        """
+        url = self._activity_download_url(activity_id, dl_fmt)
 
         logger.debug("Downloading activities from %s", url)
 
         return self.download(url)
 
+    def _archive_jobs(
+        self, directory: str, activity_ids: Iterable, formats: Iterable
+    ) -> Tuple[_ArchiveManifest, List[Tuple[Any, Any, str]], int]:
+        """
+        Return the manifest of 'directory', the (activity id, format,
+        filename) downloads still missing and the number already done.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        manifest = _ArchiveManifest(os.path.join(directory, "manifest.jsonl"))
+        jobs = []
+        skipped = 0
+        for activity_id in activity_ids:
+            for dl_fmt in formats:
+                extension = self.activity_download_extensions[dl_fmt]
+                filename = f"{activity_id}.{extension}"
+                if manifest.is_done(filename, directory):
+                    skipped += 1
+                else:
+                    jobs.append((activity_id, dl_fmt, filename))
+
+        return manifest, jobs, skipped
+
     def get_activity_splits(self, activity_id):
         """Return activity splits."""
 
@@ -1377,6 +2278,21 @@ class Garmin:
 
         return self.connectapi(url)
 
+    def iter_gear_activities(
+        self, gearUUID, limit: Optional[int] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Iterate over activities where gear uuid was used, fetching one page
+        of 'limit' activities at a time.
+        """
+
+        gearUUID = str(gearUUID)
+        url = f"{self.garmin_connect_activities_baseurl}{gearUUID}/gear"
+        logger.debug("Iterating activities for gearUUID %s", gearUUID)
+
+        return self._iter_pages(url, {}, limit=limit)
+
+    @_memoize(ttl=60 * 60)
     def get_user_profile(self):
         """Get all users settings."""
 
@@ -1385,6 +2301,7 @@ class Garmin:
 
         return self.connectapi(url)
 
+    @_memoize(ttl=60 * 60)
     def get_userprofile_settings(self):
         """Get user settings."""
 
@@ -1401,8 +2318,9 @@ class Garmin:
 
         url = f"{self.garmin_request_reload_url}/{cdate}"
         logger.debug(f"Requesting reload of data for {cdate}.")
+        self._invalidate_cache(str(cdate))
 
-        return self.garth.post("connectapi", url, api=True)
+        return self.request("POST", url, api=True)
 
     def get_workouts(self, start=0, end=100):
         """Return workouts from start till end."""
@@ -1432,7 +2350,7 @@ class Garmin:
     #     url = f"{self.garmin_workouts}/workout"
     #     logger.debug("Uploading workout using %s", url)
 
-    #     return self.garth.post("connectapi", url, json=workout_json, api=True)
+    #     return self.request("POST", url, json=workout_json, api=True)
     def get_menstrual_data_for_date(self, fordate: str):
         """Return menstrual data for date."""
 
@@ -1459,6 +2377,753 @@ class Garmin:
 
         return self.connectapi(url)
 
+    @staticmethod
+    def _graphql_batch(
+        metrics: Iterable[str], startdate: str, enddate: str, max_fields: int
+    ) -> Tuple[GraphQLBatch, List[Dict[str, str]]]:
+        """
+        Return the GraphQLBatch of query_garmin_graphql_metrics and its
+        documents to send.
+        """
+
+        batch = GraphQLBatch(
+            metrics, _date_range(startdate, enddate), max_fields
+        )
+        documents = batch.documents
+        logger.debug(
+            f"Requesting {len(batch.fields)} GraphQL fields "
+            f"in {len(documents)} queries"
+        )
+        return batch, documents
+
+    def logout(self):
+        """Log user out of session."""
+
+        logger.error(
+            "Deprecated: Alternative is to delete login tokens to logout."
+        )
+
+
+class Garmin(_GarminBase):
+    """
+    Class for fetching data from Garmin Connect.
+
+    Most endpoints are defined on _GarminBase and shared with AsyncGarmin,
+    this class sends their requests and runs the methods combining several
+    requests as blocking calls.
+    """
+
+    @staticmethod
+    def shared_session(pool_size: int = 100) -> requests.Session:
+        """
+        Return a Session with a pool of 'pool_size' connections and the
+        retry policy of Garmin, to pass as 'session' to many instances.
+        """
+
+        session = _PooledSession(pool_size)
+        retry = Retry(
+            total=garth.Client.retries,
+            status_forcelist=STATUS_FORCELIST,
+            backoff_factor=garth.Client.backoff_factor,
+        )
+        session.mount(
+            "https://",
+            HTTPAdapter(
+                max_retries=retry,
+                pool_connections=pool_size,
+                pool_maxsize=pool_size,
+            ),
+        )
+        return session
+
+    def _connectapi(self, path, method="GET", **kwargs):
+        response = self.request(method, path, api=True, **kwargs)
+        if response.status_code == 204:
+            return None
+        return response.json()
+
+    def _download(self, path, **kwargs):
+        return self.request("GET", path, api=True, **kwargs).content
+
+    def _cached(self, kind: str, fetch: Callable, path, kwargs):
+        """Return the cached response for 'path' or 'fetch' it."""
+
+        cache = self.cache
+        entry = None
+        if cache is not None:
+            entry = cache.key_for(kind, path, kwargs, self.display_name)
+        if cache is None or entry is None:
+            return fetch(path, **kwargs)
+
+        key, ttl = entry
+        hit, response = cache.get(key)
+        if not hit:
+            response = fetch(path, **kwargs)
+            cache.set(key, response, ttl)
+        return response
+
+    def connectapi(self, path, **kwargs):
+        # Concurrent identical reads share one request, see _SingleFlight.
+        return self._flights.do(
+            _flight_key("json", path, kwargs),
+            self._cached,
+            "json",
+            self._connectapi,
+            path,
+            kwargs,
+        )
+
+    def download(self, path, **kwargs):
+        return self._flights.do(
+            _flight_key("raw", path, kwargs),
+            self._cached,
+            "raw",
+            self._download,
+            path,
+            kwargs,
+        )
+
+    def request(self, method: str, path: str, /, **kwargs):
+        """
+        Send a raw 'method' request for 'path' on the connectapi domain (or
+        'base_url') and return the response. Pass 'api=True' to
+        authenticate the request. Waits for the rate limiter, if any, and
+        retries requests answered with 429 Too Many Requests up to
+        'max_retries' times.
+        """
+
+        url = self._api_url(path)
+        for attempt in itertools.count():
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                return self._attempt(method, path, url, attempt, kwargs)
+            except GarthHTTPError as e:
+                delay = self._retry_delay(e, attempt, path)
+            if self.rate_limiter is None:
+                time.sleep(delay)
+            _rewind_files(kwargs)
+
+    def _attempt(
+        self,
+        method: str,
+        path: str,
+        url: str,
+        attempt: int,
+        kwargs: Dict[str, Any],
+    ):
+        """Send one attempt of a request, calling the hooks around it."""
+
+        # Garth writes the Authorization header into the headers it is
+        # given, by default a dict shared by all its clients.
+        kwargs = {**kwargs, "headers": {**(kwargs.get("headers") or {})}}
+        if not self.hooks:
+            return self.garth.request(method, "connectapi", url, **kwargs)
+
+        request = self._before_request(method, path, attempt, kwargs)
+        try:
+            response = self.garth.request(method, "connectapi", url, **kwargs)
+        except Exception as e:
+            self._on_error(request, e, _status_code(e))
+            raise
+
+        # Retries of urllib3 after a status of STATUS_FORCELIST.
+        retries = getattr(
+            getattr(response.raw, "retries", None), "history", ()
+        )
+        self._after_response(
+            request,
+            response,
+            _response_size(response, kwargs),
+            len(retries or ()),
+        )
+        return response
+
+    def _refresh_expired_token(self):
+        """
+        Refresh an expired OAuth2 token once before going concurrent,
+        instead of letting every worker thread race to do it.
+        """
+
+        oauth2_token = self.garth.oauth2_token
+        if oauth2_token is not None and oauth2_token.expired:
+            self.garth.refresh_oauth2()
+
+    def _paginate(
+        self,
+        url: str,
+        params: Dict[str, str],
+        start: int = 0,
+        limit: Optional[int] = None,
+        workers: int = 4,
+    ) -> List[Any]:
+        """
+        Return all items of the paginated endpoint 'url' from offset 'start'.
+        Pages hold 'limit' items, or when None the largest number the server
+        accepts for this endpoint, which is learned on the first call.
+        After a full page, up to 'workers' following pages are requested
+        concurrently; paging stops at the first short page.
+        """
+
+        def fetch(request: Tuple[int, int]) -> List[Any]:
+            page_params = _page_params(url, params, *request)
+            return self.connectapi(url, params=page_params) or []
+
+        workers = max(1, min(workers, self.garth.pool_maxsize))
+        plan = self._page_requests(url, start, limit, workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            requests = next(plan)
+            while True:
+                if len(requests) > 1:
+                    self._refresh_expired_token()
+                try:
+                    pages = list(executor.map(fetch, requests))
+                except GarthHTTPError as e:
+                    # The plan retries smaller pages, or raises it again.
+                    requests = plan.throw(e)
+                    continue
+                try:
+                    requests = plan.send(pages)
+                except StopIteration as done:
+                    return done.value
+
+    def _iter_pages(
+        self,
+        url: str,
+        params: Dict[str, str],
+        start: int = 0,
+        limit: Optional[int] = None,
+    ) -> Iterator[Any]:
+        """
+        Yield the items of the paginated endpoint 'url' from offset 'start',
+        requesting the next page of 'limit' items only once the previous
+        one is consumed.
+        """
+
+        plan = self._iter_page_requests(url, start, limit)
+        request = next(plan)
+        while True:
+            page_params = _page_params(url, params, *request)
+            page = self.connectapi(url, params=page_params) or []
+            yield from page
+            try:
+                request = plan.send(page)
+            except StopIteration:
+                return
+
+    def _fan_out(
+        self, func: Callable, items: Iterable, workers: int = 8
+    ) -> Tuple[Dict[Any, Any], Dict[Any, Exception]]:
+        """
+        Call 'func' for every item on a bounded thread pool.
+        Returns two dicts keyed by item, in input order: the results of the
+        calls that succeeded and the exceptions of the calls that failed.
+        """
+
+        items = list(items)
+        workers = max(1, min(workers, self.garth.pool_maxsize, len(items)))
+        self._refresh_expired_token()
+
+        results: Dict[Any, Any] = {}
+        errors: Dict[Any, Exception] = {}
+        if not items:
+            return results, errors
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(item, executor.submit(func, item)) for item in items]
+            for item, future in futures:
+                try:
+                    results[item] = future.result()
+                except Exception as e:
+                    logger.debug("Request for %s failed: %s", item, e)
+                    errors[item] = e
+
+        return results, errors
+
+    def fetch_range(
+        self,
+        metric: Union[str, Callable],
+        start: str,
+        end: str,
+        workers: int = 8,
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Run a per-day getter for every day from 'start' to 'end' format
+        'YYYY-MM-DD' (inclusive), using up to 'workers' concurrent requests.
+        'metric' is the name of a getter taking a 'cdate', with or without
+        its 'get_' prefix (e.g. "heart_rates" or "get_sleep_data"), or any
+        callable taking a 'cdate'.
+        Returns {"results": {cdate: data}, "errors": {cdate: exception}},
+        both in date order; a failing day does not affect the other days.
+        """
+
+        getter = self._day_getter(metric)
+        dates = _date_range(start, end)
+        logger.debug(
+            f"Requesting {metric} for {len(dates)} days from {start} to {end}"
+        )
+        results, errors = self._fan_out(getter, dates, workers=workers)
+
+        return {"results": results, "errors": errors}
+
+    def login(
+        self,
+        /,
+        tokenstore: Optional[str] = None,
+        profile_max_age: Optional[float] = None,
+    ):
+        """
+        Log in using Garth.
+        With 'profile_max_age' seconds and a token store directory, the
+        display name, full name and unit system are kept in its
+        profile.json and restored from there without any request, until
+        they are older than that or the stored tokens were refreshed.
+        """
+        tokenstore = tokenstore or os.getenv("GARMINTOKENS")
+
+        self._load_tokens(tokenstore)
+        self.clear_metadata_cache()
+
+        profile_path = None
+        if profile_max_age is not None:
+            profile_path = self._profile_path(tokenstore)
+            if profile_path and self._restore_profile(
+                profile_path, profile_max_age
+            ):
+                return True
+
+        # Garth keeps the profile, saving a request on later logins.
+        profile = self.garth._user_profile
+        if not profile:
+            profile = self.connectapi(self.garmin_connect_social_profile_url)
+            self.garth._user_profile = profile
+        self.display_name = profile["displayName"]
+        self.full_name = profile["fullName"]
+
+        settings = self.connectapi(self.garmin_connect_user_settings_url)
+        self.unit_system = settings["userData"]["measurementSystem"]
+
+        if profile_path:
+            self._save_profile(profile_path)
+        return True
+
+    def get_user_summary(self, cdate: str) -> Dict[str, Any]:
+        """Return user activity summary for 'cdate' format 'YYYY-MM-DD'."""
+
+        url = f"{self.garmin_connect_daily_summary_url}/{self.display_name}"
+        params = {"calendarDate": str(cdate)}
+        logger.debug("Requesting user summary")
+
+        response = self.connectapi(url, params=params)
+
+        if response["privacyProtected"] is True:
+            raise GarminConnectAuthenticationError("Authentication error")
+
+        return response
+
+    def get_stats_and_body(self, cdate):
+        """Return activity data and body composition (compat for garminconnect)."""
+
+        return {
+            **self.get_stats(cdate),
+            **self.get_body_composition(cdate)["totalAverage"],
+        }
+
+    def add_body_composition(
+        self,
+        timestamp: Optional[str],
+        weight: float,
+        percent_fat: Optional[float] = None,
+        percent_hydration: Optional[float] = None,
+        visceral_fat_mass: Optional[float] = None,
+        bone_mass: Optional[float] = None,
+        muscle_mass: Optional[float] = None,
+        basal_met: Optional[float] = None,
+        active_met: Optional[float] = None,
+        physique_rating: Optional[float] = None,
+        metabolic_age: Optional[float] = None,
+        visceral_fat_rating: Optional[float] = None,
+        bmi: Optional[float] = None,
+    ):
+        return self.add_body_compositions(
+            [
+                {
+                    "timestamp": timestamp,
+                    "weight": weight,
+                    "percent_fat": percent_fat,
+                    "percent_hydration": percent_hydration,
+                    "visceral_fat_mass": visceral_fat_mass,
+                    "bone_mass": bone_mass,
+                    "muscle_mass": muscle_mass,
+                    "basal_met": basal_met,
+                    "active_met": active_met,
+                    "physique_rating": physique_rating,
+                    "metabolic_age": metabolic_age,
+                    "visceral_fat_rating": visceral_fat_rating,
+                    "bmi": bmi,
+                }
+            ]
+        )[0]
+
+    def add_body_compositions(
+        self, records: Iterable[Any], max_size: int = FIT_MAX_SIZE
+    ) -> List[Any]:
+        """
+        Upload many body composition 'records' in as few FIT files as
+        possible, each at most 'max_size' bytes. Records are dicts or
+        dataclasses with a 'timestamp' (datetime or ISO 8601 string) and
+        the keyword arguments of add_body_composition. Returns the upload
+        response of every file.
+        """
+
+        responses = []
+        for number, content in enumerate(
+            self._body_composition_files(records, max_size)
+        ):
+            logger.debug(f"Uploading body composition file {number}")
+            files = {"file": ("body_composition.fit", content)}
+            responses.append(
+                self.request(
+                    "POST", self.garmin_connect_upload, files=files, api=True
+                )
+            )
+        return responses
+
+    def import_weigh_ins(
+        self, records: Iterable[Any], workers: int = 4
+    ) -> Dict[str, Any]:
+        """
+        Add many weigh-ins, skipping those already stored. Records are
+        dicts or dataclasses with the arguments of
+        add_weigh_in_with_timestamps ('weight', 'unitKey', 'dateTimestamp'
+        and optionally 'gmtTimestamp'). The stored weigh-ins are fetched
+        once, records matching one on timestamp and weight are skipped and
+        the others posted with up to 'workers' concurrent requests.
+        Returns {"created": count, "skipped": count, "failed": {index:
+        exception}} with the indexes of the records that failed.
+        """
+
+        records, window = self._plan_weigh_ins(records)
+        existing = self.get_weigh_ins(*window) if window else None
+        new = self._new_weigh_ins(records, existing)
+        results, errors = self._fan_out(
+            lambda index: self.add_weigh_in_with_timestamps(**records[index]),
+            new,
+            workers=workers,
+        )
+
+        return {
+            "created": len(results),
+            "skipped": len(records) - len(new),
+            "failed": errors,
+        }
+
+    def delete_weigh_ins(self, cdate: str, delete_all: bool = False):
+        """
+        Delete weigh-in for 'cdate' format 'YYYY-MM-DD'.
+        Includes option to delete all weigh-ins for that date.
+        """
+
+        weigh_ins = self._weigh_ins_to_delete(
+            self.get_daily_weigh_ins(cdate), cdate, delete_all
+        )
+        if not weigh_ins:
+            return
+
+        for w in weigh_ins:
+            self.delete_weigh_in(w["samplePk"], cdate)
+
+        return len(weigh_ins)
+
+    def delete_weigh_ins_range(
+        self,
+        startdate: str,
+        enddate: str,
+        predicate: Optional[Callable[[Dict[str, Any]], bool]] = None,
+        dry_run: bool = False,
+        workers: int = 4,
+    ) -> Dict[str, Any]:
+        """
+        Delete the weigh-ins from 'startdate' to 'enddate' format
+        'YYYY-MM-DD' for which 'predicate' (if given) returns True, e.g.
+        lambda sample: sample["sourceType"] == "INDEX_SCALE". Samples are
+        listed with one request and deleted with up to 'workers' concurrent
+        requests, or only reported with 'dry_run'.
+        Returns {"matched": [sample], "deleted": count, "failed":
+        {samplePk: exception}}.
+        """
+
+        samples = self._weigh_in_samples(
+            self.get_weigh_ins(startdate, enddate), predicate
+        )
+        if dry_run:
+            return {"matched": samples, "deleted": 0, "failed": {}}
+
+        logger.debug(f"Deleting {len(samples)} weigh-ins")
+        dates = {
+            sample["samplePk"]: sample["calendarDate"] for sample in samples
+        }
+        results, errors = self._fan_out(
+            lambda pk: self.delete_weigh_in(pk, dates[pk]), dates, workers
+        )
+
+        return {"matched": samples, "deleted": len(results), "failed": errors}
+
+    def _series(
+        self,
+        metric: str,
+        startdate: str,
+        enddate: Optional[str],
+        workers: int,
+        decode: Callable[[Dict[str, Any]], "TimeSeries"],
+    ) -> "TimeSeries":
+        """
+        Decode the per-day getter 'metric' for 'startdate' through
+        'enddate' into one TimeSeries. Raises the first error of any day.
+        """
+
+        from .timeseries import TimeSeries
+
+        if enddate is None:
+            return decode(getattr(self, metric)(startdate))
+
+        fetched = self.fetch_range(metric, startdate, enddate, workers)
+        if fetched["errors"]:
+            raise next(iter(fetched["errors"].values()))
+        return TimeSeries.concat(map(decode, fetched["results"].values()))
+
+    def get_body_battery_series(
+        self, startdate: str, enddate=None
+    ) -> "TimeSeries":
+        """
+        Return body battery levels from 'startdate' format 'YYYY-MM-DD'
+        through enddate 'YYYY-MM-DD' as a TimeSeries. Requires numpy.
+        """
+
+        from .timeseries import TimeSeries
+
+        return TimeSeries.concat(
+            TimeSeries.from_payload(
+                day,
+                "bodyBatteryValuesArray",
+                "bodyBatteryValueDescriptorDTOList",
+                "bodyBatteryLevel",
+            )
+            for day in self.get_body_battery(startdate, enddate) or []
+        )
+
+    def get_device_solar_data(
+        self, device_id: str, startdate: str, enddate=None
+    ) -> Dict[str, Any]:
+        """Return solar data for compatible device with 'device_id'"""
+        if enddate is None:
+            enddate = startdate
+            single_day = True
+        else:
+            single_day = False
+
+        params = {"singleDayView": single_day}
+
+        url = f"{self.garmin_connect_solar_url}/{device_id}/{startdate}/{enddate}"
+
+        return self.connectapi(url, params=params)["deviceSolarInput"]
+
+    def get_all_device_settings(
+        self, workers: int = 8
+    ) -> Dict[str, Dict[Any, Any]]:
+        """
+        Return the settings of all devices, requested concurrently.
+        Returns {"results": {device_id: settings}, "errors": {device_id:
+        exception}}; a failing device does not affect the other devices.
+        """
+
+        device_ids = [device["deviceId"] for device in self.get_devices()]
+        logger.debug(f"Requesting settings of {len(device_ids)} devices")
+        results, errors = self._fan_out(
+            self.get_device_settings, device_ids, workers=workers
+        )
+
+        return {"results": results, "errors": errors}
+
+    def get_all_device_solar_data(
+        self, startdate: str, enddate=None, workers: int = 8
+    ) -> Dict[str, Dict[Any, Any]]:
+        """
+        Return solar data from 'startdate' format 'YYYY-MM-DD' through
+        enddate 'YYYY-MM-DD' of all devices, requested concurrently.
+        Returns {"results": {device_id: data}, "errors": {device_id:
+        exception}}; devices without solar charging end up in "errors".
+        """
+
+        device_ids = [device["deviceId"] for device in self.get_devices()]
+        logger.debug(f"Requesting solar data of {len(device_ids)} devices")
+        results, errors = self._fan_out(
+            lambda device_id: self.get_device_solar_data(
+                device_id, startdate, enddate
+            ),
+            device_ids,
+            workers=workers,
+        )
+
+        return {"results": results, "errors": errors}
+
+    def get_device_alarms(self) -> List[Any]:
+        """Get list of active alarms from all devices."""
+
+        logger.debug("Requesting device alarms")
+
+        return self._collect_alarms(self.get_all_device_settings())
+
+    def get_last_activity(self):
+        """Return last activity."""
+
+        activities = self.get_activities(0, 1)
+        if activities:
+            return activities[-1]
+
+        return None
+
+    def sync_activities(self, statefile: str, limit: int = 20):
+        """
+        Return the activities started since the previous call, newest first.
+        The most recent activity seen is stored as a high-water mark in
+        'statefile'; pages of 'limit' activities are requested only until an
+        activity at or below that mark shows up. Without a state file all
+        activities are returned.
+        Activities uploaded later with an older start time than the mark are
+        not picked up, use get_activities_by_date to backfill those.
+        """
+
+        state = self._read_sync_state(statefile)
+        logger.debug(f"Syncing activities newer than {state}")
+
+        activities = []
+        start = 0
+        while True:
+            page = self.get_activities(start, limit) or []
+            new = list(
+                itertools.takewhile(
+                    lambda activity: not self._is_synced(activity, state),
+                    page,
+                )
+            )
+            activities.extend(new)
+            # Either the mark was reached or this was the last page.
+            if len(new) < limit:
+                break
+            start = start + limit
+
+        if activities:
+            self._write_sync_state(statefile, activities[0])
+
+        return activities
+
+    def download_activity_to(
+        self,
+        dest,
+        activity_id,
+        dl_fmt=_GarminBase.ActivityDownloadFormat.TCX,
+        chunk_size: int = 64 * 1024,
+    ) -> Dict[str, Any]:
+        """
+        Downloads activity in requested format (see download_activity) and
+        streams it in chunks to 'dest', either a file path or a writable
+        binary file object, so the file never has to fit in memory.
+        A path is written atomically: the file only appears once complete.
+        Returns {"path": path or None, "size": bytes, "sha256": hex digest}.
+        """
+        url = self._activity_download_url(activity_id, dl_fmt)
+
+        logger.debug("Streaming activity from %s", url)
+
+        response = self.request("GET", url, api=True, stream=True)
+        try:
+            with _DownloadWriter(dest) as writer:
+                for chunk in response.iter_content(chunk_size):
+                    writer.write(chunk)
+        finally:
+            response.close()
+
+        return writer.result()
+
+    def archive_activities(
+        self,
+        directory: str,
+        activity_ids: Optional[Iterable] = None,
+        formats: Iterable = (_GarminBase.ActivityDownloadFormat.ORIGINAL,),
+        workers: int = 4,
+        progress: Optional[Callable[[int, int, Dict[str, Any]], Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Download activities into 'directory' as '<activity id>.<extension>'
+        files, one per ActivityDownloadFormat in 'formats', with up to
+        'workers' concurrent downloads.
+        Without 'activity_ids' all activities of the account are archived.
+        Completed files are recorded with their size and SHA-256 in
+        'manifest.jsonl', so an interrupted run can simply be restarted.
+        'progress' is called as progress(done, total, entry) after every
+        file, with an "error" key in 'entry' when the download failed.
+        Returns {"downloaded": count, "skipped": count, "failed": {filename:
+        exception}}.
+        """
+
+        directory = os.path.expanduser(directory)
+        formats = list(formats)
+        if activity_ids is None:
+            activity_ids = (a["activityId"] for a in self.iter_activities())
+        manifest, jobs, skipped = self._archive_jobs(
+            directory, activity_ids, formats
+        )
+        logger.debug(
+            f"Archiving {len(jobs)} files to {directory}, {skipped} done"
+        )
+
+        done = itertools.count(1)
+        lock = threading.Lock()
+
+        def download(job):
+            activity_id, dl_fmt, filename = job
+            entry = {
+                "file": filename,
+                "activityId": activity_id,
+                "format": dl_fmt.name,
+            }
+            try:
+                result = self.download_activity_to(
+                    os.path.join(directory, filename), activity_id, dl_fmt
+                )
+                entry.update(size=result["size"], sha256=result["sha256"])
+                manifest.add(entry)
+            except Exception as e:
+                entry["error"] = e
+                raise
+            finally:
+                if progress is not None:
+                    with lock:
+                        progress(next(done), len(jobs), entry)
+
+        results, errors = self._fan_out(download, jobs, workers=workers)
+
+        return {
+            "downloaded": len(results),
+            "skipped": skipped,
+            "failed": {job[2]: error for job, error in errors.items()},
+        }
+
+    def get_activity_details_arrays(
+        self, activity_id, maxchart=2000, maxpoly=4000
+    ) -> "ActivityDetails":
+        """
+        Return activity details as an ActivityDetails object holding one
+        NumPy array per metric. Requires numpy.
+        """
+
+        from .details import ActivityDetails
+
+        return ActivityDetails.from_payload(
+            self.get_activity_details(activity_id, maxchart, maxpoly)
+        )
+
     def query_garmin_graphql(self, query: dict):
         """Returns the results of a POST request to the Garmin GraphQL Endpoints.
         Requires a GraphQL structured query.  See {TBD} for examples.
@@ -1466,17 +3131,64 @@ class Garmin:
 
         logger.debug(f"Querying Garmin GraphQL Endpoint with query: {query}")
 
-        return self.garth.post(
-            "connectapi", self.garmin_graphql_endpoint, json=query
+        return self.request(
+            "POST", self.garmin_graphql_endpoint, json=query, api=True
         ).json()
 
-    def logout(self):
-        """Log user out of session."""
+    def query_garmin_graphql_metrics(
+        self,
+        metrics: Iterable[str],
+        startdate: str,
+        enddate: str,
+        max_fields: int = MAX_FIELDS,
+        workers: int = 4,
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Return 'metrics' (e.g. ["sleep_data", "hrv_data"], see
+        graphql.METRICS) for every day from 'startdate' to 'enddate' format
+        'YYYY-MM-DD', batched into a few GraphQL requests of at most
+        'max_fields' aliased fields each.
+        Returns {"results": {metric: {cdate: data}}, "errors": {metric:
+        {cdate: error}}}.
+        """
 
-        logger.error(
-            "Deprecated: Alternative is to delete login tokens to logout."
+        batch, documents = self._graphql_batch(
+            metrics, startdate, enddate, max_fields
+        )
+        results, errors = self._fan_out(
+            lambda i: self.query_garmin_graphql(documents[i]),
+            range(len(documents)),
+            workers=workers,
         )
 
+        return batch.split(_outcomes(range(len(documents)), results, errors))
+
+
+def __getattr__(name):
+    # These classes depend on optional packages (httpx, numpy) or on Garmin
+    # itself, so only import them when they are asked for.
+    if name == "AccountPool":
+        from .pool import AccountPool
+
+        return AccountPool
+    if name == "AsyncGarmin":
+        from .aio import AsyncGarmin
+
+        return AsyncGarmin
+    if name == "ActivityDetails":
+        from .details import ActivityDetails
+
+        return ActivityDetails
+    if name == "StandInServer":
+        from .standin import StandInServer
+
+        return StandInServer
+    if name == "TimeSeries":
+        from .timeseries import TimeSeries
+
+        return TimeSeries
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 class GarminConnectConnectionError(Exception):
     """Raised when communication ended in error."""
@@ -0,0 +1,765 @@
+"""Asyncio client for Garmin Connect."""
+
+import asyncio
+import itertools
+import logging
+import os
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    cast,
+)
+
+import garth
+from garth.exc import GarthHTTPError
+from urllib3.util.retry import Retry
+
+from . import (
+    FIT_MAX_SIZE,
+    GarminConnectAuthenticationError,
+    _copy_exception,
+    _date_range,
+    _DownloadWriter,
+    _flight_key,
+    _GarminBase,
+    _outcomes,
+    _page_params,
+    _rewind_files,
+)
+from .cache import ResponseCache
+from .graphql import MAX_FIELDS
+from .hooks import RequestHook
+from .metrics import Metrics
+from .ratelimit import RateLimiter
+
+try:
+    import httpx
+except ImportError as e:  # pragma: no cover
+    raise ImportError(
+        "AsyncGarmin requires httpx, install it with "
+        "'pip install garminconnect[async]'"
+    ) from e
+
+logger = logging.getLogger(__name__)
+
+
+def _retryable(method: str, error: httpx.TransportError) -> bool:
+    """
+    Return whether a request that failed with 'error' before a response
+    is retried, as urllib3 retries it for Garmin: always when it could not
+    connect, otherwise only for idempotent methods.
+    """
+
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return True
+    return method.upper() in Retry.DEFAULT_ALLOWED_METHODS
+
+
+class AsyncGarmin(_GarminBase):
+    """
+    Class for fetching data from Garmin Connect using asyncio.
+
+    Offers the same methods as Garmin, every method that talks to Garmin
+    Connect returns an awaitable. Authentication still uses Garth, so the
+    token store written by Garmin.login() can be shared between both.
+    """
+
+    _is_async = True
+
+    def __init__(
+        self,
+        email=None,
+        password=None,
+        is_cn=False,
+        prompt_mfa=None,
+        cache: Optional[ResponseCache] = None,
+        client: Optional["httpx.AsyncClient"] = None,
+        max_connections: int = 100,
+        rate_limiter: Optional[RateLimiter] = None,
+        base_url: Optional[str] = None,
+        metrics: Optional[Metrics] = None,
+        hooks: Iterable[RequestHook] = (),
+    ):
+        """
+        Create a new class instance.
+        Pass 'client' to share one httpx.AsyncClient (and its connection
+        pool) between the instances of many users.
+        """
+
+        super().__init__(
+            email,
+            password,
+            is_cn,
+            prompt_mfa,
+            cache,
+            rate_limiter,
+            base_url=base_url,
+            metrics=metrics,
+            hooks=hooks,
+        )
+
+        self._owns_client = client is None
+        self.client = client or httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+        self._refresh_lock = asyncio.Lock()
+        self._tasks: Dict[str, "asyncio.Future"] = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """Close the HTTP client, unless it was passed in by the caller."""
+
+        if self._owns_client:
+            await self.client.aclose()
+
+    async def _refresh_oauth2(self):
+        """Refresh an expired OAuth2 token, at most once at a time."""
+
+        async with self._refresh_lock:
+            oauth2_token = self.garth.oauth2_token
+            if oauth2_token is None or oauth2_token.expired:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, self.garth.refresh_oauth2)
+
+    async def _prepare(
+        self, path: str, api: bool = False, headers: Optional[dict] = None
+    ) -> Tuple[str, Dict[str, str]]:
+        """Return the url and headers of a request for 'path'."""
+
+        headers = {**garth.http.USER_AGENT, **(headers or {})}
+        if api:
+            assert (
+                self.garth.oauth1_token
+            ), "OAuth1 token is required for API requests"
+            oauth2_token = self.garth.oauth2_token
+            if oauth2_token is None or oauth2_token.expired:
+                await self._refresh_oauth2()
+            headers["Authorization"] = str(self.garth.oauth2_token)
+
+        return self._api_url(path), headers
+
+    async def request(self, method: str, path: str, /, **kwargs):
+        """
+        Send a raw 'method' request for 'path' on the connectapi domain and
+        return the httpx response. Pass 'api=True' to authenticate the
+        request.
+        """
+
+        api = kwargs.pop("api", False)
+        headers = kwargs.pop("headers", None)
+        return await self._request(method, path, api, headers, kwargs)
+
+    async def _request(self, method, path, api, headers, kwargs, consume=None):
+        """
+        Send a request, retrying after 429 Too Many Requests, and return
+        the response, or what 'consume(response)' returns when given. It
+        is awaited with the streamed response once answered successfully.
+        """
+
+        params = kwargs.get("params")
+        if params:
+            # Sent like requests sends them, True as "True" and not "true".
+            kwargs = {
+                **kwargs,
+                "params": {
+                    key: str(value) if isinstance(value, bool) else value
+                    for key, value in params.items()
+                },
+            }
+        for attempt in itertools.count():
+            if self.rate_limiter is not None:
+                await asyncio.sleep(self.rate_limiter.reserve())
+            try:
+                return await self._send(
+                    method, path, api, headers, kwargs, attempt, consume
+                )
+            except GarthHTTPError as e:
+                delay = self._retry_delay(e, attempt, path)
+            if self.rate_limiter is None:
+                await asyncio.sleep(delay)
+            _rewind_files(kwargs)
+
+    async def _send(
+        self, method, path, api, headers, kwargs, attempt=0, consume=None
+    ):
+        url, headers = await self._prepare(path, api, headers)
+        # Mirror the retry policy Garth configures for the sync client.
+        for retry in range(self.garth.retries + 1):
+            request = response = None
+            if self.hooks:
+                request = self._before_request(
+                    method, path, attempt + retry, kwargs
+                )
+            try:
+                if consume is None:
+                    response = await self.client.request(
+                        method,
+                        url,
+                        headers=headers,
+                        timeout=self.garth.timeout,
+                        **kwargs,
+                    )
+                    response.raise_for_status()
+                    result = response
+                else:
+                    async with self.client.stream(
+                        method,
+                        url,
+                        headers=headers,
+                        timeout=self.garth.timeout,
+                        **kwargs,
+                    ) as response:
+                        response.raise_for_status()
+                        result = await consume(response)
+            except httpx.HTTPStatusError as e:
+                error = GarthHTTPError(msg="Error in request", error=e)
+                if request is not None:
+                    self._on_error(request, error, response.status_code)
+                if (
+                    response.status_code not in self.garth.status_forcelist
+                    or retry == self.garth.retries
+                ):
+                    raise error
+                await asyncio.sleep(self.garth.backoff_factor * 2**retry)
+                _rewind_files(kwargs)
+                continue
+            except httpx.TransportError as e:
+                if request is not None:
+                    status = getattr(response, "status_code", None)
+                    self._on_error(request, e, status)
+                if (
+                    response is not None
+                    or not _retryable(method, e)
+                    or retry == self.garth.retries
+                ):
+                    raise
+                await asyncio.sleep(self.garth.backoff_factor * 2**retry)
+                _rewind_files(kwargs)
+                continue
+            except Exception as e:
+                # Including failures reading or writing a streamed response.
+                if request is not None:
+                    status = getattr(response, "status_code", None)
+                    self._on_error(request, e, status)
+                raise
+
+            if request is not None:
+                size = response.num_bytes_downloaded
+                if consume is None:
+                    size = len(response.content)
+                self._after_response(request, response, size, 0)
+            return result
+
+    async def _connectapi(self, path, method="GET", **kwargs):
+        response = await self.request(method, path, api=True, **kwargs)
+        if response.status_code == 204:
+            return None
+        return response.json()
+
+    async def _download(self, path, **kwargs):
+        response = await self.request("GET", path, api=True, **kwargs)
+        return response.content
+
+    async def _cached(self, kind: str, fetch: Callable, path, kwargs):
+        cache = self.cache
+        entry = None
+        if cache is not None:
+            entry = cache.key_for(kind, path, kwargs, self.display_name)
+        if cache is None or entry is None:
+            return await fetch(path, **kwargs)
+
+        key, ttl = entry
+        hit, response = cache.get(key)
+        if not hit:
+            response = await fetch(path, **kwargs)
+            cache.set(key, response, ttl)
+        return response
+
+    async def _single_flight(self, key: Optional[str], factory: Callable):
+        """
+        Await the task in flight for 'key', or start it with 'factory'.
+        A cancelled caller does not cancel the task for the others.
+        """
+
+        if key is None:
+            return await factory()
+
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        try:
+            return await asyncio.shield(task)
+        except Exception as error:
+            # Raising the task's exception in every caller would mutate its
+            # __traceback__ from all of them.
+            raise _copy_exception(error) from error
+
+    async def connectapi(self, path, **kwargs):
+        return await self._single_flight(
+            _flight_key("json", path, kwargs),
+            lambda: self._cached("json", self._connectapi, path, kwargs),
+        )
+
+    async def download(self, path, **kwargs):
+        return await self._single_flight(
+            _flight_key("raw", path, kwargs),
+            lambda: self._cached("raw", self._download, path, kwargs),
+        )
+
+    async def _paginate(
+        self,
+        url: str,
+        params: Dict[str, str],
+        start: int = 0,
+        limit: Optional[int] = None,
+        workers: int = 4,
+    ) -> List[Any]:
+        async def fetch(request: Tuple[int, int]) -> List[Any]:
+            page_params = _page_params(url, params, *request)
+            return await self.connectapi(url, params=page_params) or []
+
+        plan = self._page_requests(url, start, limit, max(1, workers))
+        requests = next(plan)
+        while True:
+            try:
+                pages = await asyncio.gather(*map(fetch, requests))
+            except GarthHTTPError as e:
+                # The plan retries smaller pages, or raises it again.
+                requests = plan.throw(e)
+                continue
+            try:
+                requests = plan.send(pages)
+            except StopIteration as done:
+                return done.value
+
+    async def _iter_pages(
+        self,
+        url: str,
+        params: Dict[str, str],
+        start: int = 0,
+        limit: Optional[int] = None,
+    ) -> AsyncIterator[Any]:
+        plan = self._iter_page_requests(url, start, limit)
+        request = next(plan)
+        while True:
+            page_params = _page_params(url, params, *request)
+            page = await self.connectapi(url, params=page_params) or []
+            for item in page:
+                yield item
+            try:
+                request = plan.send(page)
+            except StopIteration:
+                return
+
+    async def download_activity_to(
+        self,
+        dest,
+        activity_id,
+        dl_fmt=_GarminBase.ActivityDownloadFormat.TCX,
+        chunk_size: int = 64 * 1024,
+    ) -> Dict[str, Any]:
+        url = self._activity_download_url(activity_id, dl_fmt)
+
+        logger.debug("Streaming activity from %s", url)
+
+        async def write(response):
+            # Only a successful response is written, a retried one is not.
+            with _DownloadWriter(dest) as writer:
+                async for chunk in response.aiter_bytes(chunk_size):
+                    writer.write(chunk)
+            return writer.result()
+
+        return await self._request("GET", url, True, None, {}, write)
+
+    async def archive_activities(
+        self,
+        directory: str,
+        activity_ids: Optional[Iterable] = None,
+        formats: Iterable = (_GarminBase.ActivityDownloadFormat.ORIGINAL,),
+        workers: int = 4,
+        progress: Optional[Callable[[int, int, Dict[str, Any]], Any]] = None,
+    ) -> Dict[str, Any]:
+        directory = os.path.expanduser(directory)
+        formats = list(formats)
+        if activity_ids is None:
+            activity_ids = [
+                a["activityId"]
+                async for a in self._iter_pages(
+                    self.garmin_connect_activities, {}
+                )
+            ]
+        manifest, jobs, skipped = self._archive_jobs(
+            directory, activity_ids, formats
+        )
+        logger.debug(
+            f"Archiving {len(jobs)} files to {directory}, {skipped} done"
+        )
+
+        done = itertools.count(1)
+
+        async def download(job):
+            activity_id, dl_fmt, filename = job
+            entry = {
+                "file": filename,
+                "activityId": activity_id,
+                "format": dl_fmt.name,
+            }
+            try:
+                result = await self.download_activity_to(
+                    os.path.join(directory, filename), activity_id, dl_fmt
+                )
+                entry.update(size=result["size"], sha256=result["sha256"])
+                manifest.add(entry)
+            except Exception as e:
+                entry["error"] = e
+                raise
+            finally:
+                if progress is not None:
+                    progress(next(done), len(jobs), entry)
+
+        results, errors = await self._fan_out(download, jobs, workers=workers)
+
+        return {
+            "downloaded": len(results),
+            "skipped": skipped,
+            "failed": {job[2]: error for job, error in errors.items()},
+        }
+
+    async def _fan_out(
+        self, func: Callable, items: Iterable, workers: int = 8
+    ) -> Tuple[Dict[Any, Any], Dict[Any, Exception]]:
+        """
+        Await 'func' for every item with at most 'workers' calls in flight.
+        Returns two dicts keyed by item, in input order: the results of the
+        calls that succeeded and the exceptions of the calls that failed.
+        """
+
+        items = list(items)
+        semaphore = asyncio.Semaphore(max(1, workers))
+
+        oauth2_token = self.garth.oauth2_token
+        if oauth2_token is not None and oauth2_token.expired:
+            await self._refresh_oauth2()
+
+        async def call(item):
+            async with semaphore:
+                return await func(item)
+
+        outcomes = await asyncio.gather(
+            *(call(item) for item in items), return_exceptions=True
+        )
+
+        results: Dict[Any, Any] = {}
+        errors: Dict[Any, Exception] = {}
+        for item, outcome in zip(items, outcomes):
+            if isinstance(outcome, Exception):
+                logger.debug("Request for %s failed: %s", item, outcome)
+                errors[item] = outcome
+            else:
+                results[item] = outcome
+
+        return results, errors
+
+    async def fetch_range(self, metric, start, end, workers: int = 8):
+        getter = self._day_getter(metric)
+        dates = _date_range(start, end)
+        logger.debug(
+            f"Requesting {metric} for {len(dates)} days from {start} to {end}"
+        )
+        results, errors = await self._fan_out(getter, dates, workers=workers)
+
+        return {"results": results, "errors": errors}
+
+    async def login(
+        self,
+        /,
+        tokenstore: Optional[str] = None,
+        profile_max_age: Optional[float] = None,
+    ):
+        """Log in using Garth, see Garmin.login."""
+
+        tokenstore = tokenstore or os.getenv("GARMINTOKENS")
+        if tokenstore:
+            self._load_tokens(tokenstore)
+        else:
+            # The SSO flow is blocking, run it off the event loop.
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self._load_tokens, None)
+        self.clear_metadata_cache()
+
+        profile_path = None
+        if profile_max_age is not None:
+            profile_path = self._profile_path(tokenstore)
+            if profile_path and self._restore_profile(
+                profile_path, profile_max_age
+            ):
+                return True
+
+        profile = await self.connectapi(self.garmin_connect_social_profile_url)
+        self.garth._user_profile = profile
+        self.display_name = profile["displayName"]
+        self.full_name = profile["fullName"]
+
+        settings = await self.connectapi(self.garmin_connect_user_settings_url)
+        self.unit_system = settings["userData"]["measurementSystem"]
+
+        if profile_path:
+            self._save_profile(profile_path)
+        return True
+
+    async def get_user_summary(self, cdate: str) -> Dict[str, Any]:
+        url = f"{self.garmin_connect_daily_summary_url}/{self.display_name}"
+        params = {"calendarDate": str(cdate)}
+        logger.debug("Requesting user summary")
+
+        response = await self.connectapi(url, params=params)
+
+        if response["privacyProtected"] is True:
+            raise GarminConnectAuthenticationError("Authentication error")
+
+        return response
+
+    async def get_stats_and_body(self, cdate):
+        stats, body = await asyncio.gather(
+            self.get_stats(cdate), self.get_body_composition(cdate)
+        )
+
+        return {**stats, **body["totalAverage"]}
+
+    async def delete_weigh_ins(self, cdate: str, delete_all: bool = False):
+        weigh_ins = self._weigh_ins_to_delete(
+            await self.get_daily_weigh_ins(cdate), cdate, delete_all
+        )
+        if not weigh_ins:
+            return
+
+        await asyncio.gather(
+            *(self.delete_weigh_in(w["samplePk"], cdate) for w in weigh_ins)
+        )
+
+        return len(weigh_ins)
+
+    async def delete_weigh_ins_range(
+        self,
+        startdate: str,
+        enddate: str,
+        predicate=None,
+        dry_run: bool = False,
+        workers: int = 4,
+    ):
+        samples = self._weigh_in_samples(
+            await self.get_weigh_ins(startdate, enddate), predicate
+        )
+        if dry_run:
+            return {"matched": samples, "deleted": 0, "failed": {}}
+
+        logger.debug(f"Deleting {len(samples)} weigh-ins")
+        dates = {
+            sample["samplePk"]: sample["calendarDate"] for sample in samples
+        }
+        results, errors = await self._fan_out(
+            lambda pk: self.delete_weigh_in(pk, dates[pk]), dates, workers
+        )
+
+        return {"matched": samples, "deleted": len(results), "failed": errors}
+
+    async def get_device_solar_data(
+        self, device_id: str, startdate: str, enddate=None
+    ) -> Dict[str, Any]:
+        if enddate is None:
+            enddate = startdate
+            single_day = True
+        else:
+            single_day = False
+
+        params = {"singleDayView": single_day}
+
+        url = f"{self.garmin_connect_solar_url}/{device_id}/{startdate}/{enddate}"
+        response = await self.connectapi(url, params=params)
+
+        return response["deviceSolarInput"]
+
+    async def get_all_device_settings(self, workers: int = 8):
+        device_ids = [
+            device["deviceId"] for device in await self.get_devices()
+        ]
+        logger.debug(f"Requesting settings of {len(device_ids)} devices")
+        results, errors = await self._fan_out(
+            self.get_device_settings, device_ids, workers=workers
+        )
+
+        return {"results": results, "errors": errors}
+
+    async def get_all_device_solar_data(
+        self, startdate: str, enddate=None, workers: int = 8
+    ):
+        device_ids = [
+            device["deviceId"] for device in await self.get_devices()
+        ]
+        logger.debug(f"Requesting solar data of {len(device_ids)} devices")
+        results, errors = await self._fan_out(
+            lambda device_id: self.get_device_solar_data(
+                device_id, startdate, enddate
+            ),
+            device_ids,
+            workers=workers,
+        )
+
+        return {"results": results, "errors": errors}
+
+    async def get_device_alarms(self) -> List[Any]:
+        logger.debug("Requesting device alarms")
+
+        return self._collect_alarms(await self.get_all_device_settings())
+
+    async def add_body_composition(
+        self, timestamp: Optional[str], weight: float, **kwargs
+    ):
+        responses = await self.add_body_compositions(
+            [{"timestamp": timestamp, "weight": weight, **kwargs}]
+        )
+        return responses[0]
+
+    async def add_body_compositions(
+        self, records, max_size: int = FIT_MAX_SIZE
+    ) -> List[Any]:
+        responses = []
+        for number, content in enumerate(
+            self._body_composition_files(records, max_size)
+        ):
+            logger.debug(f"Uploading body composition file {number}")
+            files = {"file": ("body_composition.fit", content)}
+            responses.append(
+                await self.request(
+                    "POST", self.garmin_connect_upload, files=files, api=True
+                )
+            )
+        return responses
+
+    async def import_weigh_ins(self, records, workers: int = 4):
+        records, window = self._plan_weigh_ins(records)
+        existing = await self.get_weigh_ins(*window) if window else None
+        new = self._new_weigh_ins(records, existing)
+        results, errors = await self._fan_out(
+            lambda index: self.add_weigh_in_with_timestamps(**records[index]),
+            new,
+            workers=workers,
+        )
+
+        return {
+            "created": len(results),
+            "skipped": len(records) - len(new),
+            "failed": errors,
+        }
+
+    async def get_last_activity(self):
+        activities = await self.get_activities(0, 1)
+        if activities:
+            return activities[-1]
+
+        return None
+
+    async def sync_activities(self, statefile: str, limit: int = 20):
+        state = self._read_sync_state(statefile)
+        logger.debug(f"Syncing activities newer than {state}")
+
+        activities = []
+        start = 0
+        while True:
+            page = await self.get_activities(start, limit) or []
+            new = list(
+                itertools.takewhile(
+                    lambda activity: not self._is_synced(activity, state),
+                    page,
+                )
+            )
+            activities.extend(new)
+            if len(new) < limit:
+                break
+            start = start + limit
+
+        if activities:
+            self._write_sync_state(statefile, activities[0])
+
+        return activities
+
+    async def get_activity_details_arrays(
+        self, activity_id, maxchart=2000, maxpoly=4000
+    ):
+        from .details import ActivityDetails
+
+        return ActivityDetails.from_payload(
+            await self.get_activity_details(activity_id, maxchart, maxpoly)
+        )
+
+    async def _series(self, metric, startdate, enddate, workers, decode):
+        from .timeseries import TimeSeries
+
+        if enddate is None:
+            return decode(await getattr(self, metric)(startdate))
+
+        fetched = await self.fetch_range(metric, startdate, enddate, workers)
+        if fetched["errors"]:
+            raise next(iter(fetched["errors"].values()))
+        return TimeSeries.concat(map(decode, fetched["results"].values()))
+
+    async def get_body_battery_series(self, startdate: str, enddate=None):
+        from .timeseries import TimeSeries
+
+        # Typed after the blocking Garmin.get_body_battery.
+        days = await cast(
+            Awaitable[List[Dict[str, Any]]],
+            self.get_body_battery(startdate, enddate),
+        )
+        return TimeSeries.concat(
+            TimeSeries.from_payload(
+                day,
+                "bodyBatteryValuesArray",
+                "bodyBatteryValueDescriptorDTOList",
+                "bodyBatteryLevel",
+            )
+            for day in days or []
+        )
+
+    async def query_garmin_graphql(self, query: dict):
+        logger.debug(f"Querying Garmin GraphQL Endpoint with query: {query}")
+
+        response = await self.request(
+            "POST", self.garmin_graphql_endpoint, json=query, api=True
+        )
+        return response.json()
+
+    async def query_garmin_graphql_metrics(
+        self,
+        metrics,
+        startdate: str,
+        enddate: str,
+        max_fields: int = MAX_FIELDS,
+        workers: int = 4,
+    ):
+        batch, documents = self._graphql_batch(
+            metrics, startdate, enddate, max_fields
+        )
+        results, errors = await self._fan_out(
+            lambda i: self.query_garmin_graphql(documents[i]),
+            range(len(documents)),
+            workers=workers,
+        )
+
+        return batch.split(_outcomes(range(len(documents)), results, errors))
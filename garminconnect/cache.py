@@ -0,0 +1,317 @@
+"""Response caches for Garmin Connect data."""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+logger = logging.getLogger(__name__)
+
+# Endpoints returning the data of one finished activity, which never changes
+# unless the activity itself is edited through this API.
+ACTIVITY_PATTERN = re.compile(
+    r"^/?(activity-service/activity|download-service/files/activity"
+    r"|download-service/export/\w+/activity)/\d+"
+)
+
+# Endpoints returning wellness data for the dates in their path or params.
+# Once those dates are over, the data is final.
+DATED_PREFIXES = (
+    "/usersummary-service/usersummary/daily",
+    "/usersummary-service/stats/steps/daily",
+    "/wellness-service/wellness/",
+    "/hrv-service/hrv",
+    "/metrics-service/metrics/",
+    "/userstats-service/wellness/daily",
+    "/fitnessage-service/fitnessage",
+    "/mobile-gateway/heartRate/forDate",
+)
+
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache for Garmin Connect responses.
+
+    Responses for finished activities and for dates before the settle
+    window are kept until evicted, responses for recent dates expire after
+    'recent_ttl' seconds, everything else is never cached. Keys start with
+    the account, so one cache can be shared by several accounts. When the database
+    grows beyond 'max_size' bytes the least recently used entries are
+    evicted.
+    """
+
+    def __init__(
+        self,
+        path: str = "~/.garminconnect/cache.sqlite",
+        max_size: int = 512 * 1024 * 1024,
+        recent_ttl: float = 900,
+        settle_days: int = 1,
+    ):
+        """
+        Open (or create) the cache database at 'path'.
+        Dates older than 'settle_days' days before today are considered
+        closed, late device syncs can still change the more recent ones.
+        """
+
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+        self.recent_ttl = recent_ttl
+        self.settle_days = settle_days
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Most callers never open a ResponseCache, so sqlite3 is only
+        # imported when one is.
+        import sqlite3
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+            "is_json INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at "
+            "ON responses (accessed_at)"
+        )
+
+    def close(self):
+        """Close the database connection."""
+
+        with self._lock:
+            self._db.close()
+
+    def key_for(
+        self,
+        kind: str,
+        path: str,
+        kwargs: Dict[str, Any],
+        account: Optional[str],
+    ) -> Optional[Tuple[str, Optional[float]]]:
+        """
+        Return the cache key and time to live in seconds (None for no
+        expiry) of a request of 'account' (its display name), or None when
+        it must not be cached. Requests of an unknown account never are.
+        """
+
+        if not account:
+            return None
+        method = kwargs.get("method", "GET")
+        if method != "GET" or kwargs.keys() - {"method", "params"}:
+            return None
+
+        params = kwargs.get("params") or {}
+        key = f"{account} {kind} {path}"
+        if params:
+            key += "?" + urlencode(sorted(params.items()))
+
+        if ACTIVITY_PATTERN.match(path):
+            return key, None
+
+        if not path.startswith(DATED_PREFIXES):
+            return None
+        dates = DATE_PATTERN.findall(key)
+        if not dates:
+            return None
+        closed = date.today() - timedelta(days=self.settle_days)
+        if max(dates) < closed.isoformat():
+            return key, None
+
+        return key, self.recent_ttl
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """Return (True, value) for a cached key or (False, None)."""
+
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, is_json, expires_at FROM responses "
+                "WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is not None and (row[2] is None or row[2] > now):
+                self._db.execute(
+                    "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                    (now, key),
+                )
+                self.hits += 1
+                value, is_json, _ = row
+                return True, json.loads(value) if is_json else value
+            self.misses += 1
+
+        return False, None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """Store 'value' (bytes or JSON data) under 'key' for 'ttl' seconds."""
+
+        is_json = not isinstance(value, bytes)
+        blob = json.dumps(value).encode() if is_json else value
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, value, is_json, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, blob, is_json, len(blob), expires_at, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float):
+        """Drop expired entries, then LRU entries until under 'max_size'."""
+
+        cursor = self._db.execute(
+            "DELETE FROM responses WHERE expires_at <= ?", (now,)
+        )
+        self.evictions += cursor.rowcount
+        (size,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if size <= self.max_size:
+            return
+
+        # Free some headroom so every insert does not trigger an eviction.
+        target = self.max_size * 0.9
+        rows = self._db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at"
+        ).fetchall()
+        evicted = []
+        for key, entry_size in rows:
+            if size <= target:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self.evictions += len(evicted)
+        logger.debug("Evicted %d cached responses", len(evicted))
+
+    def invalidate(self, fragment: str) -> int:
+        """
+        Drop all entries with 'fragment' as a path segment or parameter
+        value in their key, e.g. an activity id or a 'YYYY-MM-DD' date.
+        """
+
+        escaped = re.sub(r"([%_\\])", r"\\\1", fragment)
+        patterns = [f"%{escaped}{end}" for end in ("", "/%", "?%", "&%")]
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM responses WHERE "
+                + " OR ".join(["key LIKE ? ESCAPE '\\'"] * len(patterns)),
+                patterns,
+            )
+        return cursor.rowcount
+
+    def clear(self):
+        """Drop all entries and reset the counters."""
+
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.execute("VACUUM")
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and the current size of the cache."""
+
+        with self._lock:
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "size": size,
+            "max_size": self.max_size,
+        }
+
+
+class MemoryCache:
+    """
+    Thread-safe in-memory cache with a time to live per entry and least
+    recently used eviction beyond 'maxsize' entries.
+
+    Keys are tuples whose first item is a namespace (the name of the cached
+    method), so all entries of one namespace can be invalidated at once.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        """Create an empty cache holding at most 'maxsize' entries."""
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple) -> Tuple[bool, Any]:
+        """Return (True, value) for a live key or (False, None)."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+
+        return False, None
+
+    def set(self, key: Tuple, value: Any, ttl: float):
+        """Store 'value' under 'key' for 'ttl' seconds."""
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *namespaces: str) -> int:
+        """Drop the entries of 'namespaces', or all entries if none given."""
+
+        with self._lock:
+            keys = [
+                key
+                for key in self._entries
+                if not namespaces or key[0] in namespaces
+            ]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and the current size of the cache."""
+
+        with self._lock:
+            entries = len(self._entries)
+
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": entries,
+            "max_size": self.maxsize,
+        }
@@ -0,0 +1,114 @@
+"""Columnar decoding of Garmin Connect activity details."""
+
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    import numpy as np
+except ImportError as e:  # pragma: no cover
+    raise ImportError(
+        "ActivityDetails requires numpy, install it with "
+        "'pip install garminconnect[numpy]'"
+    ) from e
+
+TIMESTAMP_KEY = "directTimestamp"
+
+
+class ActivityDetails:
+    """
+    Struct-of-arrays view of the samples returned by get_activity_details.
+
+    Every metric key of the 'metricDescriptors' (e.g. "directHeartRate",
+    "directSpeed", "directElevation", "directTimestamp") maps to one
+    contiguous float64 array with a value per sample, NaN where a sample
+    has no value.
+    """
+
+    def __init__(
+        self,
+        columns: Dict[str, "np.ndarray"],
+        units: Optional[Dict[str, Optional[str]]] = None,
+        activity_id: Optional[int] = None,
+    ):
+        self.columns = columns
+        self.units = units or {}
+        self.activity_id = activity_id
+
+    @classmethod
+    def from_payload(cls, payload: Dict[str, Any]) -> "ActivityDetails":
+        """Decode a get_activity_details response."""
+
+        descriptors = sorted(
+            payload.get("metricDescriptors") or [],
+            key=lambda descriptor: descriptor["metricsIndex"],
+        )
+        width = max((d["metricsIndex"] for d in descriptors), default=-1) + 1
+        samples = payload.get("activityDetailMetrics") or []
+
+        matrix = np.full((width, len(samples)), np.nan)
+        if width and samples:
+            rows = [sample["metrics"] for sample in samples]
+            if all(len(row) == width for row in rows):
+                # None becomes NaN in the float conversion.
+                matrix = np.array(rows, dtype=np.float64).T.copy()
+            else:
+                for i, row in enumerate(rows):
+                    values = np.array(row[:width], dtype=np.float64)
+                    matrix[: len(values), i] = values
+
+        columns = {d["key"]: matrix[d["metricsIndex"]] for d in descriptors}
+        units = {
+            d["key"]: (d.get("unit") or {}).get("key") for d in descriptors
+        }
+
+        return cls(columns, units, payload.get("activityId"))
+
+    def __getitem__(self, key: str) -> "np.ndarray":
+        return self.columns[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.columns
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.columns)
+
+    def __len__(self) -> int:
+        """Return the number of samples."""
+
+        return len(next(iter(self.columns.values()), ()))
+
+    def __repr__(self) -> str:
+        return (
+            f"ActivityDetails(activity_id={self.activity_id}, "
+            f"samples={len(self)}, metrics={self.keys()})"
+        )
+
+    def keys(self) -> List[str]:
+        return list(self.columns)
+
+    @property
+    def timestamps(self) -> "np.ndarray":
+        """Return the sample times as datetime64[ms] (NaT when missing)."""
+
+        values = self.columns[TIMESTAMP_KEY]
+        timestamps = np.full(values.shape, np.datetime64("NaT"), "M8[ms]")
+        present = ~np.isnan(values)
+        milliseconds = values[present].astype(np.int64)
+        timestamps[present] = milliseconds.astype("M8[ms]")
+        return timestamps
+
+    def to_pandas(self):
+        """Return a pandas DataFrame with a column per metric."""
+
+        import pandas as pd
+
+        frame = pd.DataFrame(self.columns, copy=False)
+        if TIMESTAMP_KEY in self.columns:
+            frame.index = pd.DatetimeIndex(self.timestamps, name="timestamp")
+        return frame
+
+    def to_arrow(self):
+        """Return a pyarrow Table with a column per metric."""
+
+        import pyarrow as pa
+
+        return pa.table(self.columns)
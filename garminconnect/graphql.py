@@ -0,0 +1,189 @@
+"""Batched GraphQL queries for Garmin Connect metrics."""
+
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# Aliased fields per document. Keeps both the document and the response of
+# one request small enough to be served quickly.
+MAX_FIELDS = 40
+
+
+class GraphQLMetric(NamedTuple):
+    """
+    A GraphQL field returning one metric as JSON.
+
+    Ranged fields take a 'startDate' and 'endDate' and return the items of
+    up to 'max_days' days, either as a list or under 'items_key', each
+    dated by its 'date_key' (a dotted path for nested dates). Other fields
+    return a single day given as 'date_arg'.
+    """
+
+    field: str
+    ranged: bool = True
+    date_key: str = "calendarDate"
+    items_key: Optional[str] = None
+    date_arg: str = "date"
+    max_days: int = 28
+
+
+# Metric names of GraphQLBatch, named after the matching REST getters. The
+# data of a day is the GraphQL item as returned, which is shaped unlike the
+# REST getter's response (see garminconnect/graphql_queries.txt for
+# samples of each field):
+METRICS: Dict[str, GraphQLMetric] = {
+    # The V2 daily summary, with nested "movement", "heartRate" etc.
+    # instead of the flat totals of get_user_summary.
+    "user_summary": GraphQLMetric(
+        "userDailySummaryV2Scalar", items_key="data"
+    ),
+    # The "dailySleepDTO" of get_sleep_data, without the sleep levels.
+    "sleep_data": GraphQLMetric("sleepSummariesScalar"),
+    # The "hrvSummary" of get_hrv_data, without the readings.
+    "hrv_data": GraphQLMetric(
+        "heartRateVariabilityScalar", items_key="hrvSummaries"
+    ),
+    # One item of the list get_training_readiness returns.
+    "training_readiness": GraphQLMetric("trainingReadinessRangeScalar"),
+    # One item of the list get_max_metrics returns.
+    "max_metrics": GraphQLMetric(
+        "vo2MaxScalar", date_key="generic.calendarDate"
+    ),
+    # One of the "dailyWeightSummaries" of get_weigh_ins.
+    "weigh_ins": GraphQLMetric(
+        "weightScalar",
+        date_key="summaryDate",
+        items_key="dailyWeightSummaries",
+    ),
+    # One of the "measurementSummaries" of get_blood_pressure.
+    "blood_pressure": GraphQLMetric(
+        "bloodPressureScalar",
+        date_key="startDate",
+        items_key="measurementSummaries",
+    ),
+    # The "mostRecentTrainingStatus" of get_training_status.
+    "training_status": GraphQLMetric(
+        "trainingStatusDailyScalar", ranged=False, date_arg="calendarDate"
+    ),
+}
+
+
+class GraphQLBatch:
+    """
+    Compile several metrics over a range of days into a few GraphQL
+    documents of aliased fields, and split their responses back into
+    per-metric, per-day data.
+    """
+
+    def __init__(
+        self,
+        metrics: Iterable[str],
+        dates: List[str],
+        max_fields: int = MAX_FIELDS,
+    ):
+        """
+        Plan the fields querying 'metrics' (names of METRICS) for every day
+        of 'dates', a list of consecutive 'YYYY-MM-DD' dates.
+        """
+
+        self.metrics = list(metrics)
+        unknown = [m for m in self.metrics if m not in METRICS]
+        if unknown:
+            raise ValueError(
+                f"Unknown metrics {unknown}, expected some of {list(METRICS)}"
+            )
+
+        # alias -> (metric, dates covered, field call)
+        self.fields: Dict[str, Tuple[str, List[str], str]] = {}
+        for metric in self.metrics:
+            spec = METRICS[metric]
+            step = spec.max_days if spec.ranged else 1
+            for i in range(0, len(dates), step):
+                days = dates[i : i + step]
+                if spec.ranged:
+                    arguments = (
+                        f'startDate: "{days[0]}", endDate: "{days[-1]}"'
+                    )
+                else:
+                    arguments = f'{spec.date_arg}: "{days[0]}"'
+                alias = f"{metric}_{days[0].replace('-', '_')}"
+                self.fields[alias] = (
+                    metric,
+                    days,
+                    f"{alias}: {spec.field}({arguments})",
+                )
+
+        aliases = list(self.fields)
+        self.aliases = [
+            aliases[i : i + max_fields]
+            for i in range(0, len(aliases), max(1, max_fields))
+        ]
+
+    @property
+    def documents(self) -> List[Dict[str, str]]:
+        """Return the queries to post, as query_garmin_graphql takes them."""
+
+        return [
+            {
+                "query": "query {\n  "
+                + "\n  ".join(self.fields[alias][2] for alias in aliases)
+                + "\n}"
+            }
+            for aliases in self.aliases
+        ]
+
+    def split(self, responses: List[Any]) -> Dict[str, Dict[str, Any]]:
+        """
+        Split the 'responses' to the documents (in the same order; an
+        exception for a failed request) by metric and day.
+        Returns {"results": {metric: {cdate: data}}, "errors": {metric:
+        {cdate: error}}}, days without data are left out of "results".
+        """
+
+        results: Dict[str, Dict[str, Any]] = {m: {} for m in self.metrics}
+        errors: Dict[str, Dict[str, Any]] = {}
+
+        def fail(alias: str, error: Any):
+            metric, days, _ = self.fields[alias]
+            errors.setdefault(metric, {}).update(dict.fromkeys(days, error))
+
+        for aliases, response in zip(self.aliases, responses):
+            if isinstance(response, Exception):
+                for alias in aliases:
+                    fail(alias, response)
+                continue
+
+            for error in response.get("errors") or []:
+                path = error.get("path") or [None]
+                if path[0] in self.fields:
+                    fail(path[0], error)
+
+            data = response.get("data") or {}
+            for alias in aliases:
+                value = data.get(alias)
+                metric, days, _ = self.fields[alias]
+                if value is None:
+                    continue
+                spec = METRICS[metric]
+                if spec.ranged:
+                    results[metric].update(self._split_days(spec, value))
+                else:
+                    results[metric][days[0]] = value
+
+        for metric, found in results.items():
+            results[metric] = dict(sorted(found.items()))
+        return {"results": results, "errors": errors}
+
+    @staticmethod
+    def _split_days(spec: GraphQLMetric, value: Any) -> Dict[str, Any]:
+        items = value.get(spec.items_key) if spec.items_key else value
+        if not isinstance(items, list):
+            return {}
+
+        days = {}
+        for item in items:
+            day = item
+            for key in spec.date_key.split("."):
+                day = day.get(key) if isinstance(day, dict) else None
+            if day is not None:
+                # Some dates come with a time, keep 'YYYY-MM-DD'.
+                days[str(day)[:10]] = item
+        return days
@@ -0,0 +1,50 @@
+"""Hooks observing the requests sent to Garmin Connect."""
+
+import dataclasses
+from typing import Any, Dict, Optional
+
+
+@dataclasses.dataclass
+class RequestInfo:
+    """
+    One HTTP request, as passed to RequestHook. Fields after 'start' are
+    only set once the request is answered or failed.
+    """
+
+    # HTTP method and path of the request, with 'endpoint' its path as an
+    # endpoint template (see endpoint_template).
+    method: str
+    path: str
+    endpoint: str
+    params: Optional[Dict[str, Any]] = None
+    # Number of the attempt, 0 unless retried after 429 or a server error.
+    attempt: int = 0
+    request_bytes: int = 0
+    # perf_counter() when the request was sent.
+    start: float = 0.0
+    seconds: float = 0.0
+    # HTTP status, None without a response (e.g. a connection error).
+    status: Optional[int] = None
+    response_bytes: int = 0
+    # Retries made for this request, including those of the HTTP client.
+    retries: int = 0
+
+
+class RequestHook:
+    """
+    Base class of hooks called around every HTTP request a Garmin instance
+    sends, e.g. to trace or profile them. Add them with Garmin.add_hook.
+
+    Hooks run in the thread (or task) sending the request, in the order
+    they were added, and the exceptions they raise propagate to the
+    caller. Each retry of a request is a request of its own.
+    """
+
+    def before_request(self, request: RequestInfo):
+        """Called right before 'request' is sent."""
+
+    def after_response(self, request: RequestInfo, response: Any):
+        """Called with the successful 'response' to 'request'."""
+
+    def on_error(self, request: RequestInfo, error: Exception):
+        """Called when 'request' failed with 'error'."""
@@ -0,0 +1,248 @@
+"""Per-endpoint request metrics for Garmin Connect."""
+
+import functools
+import re
+import threading
+from typing import Any, Dict, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+from .hooks import RequestHook, RequestInfo
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+UUID_PATTERN = re.compile(
+    r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}"
+    r"-[0-9a-fA-F]{12}"
+)
+ID_PATTERN = re.compile(r"(?<=/)\d+(?=/|$)")
+
+
+@functools.lru_cache(maxsize=4096)
+def endpoint_template(path: str, display_name: Optional[str] = None) -> str:
+    """
+    Return the endpoint of 'path' with the query string left out and its
+    dates, UUIDs, numeric ids and the 'display_name' segment replaced by
+    placeholders, e.g. "/wellness-service/wellness/dailyHeartRate/
+    {display_name}" or "/download-service/files/activity/{id}".
+    """
+
+    path = urlsplit(path).path
+    if not path.startswith("/"):
+        path = f"/{path}"
+    if display_name:
+        segment = re.escape(display_name)
+        path = re.sub(f"(?<=/){segment}(?=/|$)", "{display_name}", path)
+    path = DATE_PATTERN.sub("{date}", path)
+    path = UUID_PATTERN.sub("{uuid}", path)
+    return ID_PATTERN.sub("{id}", path)
+
+
+class _Endpoint:
+    def __init__(self, buckets: int):
+        self.calls = 0
+        self.retries = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.statuses: Dict[Union[int, str], int] = {}
+        self.buckets = [0] * (buckets + 1)
+
+
+class Metrics(RequestHook):
+    """
+    Calls, latency histogram, response bytes, retries and status codes of
+    every endpoint (see endpoint_template) requested through Garmin
+    instances created with this as their 'metrics' (or added as a hook).
+
+    One instance can be shared by any number of Garmin instances and
+    threads, aggregating the requests of all of them. Every HTTP request
+    counts as a call, so a request retried after 429 Too Many Requests
+    counts twice, with one retry.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        """Create empty metrics with latency 'buckets' (in seconds)."""
+
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._endpoints: Dict[Tuple[str, str], _Endpoint] = {}
+
+    def record(
+        self,
+        method: str,
+        endpoint: str,
+        status: Union[int, str],
+        seconds: float,
+        size: int = 0,
+        retries: int = 0,
+    ):
+        """
+        Record a 'method' request of 'endpoint' answered with 'status' (or
+        "error" without a response) after 'seconds', with a response of
+        'size' bytes, after 'retries' retries.
+        """
+
+        bucket = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                bucket = i
+                break
+
+        with self._lock:
+            stats = self._endpoints.get((method, endpoint))
+            if stats is None:
+                stats = self._endpoints[(method, endpoint)] = _Endpoint(
+                    len(self.buckets)
+                )
+            stats.calls += 1
+            stats.retries += retries
+            stats.bytes += size
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.buckets[bucket] += 1
+
+    def after_response(self, request: RequestInfo, response: Any):
+        self.record(
+            request.method,
+            request.endpoint,
+            request.status or "error",
+            request.seconds,
+            request.response_bytes,
+            request.retries,
+        )
+
+    def on_error(self, request: RequestInfo, error: Exception):
+        self.record(
+            request.method,
+            request.endpoint,
+            request.status or "error",
+            request.seconds,
+            retries=request.retries,
+        )
+
+    def reset(self):
+        """Forget everything recorded so far."""
+
+        with self._lock:
+            self._endpoints.clear()
+
+    def _quantile(self, stats: _Endpoint, q: float) -> float:
+        """
+        Return the 'q' quantile (0 to 1) of the latency of 'stats',
+        interpolated within its histogram bucket like Prometheus does.
+        """
+
+        rank = q * stats.calls
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, stats.buckets):
+            if count and seen + count >= rank:
+                value = lower + (bound - lower) * (rank - seen) / count
+                return min(value, stats.max_seconds)
+            seen += count
+            lower = bound
+        return stats.max_seconds
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Return the metrics by "METHOD endpoint", busiest first: "calls",
+        "errors" (status 400 and up, or no response), "retries", "bytes",
+        "seconds" (total), "p50", "p99" and "max" seconds, "statuses" by
+        status and "histogram", the calls by bucket upper bound ("+Inf"
+        for the slowest).
+        """
+
+        with self._lock:
+            items = sorted(
+                self._endpoints.items(), key=lambda item: -item[1].calls
+            )
+            snapshot = {}
+            for (method, endpoint), stats in items:
+                bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+                snapshot[f"{method} {endpoint}"] = {
+                    "method": method,
+                    "endpoint": endpoint,
+                    "calls": stats.calls,
+                    "errors": sum(
+                        count
+                        for status, count in stats.statuses.items()
+                        if not isinstance(status, int) or status >= 400
+                    ),
+                    "retries": stats.retries,
+                    "bytes": stats.bytes,
+                    "seconds": stats.seconds,
+                    "p50": self._quantile(stats, 0.5),
+                    "p99": self._quantile(stats, 0.99),
+                    "max": stats.max_seconds,
+                    "statuses": dict(stats.statuses),
+                    "histogram": dict(zip(bounds, stats.buckets)),
+                }
+        return snapshot
+
+    def to_prometheus(self, prefix: str = "garminconnect") -> str:
+        """Return the metrics in the Prometheus text exposition format."""
+
+        def labels(method: str, endpoint: str, **extra: str) -> str:
+            pairs = {"method": method, "endpoint": endpoint, **extra}
+            return ",".join(
+                f'{name}="{_escape(value)}"' for name, value in pairs.items()
+            )
+
+        requests = [
+            f"# HELP {prefix}_requests_total Requests by endpoint and status.",
+            f"# TYPE {prefix}_requests_total counter",
+        ]
+        duration = [
+            f"# HELP {prefix}_request_duration_seconds Request latency.",
+            f"# TYPE {prefix}_request_duration_seconds histogram",
+        ]
+        size = [
+            f"# HELP {prefix}_response_bytes_total Response bytes received.",
+            f"# TYPE {prefix}_response_bytes_total counter",
+        ]
+        retries = [
+            f"# HELP {prefix}_retries_total Retried requests.",
+            f"# TYPE {prefix}_retries_total counter",
+        ]
+
+        for stats in self.snapshot().values():
+            method, endpoint = stats["method"], stats["endpoint"]
+            for status, count in sorted(
+                stats["statuses"].items(), key=lambda item: str(item[0])
+            ):
+                requests.append(
+                    f"{prefix}_requests_total"
+                    f"{{{labels(method, endpoint, status=str(status))}}} "
+                    f"{count}"
+                )
+            cumulative = 0
+            for bound, count in stats["histogram"].items():
+                cumulative += count
+                duration.append(
+                    f"{prefix}_request_duration_seconds_bucket"
+                    f"{{{labels(method, endpoint, le=bound)}}} {cumulative}"
+                )
+            series = labels(method, endpoint)
+            duration.append(
+                f"{prefix}_request_duration_seconds_sum{{{series}}} "
+                f"{stats['seconds']!r}"
+            )
+            duration.append(
+                f"{prefix}_request_duration_seconds_count{{{series}}} "
+                f"{stats['calls']}"
+            )
+            size.append(
+                f"{prefix}_response_bytes_total{{{series}}} {stats['bytes']}"
+            )
+            retries.append(
+                f"{prefix}_retries_total{{{series}}} {stats['retries']}"
+            )
+
+        return "\n".join(requests + duration + size + retries) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
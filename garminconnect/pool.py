@@ -0,0 +1,301 @@
+"""Sessions of many Garmin Connect accounts with fair scheduling."""
+
+import itertools
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from . import Garmin
+from .ratelimit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# File in an account's token store holding its rate limiter bucket, shared
+# by all processes using that token store.
+RATE_LIMIT_FILE = ".ratelimit"
+
+
+class _Account:
+    def __init__(self, name: str, tokenstore: str, limiter: RateLimiter):
+        self.name = name
+        self.tokenstore = tokenstore
+        self.limiter = limiter
+        self.queue: Deque[Tuple[Future, Callable, tuple, dict]] = deque()
+        self.running = 0
+        self.session: Optional[Garmin] = None
+        self.last_used = 0
+        self.login_lock = threading.Lock()
+
+
+class AccountPool:
+    """
+    Garmin sessions of many accounts, each logged in lazily from its own
+    token store, a subdirectory of 'directory' named after the account.
+
+    Work submitted for an account is queued per account and run by
+    'workers' threads, taking turns between the accounts with queued work,
+    so a long backfill of one account does not hold up the others. At most
+    'per_account' calls of one account run at the same time, every account
+    has its own rate limiter, and only 'max_sessions' sessions are kept,
+    closing the least recently used idle ones.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_sessions: int = 50,
+        workers: int = 8,
+        per_account: int = 2,
+        rate: float = 1.0,
+        burst: int = 5,
+        profile_max_age: Optional[float] = 24 * 60 * 60,
+        **garmin_kwargs: Any,
+    ):
+        """
+        Create the pool and start its worker threads. 'rate' and 'burst'
+        set the rate limiter of every account, 'profile_max_age' is passed
+        to Garmin.login and 'garmin_kwargs' to Garmin (e.g. a shared
+        'session', which the pool leaves open, or a shared 'cache', which
+        keys its entries by account).
+        """
+
+        if max_sessions < 1 or workers < 1 or per_account < 1:
+            raise ValueError("Pool limits must be at least 1")
+
+        self.directory = os.path.expanduser(directory)
+        self.max_sessions = max_sessions
+        self.per_account = per_account
+        self.rate = rate
+        self.burst = burst
+        self.profile_max_age = profile_max_age
+        self.garmin_kwargs = garmin_kwargs
+
+        self._accounts: Dict[str, _Account] = {}
+        self._sessions = 0
+        self._turn = 0
+        self._clock = itertools.count(1)
+        self._closed = False
+        self._ready = threading.Condition()
+        self._workers = [
+            threading.Thread(
+                target=self._work, name=f"AccountPool-{i}", daemon=True
+            )
+            for i in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def accounts(self) -> List[str]:
+        """Return the names of the accounts found in 'directory'."""
+
+        return sorted(
+            name
+            for name in os.listdir(self.directory)
+            if os.path.isdir(os.path.join(self.directory, name))
+        )
+
+    def _account(self, name: str) -> _Account:
+        """Return the record of account 'name'. Called with the lock held."""
+
+        account = self._accounts.get(name)
+        if account is None:
+            tokenstore = os.path.join(self.directory, name)
+            if not os.path.isdir(tokenstore):
+                raise KeyError(f"No token store for account {name}")
+            limiter = RateLimiter(
+                self.rate,
+                self.burst,
+                os.path.join(tokenstore, RATE_LIMIT_FILE),
+            )
+            account = self._accounts[name] = _Account(
+                name, tokenstore, limiter
+            )
+        return account
+
+    def submit(
+        self, name: str, func: Union[str, Callable], /, *args, **kwargs
+    ) -> Future:
+        """
+        Queue a call for account 'name' and return its Future. 'func' is
+        the name of a Garmin method (e.g. "get_stats") or a callable taking
+        the account's Garmin session as first argument.
+        """
+
+        call = getattr(Garmin, func) if isinstance(func, str) else func
+        future: Future = Future()
+        with self._ready:
+            if self._closed:
+                raise RuntimeError("AccountPool is closed")
+            self._account(name).queue.append((future, call, args, kwargs))
+            self._ready.notify()
+        return future
+
+    def session(self, name: str) -> Garmin:
+        """
+        Return the logged in session of account 'name'. Unlike the calls
+        submitted, using it does not keep the pool from closing it to
+        make room for other accounts once it is idle.
+        """
+
+        with self._ready:
+            account = self._account(name)
+            account.last_used = next(self._clock)
+            api = account.session or self._reserve_session(account)
+            while api is None:
+                self._ready.wait()
+                api = account.session or self._reserve_session(account)
+            # Not idle while logging in, so it is not closed meanwhile.
+            account.running += 1
+        try:
+            return self._login(account, api)
+        finally:
+            with self._ready:
+                account.running -= 1
+                self._ready.notify_all()
+
+    def _reserve_session(self, account: _Account) -> Optional[Garmin]:
+        """
+        Make room for a new session of 'account' and return it, closing
+        the least recently used idle session when at 'max_sessions'.
+        Returns None when every session is busy.
+        """
+
+        if self._sessions >= self.max_sessions:
+            idle = [
+                other
+                for other in self._accounts.values()
+                if other.session is not None
+                and not other.running
+                and other is not account
+            ]
+            if not idle:
+                return None
+            oldest = min(idle, key=lambda other: other.last_used)
+            logger.debug(f"Closing the session of {oldest.name}")
+            if oldest.session is not None:
+                self._close_session(oldest.session)
+            oldest.session = None
+            self._sessions -= 1
+
+        api = account.session = Garmin(**self.garmin_kwargs)
+        self._sessions += 1
+        return api
+
+    def _close_session(self, api: Garmin):
+        """Close the HTTP session of 'api', unless it was passed in."""
+
+        if "session" not in self.garmin_kwargs:
+            api.garth.sess.close()
+
+    def _login(self, account: _Account, api: Garmin) -> Garmin:
+        """Log 'api', the session of 'account', in once."""
+
+        with account.login_lock:
+            if api.display_name is None:
+                logger.debug(f"Logging in account {account.name}")
+                api.rate_limiter = account.limiter
+                if "session" not in self.garmin_kwargs:
+                    api.garth.configure(
+                        pool_connections=self.per_account,
+                        pool_maxsize=self.per_account,
+                    )
+                    api._mount_base_url()
+                api.login(account.tokenstore, self.profile_max_age)
+        return api
+
+    def _next_job(self) -> Optional[Tuple[_Account, Garmin, Tuple]]:
+        """
+        Pop the next job, taking turns between the accounts with queued
+        work. Called with the lock held.
+        """
+
+        accounts = list(self._accounts.values())
+        for i in range(len(accounts)):
+            account = accounts[(self._turn + i) % len(accounts)]
+            if not account.queue or account.running >= self.per_account:
+                continue
+            api = account.session or self._reserve_session(account)
+            if api is None:
+                continue
+            self._turn = (self._turn + i + 1) % len(accounts)
+            account.running += 1
+            account.last_used = next(self._clock)
+            return account, api, account.queue.popleft()
+        return None
+
+    def _work(self):
+        while True:
+            with self._ready:
+                job = self._next_job()
+                while job is None:
+                    if self._closed:
+                        return
+                    self._ready.wait()
+                    job = self._next_job()
+
+            account, api, (future, func, args, kwargs) = job
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = func(
+                            self._login(account, api), *args, **kwargs
+                        )
+                    except Exception as e:
+                        logger.debug(
+                            f"Call for {account.name} failed", exc_info=True
+                        )
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                with self._ready:
+                    account.running -= 1
+                    self._ready.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the open sessions and the queued and running calls."""
+
+        with self._ready:
+            return {
+                "sessions": self._sessions,
+                "accounts": {
+                    account.name: {
+                        "queued": len(account.queue),
+                        "running": account.running,
+                        "logged_in": account.session is not None,
+                    }
+                    for account in self._accounts.values()
+                },
+            }
+
+    def close(self, wait: bool = True):
+        """
+        Stop accepting work and close all sessions, after the queued work
+        is done when 'wait' is True, else cancelling it.
+        """
+
+        with self._ready:
+            self._closed = True
+            if not wait:
+                for account in self._accounts.values():
+                    while account.queue:
+                        account.queue.popleft()[0].cancel()
+            self._ready.notify_all()
+
+        for worker in self._workers:
+            worker.join()
+        for account in self._accounts.values():
+            if account.session is not None:
+                self._close_session(account.session)
+                account.session = None
+        self._sessions = 0
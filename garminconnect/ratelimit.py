@@ -0,0 +1,144 @@
+"""Request rate limiting for Garmin Connect."""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import TYPE_CHECKING, Any, Dict, Iterator, Optional
+
+if TYPE_CHECKING:
+    import fcntl
+else:
+    try:
+        import fcntl
+    except ImportError:  # pragma: no cover
+        fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def retry_after(response: Any) -> Optional[float]:
+    """
+    Return the seconds to wait requested by the Retry-After header of
+    'response', given either as seconds or as an HTTP date.
+    """
+
+    value = getattr(response, "headers", {}).get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        until = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if until.tzinfo is None:
+        until = until.replace(tzinfo=timezone.utc)
+    return max(0.0, (until - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    """
+    Token bucket allowing 'rate' requests per second on average, in bursts
+    of up to 'burst' requests.
+
+    One limiter can be shared by any number of Garmin instances and
+    threads. With 'path' the bucket lives in that file, guarded by an
+    advisory lock, so all processes using the same path share it too.
+    """
+
+    def __init__(
+        self, rate: float = 2.0, burst: int = 10, path: Optional[str] = None
+    ):
+        """
+        Create a full bucket, or open the shared bucket at 'path'.
+        """
+
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate must be positive and burst at least 1")
+
+        self.rate = rate
+        self.burst = burst
+        self.path = os.path.expanduser(path) if path else None
+        self._lock = threading.Lock()
+        self._state = {"tokens": float(burst), "updated": time.time()}
+
+        if self.path and fcntl is None:  # pragma: no cover
+            logger.warning(
+                "File locking is not available, %s is not shared between "
+                "processes",
+                self.path,
+            )
+            self.path = None
+        if self.path:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[Dict[str, float]]:
+        """Yield the bucket state for update, locked for exclusive use."""
+
+        with self._lock:
+            if not self.path:
+                yield self._state
+                return
+
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), "r+") as f:
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:
+                        state = dict(self._state)
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+            finally:
+                os.close(fd)
+
+    def _refill(self, state: Dict[str, float], now: float):
+        elapsed = max(0.0, now - state["updated"])
+        state["tokens"] = min(
+            self.burst, state["tokens"] + elapsed * self.rate
+        )
+        state["updated"] = now
+
+    def reserve(self, tokens: int = 1) -> float:
+        """
+        Take 'tokens' from the bucket and return the seconds the caller has
+        to wait before sending its request. The bucket may go into debt,
+        later callers then queue behind it at the configured rate.
+        """
+
+        with self._locked() as state:
+            self._refill(state, time.time())
+            state["tokens"] -= tokens
+            debt = -state["tokens"]
+
+        return max(0.0, debt / self.rate)
+
+    def acquire(self, tokens: int = 1):
+        """Block until 'tokens' requests may be sent."""
+
+        delay = self.reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+    def backoff(self, seconds: float):
+        """
+        Hold back all requests for 'seconds', e.g. after the server asked
+        to retry later, then let them resume at the configured rate.
+        """
+
+        with self._locked() as state:
+            self._refill(state, time.time())
+            state["tokens"] = min(state["tokens"], -seconds * self.rate)
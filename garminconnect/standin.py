@@ -0,0 +1,677 @@
+"""Local stand-in for the Garmin Connect API, for load tests."""
+
+import io
+import json
+import logging
+import random
+import re
+import threading
+import time
+import zipfile
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from . import Garmin
+
+logger = logging.getLogger(__name__)
+
+# Access tokens of the stand-in users, 'user' being the user's index.
+TOKEN_PREFIX = "standin-"
+
+# Every activity id encodes its user and its number, see _activity_id.
+ACTIVITY_ID_BASE = 10_000_000
+
+
+def _day(value: str) -> date:
+    return date.fromisoformat(value[:10])
+
+
+def _millis(moment: datetime) -> int:
+    return int(moment.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+class StandInServer:
+    """
+    HTTP server answering the main Garmin Connect endpoints with synthetic
+    data: activity search, activities and their downloads, upload, daily
+    summaries, heart rates, sleep and weigh-ins, plus the profile and
+    settings requested by login.
+
+    The data of 'users' fake users covers the 'years' years from
+    'first_day' up to 'end' (today by default) and is generated from
+    'seed', so every run serves the same data.
+
+    Responses are delayed by 'latency' seconds give or take 'jitter', a
+    'throttle_rate' share of requests is answered with 429 Too Many
+    Requests (asking to retry after 'retry_after' seconds) and an
+    'error_rate' share with 503 Service Unavailable. Activity searches
+    asking for more than 'max_page_size' items are rejected with 400 Bad
+    Request.
+
+    Point Garmin instances at 'url' with their 'base_url', or get a logged
+    in one from client().
+    """
+
+    def __init__(
+        self,
+        users: int = 10,
+        years: int = 1,
+        end: Optional[date] = None,
+        activities_per_week: float = 4.0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        throttle_rate: float = 0.0,
+        error_rate: float = 0.0,
+        retry_after: int = 1,
+        max_page_size: int = 1000,
+        seed: int = 0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        """Create the server, listening on 'port' (0 picks a free port)."""
+
+        if users < 1 or years < 1:
+            raise ValueError("users and years must be at least 1")
+
+        self.users = users
+        self.end = end or date.today()
+        self.first_day = self.end - timedelta(days=365 * years - 1)
+        self.activities_per_week = activities_per_week
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.max_page_size = max_page_size
+        self.seed = seed
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._activities: Dict[int, List[Dict[str, Any]]] = {}
+        self._uploads = 0
+        self._statuses: Dict[int, int] = {}
+        self._requests = 0
+        self._routes = self._make_routes()
+
+        handler = type("Handler", (_Handler,), {"standin": self})
+        self._httpd = ThreadingHTTPServer((host, port), handler)
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def url(self) -> str:
+        """Return the base url to pass as 'base_url' to Garmin."""
+
+        host, port = self._httpd.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode()
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StandInServer":
+        """Serve requests in a background thread."""
+
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._httpd.serve_forever,
+                kwargs={"poll_interval": 0.1},
+                name="StandInServer",
+                daemon=True,
+            )
+            self._thread.start()
+            logger.debug(f"Stand-in server listening on {self.url}")
+        return self
+
+    def close(self):
+        """Stop serving and close the socket."""
+
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def display_name(self, user: int) -> str:
+        """Return the display name of stand-in 'user'."""
+
+        return f"user{user}"
+
+    def client(self, user: int = 0, **garmin_kwargs: Any) -> Garmin:
+        """
+        Return a Garmin instance logged in as stand-in 'user' (0 to
+        users - 1), created with 'garmin_kwargs' (e.g. 'session' or
+        'cache'). Its tokens never expire.
+        """
+
+        from garth.auth_tokens import OAuth1Token, OAuth2Token
+
+        if not 0 <= user < self.users:
+            raise ValueError(f"No stand-in user {user}")
+
+        api = Garmin(base_url=self.url, **garmin_kwargs)
+        forever = int(time.time()) + 100 * 365 * 24 * 60 * 60
+        api.garth.oauth1_token = OAuth1Token(f"token{user}", "secret")
+        api.garth.oauth2_token = OAuth2Token(
+            scope="CONNECT_READ CONNECT_WRITE",
+            jti=f"jti{user}",
+            token_type="Bearer",
+            access_token=f"{TOKEN_PREFIX}{user}",
+            refresh_token="refresh",
+            expires_in=forever,
+            expires_at=forever,
+            refresh_token_expires_in=forever,
+            refresh_token_expires_at=forever,
+        )
+        api.display_name = self.display_name(user)
+        api.full_name = f"Stand-in User {user}"
+        api.unit_system = "metric"
+        return api
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the number of requests served and their statuses."""
+
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "statuses": dict(self._statuses),
+                "uploads": self._uploads,
+            }
+
+    def _make_routes(
+        self,
+    ) -> List[Tuple[str, "re.Pattern[str]", Callable]]:
+        routes: List[Tuple[str, str, Callable]] = [
+            ("GET", Garmin.garmin_connect_social_profile_url, self._profile),
+            ("GET", Garmin.garmin_connect_user_settings_url, self._settings),
+            (
+                "GET",
+                Garmin.garmin_connect_daily_summary_url + r"/[^/]+",
+                self._daily_summary,
+            ),
+            (
+                "GET",
+                Garmin.garmin_connect_heartrates_daily_url + r"/[^/]+",
+                self._heart_rates,
+            ),
+            (
+                "GET",
+                Garmin.garmin_connect_daily_sleep_url + r"/[^/]+",
+                self._sleep,
+            ),
+            (
+                "GET",
+                Garmin.garmin_connect_weight_url + "/weight/dateRange",
+                self._body_composition,
+            ),
+            (
+                "GET",
+                Garmin.garmin_connect_weight_url
+                + r"/weight/range/(?P<start>[\d-]+)/(?P<end>[\d-]+)",
+                self._weigh_ins,
+            ),
+            (
+                "GET",
+                Garmin.garmin_connect_weight_url
+                + r"/weight/dayview/(?P<start>[\d-]+)",
+                self._weigh_ins,
+            ),
+            ("GET", Garmin.garmin_connect_activities, self._search),
+            (
+                "GET",
+                Garmin.garmin_connect_activity + r"/(?P<activity_id>\d+)",
+                self._activity,
+            ),
+            (
+                "GET",
+                Garmin.garmin_connect_fit_download + r"/(?P<activity_id>\d+)",
+                self._download,
+            ),
+            (
+                "GET",
+                r"/download-service/export/(?P<fmt>tcx|gpx|kml|csv)"
+                r"/activity/(?P<activity_id>\d+)",
+                self._download,
+            ),
+            ("POST", Garmin.garmin_connect_upload, self._upload),
+        ]
+        return [
+            (method, re.compile(pattern + "$"), handler)
+            for method, pattern, handler in routes
+        ]
+
+    def _handle(
+        self, method: str, url: str, headers: Any, body: bytes
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        """Return the status, headers and body answering a request."""
+
+        with self._lock:
+            self._requests += 1
+            delay = self.latency + self._random.uniform(
+                -self.jitter, self.jitter
+            )
+            roll = self._random.random()
+        if delay > 0:
+            time.sleep(delay)
+
+        if roll < self.throttle_rate:
+            headers = {"Retry-After": str(self.retry_after)}
+            return 429, headers, b'{"message": "Too many requests"}'
+        if roll < self.throttle_rate + self.error_rate:
+            return 503, {}, b'{"message": "Service unavailable"}'
+
+        authorization = headers.get("Authorization") or ""
+        token = authorization.rpartition(" ")[2]
+        user = token[len(TOKEN_PREFIX) :]
+        if not token.startswith(TOKEN_PREFIX) or not user.isdigit():
+            return 401, {}, b'{"message": "Unauthorized"}'
+        user_index = int(user)
+        if user_index >= self.users:
+            return 401, {}, b'{"message": "Unauthorized"}'
+
+        parts = urlsplit(url)
+        params = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        for route_method, pattern, handler in self._routes:
+            match = pattern.match(parts.path)
+            if match and route_method == method:
+                try:
+                    return handler(
+                        user_index, params, body, **match.groupdict()
+                    )
+                except (KeyError, ValueError) as e:
+                    message = json.dumps({"message": f"Bad request: {e}"})
+                    return 400, {}, message.encode()
+        return 404, {}, b'{"message": "Not found"}'
+
+    def _day_random(self, user: int, day: date, kind: str) -> random.Random:
+        return random.Random(f"{self.seed}:{user}:{day}:{kind}")
+
+    def _days(self, start: date, end: date) -> List[date]:
+        start = max(start, self.first_day)
+        end = min(end, self.end)
+        return [
+            start + timedelta(days=i) for i in range((end - start).days + 1)
+        ]
+
+    def _profile(self, user, params, body):
+        return _json(
+            {
+                "id": 1000 + user,
+                "profileId": 2000 + user,
+                "displayName": self.display_name(user),
+                "fullName": f"Stand-in User {user}",
+                "userName": self.display_name(user),
+            }
+        )
+
+    def _settings(self, user, params, body):
+        return _json(
+            {
+                "id": 2000 + user,
+                "userData": {
+                    "gender": "FEMALE" if user % 2 else "MALE",
+                    "weight": 70000.0 + 500 * (user % 20),
+                    "height": 175.0,
+                    "measurementSystem": "metric",
+                },
+            }
+        )
+
+    def _daily_summary(self, user, params, body):
+        day = _day(params["calendarDate"])
+        rng = self._day_random(user, day, "summary")
+        in_range = self.first_day <= day <= self.end
+        steps = rng.randint(2000, 20000) if in_range else None
+        return _json(
+            {
+                "userProfileId": 2000 + user,
+                "calendarDate": day.isoformat(),
+                "totalSteps": steps,
+                "dailyStepGoal": 8000,
+                "totalDistanceMeters": steps and int(steps * 0.8),
+                "totalKilocalories": steps and 1800.0 + steps * 0.04,
+                "activeKilocalories": steps and steps * 0.04,
+                "bmrKilocalories": 1800.0,
+                "restingHeartRate": rng.randint(45, 70),
+                "minHeartRate": rng.randint(40, 50),
+                "maxHeartRate": rng.randint(120, 185),
+                "averageStressLevel": rng.randint(15, 50),
+                "privacyProtected": False,
+            }
+        )
+
+    def _heart_rates(self, user, params, body):
+        day = _day(params["date"])
+        rng = self._day_random(user, day, "heart")
+        start = _millis(datetime.combine(day, datetime.min.time()))
+        values = None
+        if self.first_day <= day <= self.end:
+            resting = rng.randint(45, 65)
+            values = [
+                [start + i * 120_000, resting + rng.randint(0, 40)]
+                for i in range(720)
+            ]
+        return _json(
+            {
+                "userProfilePK": 2000 + user,
+                "calendarDate": day.isoformat(),
+                "startTimestampGMT": f"{day}T00:00:00.0",
+                "endTimestampGMT": f"{day + timedelta(days=1)}T00:00:00.0",
+                "maxHeartRate": values and max(v[1] for v in values),
+                "minHeartRate": values and min(v[1] for v in values),
+                "restingHeartRate": values and values[0][1],
+                "heartRateValueDescriptors": [
+                    {"key": "timestamp", "index": 0},
+                    {"key": "heartrate", "index": 1},
+                ],
+                "heartRateValues": values,
+            }
+        )
+
+    def _sleep(self, user, params, body):
+        day = _day(params["date"])
+        rng = self._day_random(user, day, "sleep")
+        sleep = {"calendarDate": day.isoformat(), "sleepTimeSeconds": None}
+        levels = []
+        if self.first_day <= day <= self.end:
+            start = datetime.combine(day, datetime.min.time()) - timedelta(
+                hours=rng.uniform(0.5, 2.5)
+            )
+            seconds = {"deep": 0, "light": 0, "rem": 0, "awake": 0}
+            moment = start
+            for _ in range(rng.randint(20, 40)):
+                level = rng.choice(list(seconds))
+                length = rng.randint(300, 1500)
+                seconds[level] += length
+                end = moment + timedelta(seconds=length)
+                levels.append(
+                    {
+                        "startGMT": f"{moment.isoformat()}.0",
+                        "endGMT": f"{end.isoformat()}.0",
+                        "activityLevel": list(seconds).index(level),
+                    }
+                )
+                moment = end
+            sleep.update(
+                {
+                    "sleepTimeSeconds": sum(seconds.values())
+                    - seconds["awake"],
+                    "sleepStartTimestampGMT": _millis(start),
+                    "sleepEndTimestampGMT": _millis(moment),
+                    **{f"{k}SleepSeconds": v for k, v in seconds.items()},
+                }
+            )
+        return _json(
+            {
+                "dailySleepDTO": {"userProfilePK": 2000 + user, **sleep},
+                "sleepLevels": levels,
+            }
+        )
+
+    def _weight_samples(self, user: int, start: date, end: date):
+        """Return the weigh-ins of 'user' (every third day) by day."""
+
+        samples = {}
+        for day in self._days(start, end):
+            if (day.toordinal() + user) % 3:
+                continue
+            rng = self._day_random(user, day, "weight")
+            moment = datetime.combine(day, datetime.min.time()) + timedelta(
+                hours=7, minutes=rng.randint(0, 59)
+            )
+            samples[day] = {
+                "samplePk": _millis(moment) * 100 + user % 100,
+                "date": _millis(moment),
+                "calendarDate": day.isoformat(),
+                "weight": 70000.0
+                + 500 * (user % 20)
+                + rng.uniform(-2000, 2000),
+                "bmi": None,
+                "bodyFat": round(rng.uniform(12, 25), 1),
+                "bodyWater": None,
+                "boneMass": None,
+                "muscleMass": None,
+                "sourceType": "INDEX_SCALE" if user % 2 else "MANUAL",
+                "timestampGMT": _millis(moment),
+            }
+        return samples
+
+    @staticmethod
+    def _average(samples: List[Dict[str, Any]]) -> Dict[str, Any]:
+        weights = [s["weight"] for s in samples]
+        return {
+            "weight": sum(weights) / len(weights) if weights else None,
+            "bmi": None,
+            "bodyFat": None,
+        }
+
+    def _body_composition(self, user, params, body):
+        start, end = _day(params["startDate"]), _day(params["endDate"])
+        samples = list(self._weight_samples(user, start, end).values())
+        return _json(
+            {
+                "startDate": start.isoformat(),
+                "endDate": end.isoformat(),
+                "dateWeightList": samples,
+                "totalAverage": self._average(samples),
+            }
+        )
+
+    def _weigh_ins(self, user, params, body, start, end=None):
+        start_day = _day(start)
+        end_day = _day(end) if end else start_day
+        samples = self._weight_samples(user, start_day, end_day)
+        if end is None:
+            listed = list(samples.values())
+            return _json(
+                {
+                    "startDate": start,
+                    "endDate": start,
+                    "dateWeightList": listed,
+                    "totalAverage": self._average(listed),
+                }
+            )
+        return _json(
+            {
+                "dailyWeightSummaries": [
+                    {
+                        "summaryDate": day.isoformat(),
+                        "numOfWeightEntries": 1,
+                        "latestWeight": sample,
+                        "allWeightMetrics": [sample],
+                    }
+                    for day, sample in sorted(samples.items(), reverse=True)
+                ],
+                "totalAverage": self._average(list(samples.values())),
+            }
+        )
+
+    def _activity_list(self, user: int) -> List[Dict[str, Any]]:
+        """Return the activities of 'user', most recent first."""
+
+        with self._lock:
+            activities = self._activities.get(user)
+        if activities is not None:
+            return activities
+
+        activities = []
+        chance = self.activities_per_week / 7
+        for day in self._days(self.first_day, self.end):
+            rng = self._day_random(user, day, "activity")
+            if rng.random() >= chance:
+                continue
+            start = datetime.combine(day, datetime.min.time()) + timedelta(
+                hours=rng.randint(6, 19), minutes=rng.randint(0, 59)
+            )
+            duration = rng.randint(1200, 7200)
+            kind = rng.choice(["running", "cycling", "walking", "swimming"])
+            activities.append(
+                {
+                    "activityId": self._activity_id(user, len(activities)),
+                    "activityName": f"{kind.title()} {day}",
+                    "activityType": {"typeKey": kind},
+                    "startTimeLocal": start.strftime("%Y-%m-%d %H:%M:%S"),
+                    "startTimeGMT": start.strftime("%Y-%m-%d %H:%M:%S"),
+                    "duration": float(duration),
+                    "distance": round(duration * rng.uniform(1.2, 6.0), 1),
+                    "averageHR": float(rng.randint(110, 160)),
+                    "calories": float(duration // 8),
+                    "ownerDisplayName": self.display_name(user),
+                }
+            )
+        activities.reverse()
+        with self._lock:
+            return self._activities.setdefault(user, activities)
+
+    def _activity_id(self, user: int, number: int) -> int:
+        return ACTIVITY_ID_BASE * (user + 1) + number
+
+    def _find_activity(self, user: int, activity_id: str):
+        number = int(activity_id) - ACTIVITY_ID_BASE * (user + 1)
+        activities = self._activity_list(user)
+        if not 0 <= number < len(activities):
+            return None
+        return activities[len(activities) - 1 - number]
+
+    def _search(self, user, params, body):
+        start = int(params.get("start", 0))
+        limit = int(params.get("limit", 20))
+        if limit > self.max_page_size:
+            return 400, {}, b'{"message": "limit too large"}'
+
+        activities = self._activity_list(user)
+        first = params.get("startDate")
+        last = params.get("endDate")
+        kind = params.get("activityType")
+        if first or last or kind:
+            activities = [
+                a
+                for a in activities
+                if (not first or a["startTimeLocal"][:10] >= first)
+                and (not last or a["startTimeLocal"][:10] <= last)
+                and (not kind or a["activityType"]["typeKey"] == kind)
+            ]
+        if params.get("sortOrder") == "asc":
+            activities = activities[::-1]
+        return _json(activities[start : start + limit])
+
+    def _activity(self, user, params, body, activity_id):
+        activity = self._find_activity(user, activity_id)
+        if activity is None:
+            return 404, {}, b'{"message": "Not found"}'
+        return _json(
+            {
+                "activityId": activity["activityId"],
+                "activityName": activity["activityName"],
+                "activityTypeDTO": activity["activityType"],
+                "summaryDTO": {
+                    "startTimeLocal": activity["startTimeLocal"],
+                    "duration": activity["duration"],
+                    "distance": activity["distance"],
+                    "averageHR": activity["averageHR"],
+                    "calories": activity["calories"],
+                },
+            }
+        )
+
+    def _download(self, user, params, body, activity_id, fmt=None):
+        activity = self._find_activity(user, activity_id)
+        if activity is None:
+            return 404, {}, b'{"message": "Not found"}'
+
+        start = datetime.strptime(
+            activity["startTimeGMT"], "%Y-%m-%d %H:%M:%S"
+        )
+        rng = random.Random(f"{self.seed}:{activity_id}")
+        points = [
+            (start + timedelta(seconds=s), rng.randint(100, 170))
+            for s in range(0, int(activity["duration"]), 5)
+        ]
+
+        if fmt is None:
+            # The original upload, zipped.
+            data = io.BytesIO()
+            with zipfile.ZipFile(data, "w") as archive:
+                archive.writestr(
+                    f"{activity_id}_ACTIVITY.fit",
+                    b"".join(hr.to_bytes(4, "little") for _, hr in points),
+                )
+            return 200, {"Content-Type": "application/zip"}, data.getvalue()
+        if fmt == "csv":
+            rows = ["Split,Time,Avg HR"] + [
+                f"{i + 1},{300},{hr}" for i, (_, hr) in enumerate(points[::60])
+            ]
+            return 200, {"Content-Type": "text/csv"}, "\n".join(rows).encode()
+
+        point = {
+            "tcx": "<Trackpoint><Time>{}Z</Time><HeartRateBpm><Value>{}"
+            "</Value></HeartRateBpm></Trackpoint>",
+            "gpx": '<trkpt lat="0" lon="0"><time>{}Z</time><extensions>'
+            "<hr>{}</hr></extensions></trkpt>",
+            "kml": "<when>{}Z</when><!-- {} -->",
+        }[fmt]
+        document = (
+            f'<?xml version="1.0" encoding="UTF-8"?>\n<{fmt}>'
+            + "".join(point.format(t.isoformat(), hr) for t, hr in points)
+            + f"</{fmt}>"
+        )
+        return 200, {"Content-Type": "application/xml"}, document.encode()
+
+    def _upload(self, user, params, body):
+        match = re.search(rb'filename="([^"]*)"', body)
+        with self._lock:
+            self._uploads += 1
+            upload_id = self._uploads
+        return _json(
+            {
+                "detailedImportResult": {
+                    "uploadId": upload_id,
+                    "fileName": match.group(1).decode() if match else None,
+                    "fileSize": len(body),
+                    "successes": [],
+                    "failures": [],
+                }
+            },
+            status=202,
+        )
+
+
+def _json(
+    payload: Any, status: int = 200
+) -> Tuple[int, Dict[str, str], bytes]:
+    body = json.dumps(payload).encode()
+    return status, {"Content-Type": "application/json"}, body
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections alive, as Garmin Connect does.
+    protocol_version = "HTTP/1.1"
+    standin: StandInServer
+
+    def _respond(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        status, headers, content = self.standin._handle(
+            self.command, self.path, self.headers, body
+        )
+        with self.standin._lock:
+            statuses = self.standin._statuses
+            statuses[status] = statuses.get(status, 0) + 1
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
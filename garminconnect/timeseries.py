@@ -0,0 +1,235 @@
+"""Compact intraday time series for Garmin Connect wellness data."""
+
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union
+
+try:
+    import numpy as np
+except ImportError as e:  # pragma: no cover
+    raise ImportError(
+        "TimeSeries requires numpy, install it with "
+        "'pip install garminconnect[numpy]'"
+    ) from e
+
+TimeLike = Union[int, float, str, date, datetime, "np.datetime64"]
+
+AGGREGATIONS = ("min", "mean", "max", "sum", "count")
+
+
+def _to_epoch_ms(value: TimeLike) -> int:
+    """
+    Convert epoch milliseconds, a datetime, a date or an ISO 8601 string to
+    epoch milliseconds. Naive datetimes and strings are taken as UTC, like
+    the timestamps in Garmin Connect responses.
+    """
+
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return int(value)
+    if isinstance(value, np.datetime64):
+        return int(value.astype("M8[ms]").astype(np.int64))
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000)
+
+
+def _descriptor_index(
+    descriptors: Optional[List[Dict[str, Any]]], key: str, default: int
+) -> int:
+    """
+    Return the index of 'key' in a list of value descriptors. Depending on
+    the endpoint these look like {"key": ..., "index": ...} or
+    {"<metric>ValueDescriptorKey": ..., "<metric>ValueDescriptorIndex": ...}.
+    """
+
+    for descriptor in descriptors or []:
+        fields = {name.lower(): value for name, value in descriptor.items()}
+        descriptor_key = next(
+            (v for name, v in fields.items() if name.endswith("key")), None
+        )
+        if descriptor_key == key:
+            return next(
+                (v for name, v in fields.items() if name.endswith("index")),
+                default,
+            )
+    return default
+
+
+class TimeSeries:
+    """
+    Intraday samples as an int64 array of epoch milliseconds (sorted) and a
+    float32 array of values, NaN where a sample has no value.
+    """
+
+    def __init__(
+        self,
+        timestamps: Union[Sequence[int], "np.ndarray"],
+        values: Union[Sequence[float], "np.ndarray"],
+        name: Optional[str] = None,
+    ):
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float32)
+        self.name = name
+        if self.timestamps.shape != self.values.shape:
+            raise ValueError("Timestamps and values differ in length")
+        if len(self.timestamps) > 1 and np.any(np.diff(self.timestamps) < 0):
+            order = np.argsort(self.timestamps, kind="stable")
+            self.timestamps = self.timestamps[order]
+            self.values = self.values[order]
+
+    @classmethod
+    def from_samples(
+        cls,
+        samples: Optional[Iterable[Sequence[Any]]],
+        value_index: int = 1,
+        name: Optional[str] = None,
+        drop_negative: bool = False,
+    ) -> "TimeSeries":
+        """
+        Build a series from [timestamp, value, ...] samples as returned by
+        Garmin Connect. With 'drop_negative', negative values (which mark
+        off-wrist or activity periods in stress and respiration data)
+        become NaN.
+        """
+
+        samples = [s for s in samples or [] if s and s[0] is not None]
+        timestamps = np.fromiter(
+            (s[0] for s in samples), dtype=np.int64, count=len(samples)
+        )
+        values = np.array([s[value_index] for s in samples], dtype=np.float32)
+        if drop_negative:
+            values[values < 0] = np.nan
+
+        return cls(timestamps, values, name)
+
+    @classmethod
+    def from_payload(
+        cls,
+        payload: Optional[Dict[str, Any]],
+        samples_key: str,
+        descriptors_key: str,
+        value_key: str,
+        name: Optional[str] = None,
+        drop_negative: bool = False,
+    ) -> "TimeSeries":
+        """
+        Build a series from the 'samples_key' array of a response, taking
+        the 'value_key' column as described by its 'descriptors_key' list.
+        """
+
+        payload = payload or {}
+        value_index = _descriptor_index(
+            payload.get(descriptors_key), value_key, 1
+        )
+
+        return cls.from_samples(
+            payload.get(samples_key),
+            value_index,
+            name or value_key,
+            drop_negative,
+        )
+
+    @classmethod
+    def concat(cls, series: Iterable["TimeSeries"]) -> "TimeSeries":
+        """Join series, e.g. the series of consecutive days."""
+
+        series = list(series)
+        if not series:
+            return cls([], [])
+        return cls(
+            np.concatenate([s.timestamps for s in series]),
+            np.concatenate([s.values for s in series]),
+            series[0].name,
+        )
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __getitem__(self, key):
+        """Slice by time, e.g. series["2023-07-01T06:00":"2023-07-01T12:00"]."""
+
+        if not isinstance(key, slice) or key.step is not None:
+            raise TypeError("TimeSeries can only be sliced by time")
+        return self.between(key.start, key.stop)
+
+    def __repr__(self) -> str:
+        return f"TimeSeries(name={self.name!r}, samples={len(self)})"
+
+    @property
+    def nbytes(self) -> int:
+        """Return the memory used by the samples."""
+
+        return self.timestamps.nbytes + self.values.nbytes
+
+    @property
+    def datetimes(self) -> "np.ndarray":
+        """Return the timestamps as datetime64[ms] (UTC)."""
+
+        return self.timestamps.astype("M8[ms]")
+
+    def between(
+        self, start: Optional[TimeLike] = None, end: Optional[TimeLike] = None
+    ) -> "TimeSeries":
+        """Return the samples from 'start' (inclusive) to 'end' (exclusive)."""
+
+        first = 0
+        last = len(self)
+        if start is not None:
+            first = int(np.searchsorted(self.timestamps, _to_epoch_ms(start)))
+        if end is not None:
+            last = int(np.searchsorted(self.timestamps, _to_epoch_ms(end)))
+
+        return TimeSeries(
+            self.timestamps[first:last], self.values[first:last], self.name
+        )
+
+    def resample(self, minutes: float, how: str = "mean") -> "TimeSeries":
+        """
+        Aggregate the samples into buckets of 'minutes', using one of
+        "min", "mean", "max", "sum" or "count". Buckets are aligned to the
+        epoch and labelled with their start; empty buckets are left out and
+        NaN values are ignored.
+        """
+
+        if how not in AGGREGATIONS:
+            raise ValueError(f"how must be one of {AGGREGATIONS}")
+
+        present = ~np.isnan(self.values)
+        values = self.values[present].astype(np.float64)
+        width = int(minutes * 60 * 1000)
+        buckets = self.timestamps[present] // width * width
+        if not len(buckets):
+            return TimeSeries([], [], self.name)
+
+        starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        counts = np.diff(np.r_[starts, len(buckets)])
+        if how == "min":
+            result = np.minimum.reduceat(values, starts)
+        elif how == "max":
+            result = np.maximum.reduceat(values, starts)
+        elif how == "count":
+            result = counts
+        else:
+            result = np.add.reduceat(values, starts)
+            if how == "mean":
+                result = result / counts
+
+        return TimeSeries(buckets[starts], result, self.name)
+
+    def rollup(self, minutes: float) -> Dict[str, "TimeSeries"]:
+        """Return the min, mean and max per bucket of 'minutes'."""
+
+        return {
+            how: self.resample(minutes, how) for how in ("min", "mean", "max")
+        }
+
+    def to_pandas(self):
+        """Return a pandas Series indexed by UTC timestamps."""
+
+        import pandas as pd
+
+        index = pd.DatetimeIndex(self.datetimes, name="timestamp", tz="UTC")
+        return pd.Series(self.values, index=index, name=self.name)
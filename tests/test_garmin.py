@@ -1,4 +1,21 @@
+import asyncio
+import dataclasses
+import hashlib
+import io
+import itertools
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date
+from unittest import mock
+
 import pytest
+import requests as requests_lib
+from garth.auth_tokens import OAuth1Token, OAuth2Token
+from garth.exc import GarthHTTPError
 
 import garminconnect
 
@@ -10,6 +27,24 @@ def garmin():
     return garminconnect.Garmin("email", "password")
 
 
+def fake_tokens(api):
+    """Give 'api' tokens that do not expire, for tests without cassettes."""
+
+    expires_at = int(time.time()) + 24 * 60 * 60
+    api.garth.oauth1_token = OAuth1Token("token", "secret")
+    api.garth.oauth2_token = OAuth2Token(
+        scope="CONNECT_READ",
+        jti="jti",
+        token_type="Bearer",
+        access_token="access",
+        refresh_token="refresh",
+        expires_in=24 * 60 * 60,
+        expires_at=expires_at,
+        refresh_token_expires_in=24 * 60 * 60,
+        refresh_token_expires_at=expires_at,
+    )
+
+
 @pytest.mark.vcr
 def test_stats(garmin):
     garmin.login()
@@ -144,3 +179,1084 @@ def test_request_reload(garmin):
     assert garmin.request_reload(cdate)
     # In practice, the data can take a while to load
     assert sum(steps["steps"] for steps in garmin.get_steps_data(cdate)) > 0
+
+
+def test_fetch_range(monkeypatch):
+    api = garminconnect.Garmin("email", "password")
+
+    def get_heart_rates(cdate):
+        if cdate == "2023-07-02":
+            raise garminconnect.GarminConnectConnectionError(cdate)
+        return {"calendarDate": cdate}
+
+    monkeypatch.setattr(api, "get_heart_rates", get_heart_rates)
+    fetched = api.fetch_range("heart_rates", "2023-06-30", "2023-07-03")
+    assert list(fetched["results"]) == [
+        "2023-06-30",
+        "2023-07-01",
+        "2023-07-03",
+    ]
+    assert fetched["results"]["2023-07-01"] == {"calendarDate": "2023-07-01"}
+    assert list(fetched["errors"]) == ["2023-07-02"]
+
+    with pytest.raises(ValueError):
+        api.fetch_range("no_such_metric", DATE, DATE)
+
+
+def test_async_garmin():
+    httpx = pytest.importorskip("httpx")
+
+    def handler(request):
+        if "dailyHeartRate" in request.url.path:
+            cdate = request.url.params["date"]
+            return httpx.Response(200, json={"calendarDate": cdate})
+        if "weight/range" in request.url.path:
+            return httpx.Response(200, json=dict(request.url.params))
+        return httpx.Response(500)
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        async with garminconnect.AsyncGarmin(client=client) as api:
+            fake_tokens(api)
+            api.garth.retries = 0
+            api.display_name = "display_name"
+            heart_rates = await api.get_heart_rates(DATE)
+            fetched = await api.fetch_range("get_heart_rates", DATE, DATE)
+            weigh_ins = await api.get_weigh_ins(DATE, DATE)
+            with pytest.raises(GarthHTTPError):
+                await api.get_floors(DATE)
+            # Concurrent callers share the request, but not its exception.
+            errors = await asyncio.gather(
+                api.get_floors(DATE),
+                api.get_floors(DATE),
+                return_exceptions=True,
+            )
+        await client.aclose()
+        assert errors[0] is not errors[1]
+        assert errors[0].__cause__ is errors[1].__cause__
+        return heart_rates, fetched, weigh_ins
+
+    heart_rates, fetched, weigh_ins = asyncio.run(run())
+    # Booleans are sent like requests sends them.
+    assert weigh_ins == {"includeAll": "True"}
+    assert heart_rates == {"calendarDate": DATE}
+    assert fetched["results"] == {DATE: heart_rates}
+
+
+def test_async_download_activity_to(tmp_path):
+    httpx = pytest.importorskip("httpx")
+    content = os.urandom(100 * 1024)
+    statuses = [429, 503, 200]
+
+    def handler(request):
+        status = statuses.pop(0)
+        if status == 429:
+            return httpx.Response(429, headers={"Retry-After": "0"})
+        return httpx.Response(status, content=content)
+
+    limiter = garminconnect.RateLimiter(rate=1000)
+    reserved = []
+    reserve = limiter.reserve
+    limiter.reserve = lambda: reserved.append(1) or reserve()
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        async with garminconnect.AsyncGarmin(
+            client=client, rate_limiter=limiter
+        ) as api:
+            fake_tokens(api)
+            api.garth.backoff_factor = 0
+            result = await api.download_activity_to(
+                str(tmp_path / "activity.tcx"), 12345
+            )
+        await client.aclose()
+        return result
+
+    result = asyncio.run(run())
+    assert (tmp_path / "activity.tcx").read_bytes() == content
+    assert result["size"] == len(content)
+    assert statuses == []
+    # The 503 is retried within an attempt, the 429 by another one.
+    assert len(reserved) == 2
+    assert os.listdir(tmp_path) == ["activity.tcx"]
+
+
+def test_async_download_errors(tmp_path):
+    httpx = pytest.importorskip("httpx")
+
+    paths = []
+
+    def handler(request):
+        paths.append(request.url.path)
+        # Activity 1 is never reachable, activity 3 on the second try.
+        if request.url.path.endswith("/1") or paths == [request.url.path]:
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(200, content=b"activity")
+
+    class Tracer(garminconnect.RequestHook):
+        def on_error(self, request, error):
+            errors.append((type(error), request.status))
+
+    errors = []
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        async with garminconnect.AsyncGarmin(
+            client=client, hooks=[Tracer()]
+        ) as api:
+            fake_tokens(api)
+            api.garth.retries = 1
+            api.garth.backoff_factor = 0
+            with pytest.raises(httpx.ConnectError):
+                await api.download_activity_to(str(tmp_path / "1.tcx"), 1)
+            paths.clear()
+            await api.download_activity_to(str(tmp_path / "3.tcx"), 3)
+            with pytest.raises(FileNotFoundError):
+                await api.download_activity_to(
+                    str(tmp_path / "missing" / "2.tcx"), 2
+                )
+        await client.aclose()
+
+    asyncio.run(run())
+    assert errors == [
+        *[(httpx.ConnectError, None)] * 3,
+        (FileNotFoundError, 200),
+    ]
+    assert (tmp_path / "3.tcx").read_bytes() == b"activity"
+
+
+def test_response_cache(monkeypatch, tmp_path):
+    cache = garminconnect.ResponseCache(tmp_path / "cache.sqlite")
+    api = garminconnect.Garmin("email", "password", cache=cache)
+    api.display_name = "alice"
+    other = garminconnect.Garmin("email", "password", cache=cache)
+    other.display_name = "bob"
+    calls = []
+
+    def connectapi(path, **kwargs):
+        calls.append(path)
+        return {"path": path}
+
+    monkeypatch.setattr(api, "_connectapi", connectapi)
+    monkeypatch.setattr(other, "_connectapi", lambda path: {"bob": path})
+    api.get_hrv_data(DATE)
+    api.get_hrv_data(DATE)
+    api.get_activity_splits(12345)
+    api.get_activity_splits(12345)
+    api.get_device_last_used()
+    api.get_device_last_used()
+    assert len(calls) == 4
+    assert cache.stats()["hits"] == 2
+    assert "bob" in other.get_hrv_data(DATE)
+    assert "bob" in other.get_activity_splits(12345)
+
+    cache.invalidate("activity/12345")
+    api.get_activity_splits(12345)
+    assert len(calls) == 5
+
+    today = date.today().isoformat()
+    key, ttl = cache.key_for("json", f"/hrv-service/hrv/{today}", {}, "a")
+    assert ttl == 900
+    assert cache.key_for("json", f"/hrv-service/hrv/{DATE}", {}, None) is None
+
+
+def test_metadata_cache(monkeypatch):
+    api = garminconnect.Garmin("email", "password")
+    calls = []
+
+    def connectapi(path, **kwargs):
+        calls.append(path)
+        return [{"deviceId": 1}]
+
+    monkeypatch.setattr(api, "connectapi", connectapi)
+    monkeypatch.setattr(api, "request", lambda *args, **kwargs: None)
+    assert api.get_devices() == api.get_devices()
+    api.get_gear_defaults(42)
+    api.set_gear_default("running", "uuid")
+    api.get_gear_defaults(42)
+    assert len(calls) == 3
+    assert api.cache_stats()["metadata"]["hits"] == 1
+    assert api.cache_stats()["responses"] is None
+
+
+def test_sync_activities(monkeypatch, tmp_path):
+    api = garminconnect.Garmin("email", "password")
+    activities = [
+        {"activityId": n, "startTimeGMT": f"2023-07-01 10:{n:02d}:00"}
+        for n in reversed(range(30))
+    ]
+    requests = []
+
+    def get_activities(start, limit):
+        requests.append(start)
+        return activities[start : start + limit]
+
+    monkeypatch.setattr(api, "get_activities", get_activities)
+    statefile = str(tmp_path / "sync.json")
+    assert len(api.sync_activities(statefile)) == 30
+    assert requests == [0, 20]
+
+    activities.insert(
+        0, {"activityId": 30, "startTimeGMT": "2023-07-01 10:30:00"}
+    )
+    requests.clear()
+    assert api.sync_activities(statefile) == activities[:1]
+    assert requests == [0]
+    assert api.sync_activities(statefile) == []
+
+
+def test_paginate(monkeypatch):
+    api = garminconnect.Garmin("email", "password")
+    activities = list(range(450))
+    requests = []
+
+    def connectapi(path, params):
+        start, limit = int(params["start"]), int(params["limit"])
+        requests.append((start, limit))
+        if limit > 500:
+            error = requests_lib.HTTPError(response=mock.Mock(status_code=400))
+            raise GarthHTTPError(msg="Bad request", error=error)
+        # The server silently caps pages at 100 items.
+        return activities[start : start + min(limit, 100)]
+
+    monkeypatch.setattr(api, "connectapi", connectapi)
+    assert api.get_activities_by_date(DATE) == activities
+    assert requests[:3] == [(0, 1000), (0, 500), (100, 100)]
+    assert api._page_sizes[api.garmin_connect_activities] == 100
+
+    requests.clear()
+    assert api.get_activities_by_date(DATE, workers=1) == activities
+    assert requests == [(n, 100) for n in range(0, 500, 100)]
+
+    # Whether a short page is the last one is only checked once.
+    short = garminconnect.Garmin("email", "password")
+    items = list(range(37))
+
+    def uncapped(path, params):
+        start, limit = int(params["start"]), int(params["limit"])
+        requests.append((start, limit))
+        return items[start : start + limit]
+
+    monkeypatch.setattr(short, "connectapi", uncapped)
+    requests.clear()
+    assert short.get_activities_by_date(DATE) == items
+    assert requests == [(0, 1000), (37, 37)]
+    requests.clear()
+    assert short.get_activities_by_date(DATE) == items
+    assert list(short.iter_activities(DATE)) == items
+    assert requests == [(0, 1000), (0, 100)]
+
+    # An explicit limit does not hide pages the server capped.
+    monkeypatch.setattr(short, "connectapi", connectapi)
+    requests.clear()
+    assert short.get_goals(start=0, limit=500) == activities
+    assert requests[:3] == [(0, 500), (100, 100), (200, 100)]
+
+    pytest.importorskip("httpx")
+
+    async def run():
+        async with garminconnect.AsyncGarmin() as api:
+
+            async def fetch(path, params):
+                return uncapped(path, params)
+
+            monkeypatch.setattr(api, "connectapi", fetch)
+            first = await api.get_activities_by_date(DATE)
+            second = await api.get_goals(start=0, limit=10)
+            return first, second
+
+    requests.clear()
+    assert asyncio.run(run()) == (items, items)
+    assert requests == [(0, 1000), (37, 37)] + [
+        (n, 10) for n in range(0, 40, 10)
+    ]
+
+
+def test_iter_activities(monkeypatch):
+    api = garminconnect.Garmin("email", "password")
+    activities = list(range(250))
+    requests = []
+
+    def connectapi(path, params):
+        start, limit = int(params["start"]), int(params["limit"])
+        requests.append((start, limit))
+        return activities[start : start + limit]
+
+    monkeypatch.setattr(api, "connectapi", connectapi)
+    iterator = api.iter_activities(DATE)
+    assert requests == []
+    assert list(itertools.islice(iterator, 150)) == activities[:150]
+    assert requests == [(0, 100), (100, 100)]
+    assert list(iterator) == activities[150:]
+    assert requests[-1] == (200, 100)
+
+    requests.clear()
+    assert list(api.iter_gear_activities("uuid", limit=50)) == activities
+    assert len(requests) == 6
+
+    # Iterating does not hold the learned page sizes back, nor follow them.
+    assert api.garmin_connect_activities not in api._page_sizes
+    requests.clear()
+    api.get_activities_by_date(DATE, workers=1)
+    assert requests[0] == (0, 1000)
+    api._page_sizes[api.garmin_connect_activities] = 1000
+    requests.clear()
+    list(itertools.islice(api.iter_activities(DATE), 10))
+    assert requests == [(0, 100)]
+
+
+def test_download_activity_to(monkeypatch, tmp_path):
+    api = garminconnect.Garmin("email", "password")
+    content = os.urandom(300 * 1024)
+    response = requests_lib.Response()
+    response.raw = io.BytesIO(content)
+    monkeypatch.setattr(api, "request", lambda *args, **kwargs: response)
+
+    path = tmp_path / "activity.tcx"
+    result = api.download_activity_to(str(path), 12345)
+    assert path.read_bytes() == content
+    umask = os.umask(0o022)
+    os.umask(umask)
+    assert path.stat().st_mode & 0o777 == 0o666 & ~umask
+    assert result == {
+        "path": str(path),
+        "size": len(content),
+        "sha256": hashlib.sha256(content).hexdigest(),
+    }
+    assert os.listdir(tmp_path) == ["activity.tcx"]
+
+
+def test_archive_activities(monkeypatch, tmp_path):
+    api = garminconnect.Garmin("email", "password")
+    downloads = []
+
+    def download_activity_to(dest, activity_id, dl_fmt):
+        if activity_id == 3:
+            raise garminconnect.GarminConnectConnectionError(activity_id)
+        downloads.append((activity_id, dl_fmt))
+        with open(dest, "wb") as f:
+            f.write(b"activity")
+        return {"path": dest, "size": 8, "sha256": "sha256"}
+
+    monkeypatch.setattr(api, "download_activity_to", download_activity_to)
+    progress = []
+    formats = [
+        garminconnect.Garmin.ActivityDownloadFormat.ORIGINAL,
+        garminconnect.Garmin.ActivityDownloadFormat.GPX,
+    ]
+    summary = api.archive_activities(
+        tmp_path,
+        [1, 2, 3],
+        formats=formats,
+        progress=lambda *args: progress.append(args),
+    )
+    assert summary["downloaded"] == 4
+    assert summary["skipped"] == 0
+    assert list(summary["failed"]) == ["3.zip", "3.gpx"]
+    assert sorted(done for done, _, _ in progress) == [1, 2, 3, 4, 5, 6]
+    assert (tmp_path / "2.gpx").exists()
+
+    downloads.clear()
+    summary = api.archive_activities(tmp_path, [1, 2, 3], formats=formats)
+    assert summary["skipped"] == 4
+    assert downloads == []
+
+
+def test_activity_details_arrays(monkeypatch):
+    np = pytest.importorskip("numpy")
+    api = garminconnect.Garmin("email", "password")
+    details = {
+        "activityId": 12345,
+        "metricDescriptors": [
+            {"metricsIndex": 1, "key": "directHeartRate", "unit": None},
+            {
+                "metricsIndex": 0,
+                "key": "directTimestamp",
+                "unit": {"key": "gmt"},
+            },
+        ],
+        "activityDetailMetrics": [
+            {"metrics": [1688205600000.0, 120.0]},
+            {"metrics": [1688205601000.0, None]},
+            {"metrics": [1688205602000.0, 122.0]},
+        ],
+    }
+    monkeypatch.setattr(api, "get_activity_details", lambda *args: details)
+    arrays = api.get_activity_details_arrays(12345)
+    assert len(arrays) == 3
+    assert arrays.units["directTimestamp"] == "gmt"
+    assert arrays["directHeartRate"].flags["C_CONTIGUOUS"]
+    assert np.nanmean(arrays["directHeartRate"]) == 121.0
+    assert str(arrays.timestamps[0]) == "2023-07-01T10:00:00.000"
+
+
+def test_heart_rates_series(monkeypatch):
+    np = pytest.importorskip("numpy")
+    api = garminconnect.Garmin("email", "password")
+
+    def get_heart_rates(cdate):
+        start = 1688169600000 if cdate == DATE else 1688256000000
+        return {
+            "heartRateValueDescriptors": [
+                {"key": "timestamp", "index": 0},
+                {"key": "heartrate", "index": 1},
+            ],
+            "heartRateValues": [
+                [start + minute * 120000, 60 + minute] for minute in range(60)
+            ]
+            + [[start + 7200000, None]],
+        }
+
+    monkeypatch.setattr(api, "get_heart_rates", get_heart_rates)
+    series = api.get_heart_rates_series(DATE, "2023-07-02")
+    assert len(series) == 122
+    assert series.values.dtype == np.float32
+    assert np.all(np.diff(series.timestamps) >= 0)
+
+    hourly = series.resample(60, "max")
+    assert len(hourly) == 4
+    assert hourly.values[0] == 89.0
+
+    morning = series["2023-07-01T00:00":"2023-07-01T00:10"]
+    assert morning.values.tolist() == [60.0, 61.0, 62.0, 63.0, 64.0]
+
+
+def test_rate_limit(monkeypatch, tmp_path):
+    api = garminconnect.Garmin("email", "password")
+    sleeps = []
+    monkeypatch.setattr(garminconnect.time, "sleep", sleeps.append)
+    statuses = iter([429, 429, 200])
+
+    def request(method, subdomain, path, **kwargs):
+        response = requests_lib.Response()
+        response.status_code = next(statuses)
+        response.headers["Retry-After"] = "7"
+        if response.status_code == 429:
+            raise GarthHTTPError(
+                msg="Error in request",
+                error=requests_lib.HTTPError(response=response),
+            )
+        return response
+
+    monkeypatch.setattr(api.garth, "request", request)
+    assert api.request("GET", "/path").status_code == 200
+    assert sleeps == [7.0, 7.0]
+
+    statuses = itertools.repeat(429)
+    api.max_retries = 2
+    with pytest.raises(garminconnect.GarminConnectTooManyRequestsError):
+        api.request("GET", "/path")
+
+    path = tmp_path / "bucket"
+    limiter = garminconnect.RateLimiter(rate=2, burst=2, path=str(path))
+    other = garminconnect.RateLimiter(rate=2, burst=2, path=str(path))
+    assert limiter.reserve() == 0
+    assert other.reserve() == 0
+    assert limiter.reserve() == pytest.approx(0.5, abs=0.05)
+    other.backoff(10)
+    assert limiter.reserve() == pytest.approx(10.5, abs=0.05)
+
+
+def test_single_flight(monkeypatch):
+    api = garminconnect.Garmin("email", "password")
+    calls = []
+    release = threading.Event()
+    joined = threading.Event()
+    waiters = []
+
+    class Flight(Future):
+        def exception(self, timeout=None):
+            # Called by the threads joining a call in flight.
+            waiters.append(self)
+            if len(waiters) == 6:
+                joined.set()
+            return super().exception(timeout)
+
+    monkeypatch.setattr(garminconnect, "Future", Flight)
+
+    def connectapi(path, **kwargs):
+        calls.append(path)
+        release.wait(5)
+        if path.endswith("/error"):
+            raise GarthHTTPError(msg="Error in request", error=None)
+        return {"path": path}
+
+    monkeypatch.setattr(api, "_connectapi", connectapi)
+    with ThreadPoolExecutor(8) as executor:
+        futures = [
+            executor.submit(api.connectapi, path, params={"date": DATE})
+            for path in ["/summary"] * 6 + ["/error"] * 2
+        ]
+        assert joined.wait(5)
+        release.set()
+
+    assert sorted(calls) == ["/error", "/summary"]
+    results = [future.result() for future in futures[:6]]
+    assert all(result is results[0] for result in results)
+    errors = [future.exception() for future in futures[6:]]
+    assert isinstance(errors[0], GarthHTTPError)
+    assert errors[0] is not errors[1]
+    assert errors[0].msg == errors[1].msg
+
+    api.connectapi("/summary", method="POST", json={})
+    api.connectapi("/summary", method="POST", json={})
+    assert calls.count("/summary") == 3
+
+
+def test_all_device_settings(monkeypatch):
+    api = garminconnect.Garmin("email", "password")
+    devices = [{"deviceId": device_id} for device_id in (1, 2, 3)]
+    release = threading.Barrier(3, timeout=5)
+
+    def get_device_settings(device_id):
+        # Only passes when all devices are requested concurrently.
+        release.wait()
+        if device_id == 3:
+            raise GarthHTTPError(msg="Error in request", error=None)
+        return {"alarms": [f"alarm {device_id}"] if device_id == 1 else None}
+
+    monkeypatch.setattr(api, "get_devices", lambda: devices)
+    monkeypatch.setattr(api, "get_device_settings", get_device_settings)
+    settings = api.get_all_device_settings()
+    assert list(settings["results"]) == [1, 2]
+    assert list(settings["errors"]) == [3]
+
+    with pytest.raises(GarthHTTPError):
+        api.get_device_alarms()
+    devices.pop()
+    release = threading.Barrier(2, timeout=5)
+    assert api.get_device_alarms() == ["alarm 1"]
+
+
+def test_graphql_metrics(monkeypatch):
+    api = garminconnect.Garmin("email", "password")
+    queries = []
+
+    def query_garmin_graphql(query):
+        queries.append(query["query"])
+        data = {}
+        for line in query["query"].splitlines()[1:-1]:
+            alias, call = line.strip().split(": ", 1)
+            if call.startswith("sleepSummariesScalar"):
+                start = call.split('"')[1]
+                data[alias] = [{"calendarDate": start, "sleep": 1}]
+            elif alias == "training_status_2023_07_03":
+                data[alias] = None
+            else:
+                data[alias] = {"calendarDate": call.split('"')[1]}
+        errors = [
+            {"message": "failed", "path": ["training_status_2023_07_03"]}
+        ]
+        return {"data": data, "errors": errors}
+
+    monkeypatch.setattr(api, "query_garmin_graphql", query_garmin_graphql)
+    fetched = api.query_garmin_graphql_metrics(
+        ["sleep_data", "training_status"], DATE, "2023-07-30", max_fields=10
+    )
+    # Two ranged sleep fields and 30 daily fields, 10 per query.
+    assert len(queries) == 4
+    assert 'startDate: "2023-07-29", endDate: "2023-07-30"' in queries[0]
+    assert fetched["results"]["sleep_data"] == {
+        DATE: {"calendarDate": DATE, "sleep": 1},
+        "2023-07-29": {"calendarDate": "2023-07-29", "sleep": 1},
+    }
+    assert len(fetched["results"]["training_status"]) == 29
+    assert list(fetched["errors"]["training_status"]) == ["2023-07-03"]
+
+    with pytest.raises(ValueError):
+        api.query_garmin_graphql_metrics(["steps"], DATE, DATE)
+
+
+def test_graphql_authorization():
+    httpx = pytest.importorskip("httpx")
+    authorizations = []
+
+    class Adapter(requests_lib.adapters.BaseAdapter):
+        def send(self, request, **kwargs):
+            authorizations.append(request.headers.get("Authorization"))
+            response = requests_lib.Response()
+            response.status_code = 200
+            response.raw = io.BytesIO(b'{"data": {}}')
+            response.request = request
+            return response
+
+        def close(self):
+            pass
+
+    api = garminconnect.Garmin()
+    fake_tokens(api)
+    api.garth.sess.mount("https://", Adapter())
+    api.query_garmin_graphql_metrics(["sleep_data"], DATE, DATE)
+
+    def handler(request):
+        authorizations.append(request.headers.get("Authorization"))
+        return httpx.Response(200, json={"data": {}})
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        async with garminconnect.AsyncGarmin(client=client) as api:
+            fake_tokens(api)
+            await api.query_garmin_graphql_metrics(["sleep_data"], DATE, DATE)
+        await client.aclose()
+
+    asyncio.run(run())
+    assert authorizations == ["Bearer access", "Bearer access"]
+
+
+def test_graphql_recorded_payloads(monkeypatch):
+    # The sample responses recorded next to the GraphQL queries.
+    path = os.path.join(
+        os.path.dirname(garminconnect.__file__), "graphql_queries.txt"
+    )
+    with open(path) as f:
+        namespace = {"true": True, "false": False, "null": None}
+        exec(f.read(), namespace)
+    samples = {}
+    for sample in namespace["GRAPHQL_QUERIES_WITH_SAMPLE_RESPONSES"]:
+        samples.update(sample["response"]["data"] or {})
+
+    api = garminconnect.Garmin("email", "password")
+
+    def query_garmin_graphql(query):
+        data = {}
+        for line in query["query"].splitlines()[1:-1]:
+            alias, call = line.strip().split(": ", 1)
+            data[alias] = samples[call.split("(")[0]]
+        return {"data": data}
+
+    monkeypatch.setattr(api, "query_garmin_graphql", query_garmin_graphql)
+    metrics = list(garminconnect.graphql.METRICS)
+    fetched = api.query_garmin_graphql_metrics(
+        metrics, "2024-06-11", "2024-07-08"
+    )
+    results = fetched["results"]
+    assert fetched["errors"] == {}
+
+    for metric in ("user_summary", "sleep_data", "hrv_data"):
+        assert len(results[metric]) == 28
+        for cdate, item in results[metric].items():
+            assert item["calendarDate"] == cdate
+    assert len(results["training_readiness"]) == 28
+    assert results["training_readiness"]["2024-07-08"]["score"] == 83
+    assert len(results["max_metrics"]) == 24
+    assert results["max_metrics"]["2024-06-11"]["generic"] == {
+        "calendarDate": "2024-06-11",
+        "vo2MaxPreciseValue": 60.5,
+        "vo2MaxValue": 61.0,
+        "fitnessAge": None,
+        "fitnessAgeDescription": None,
+        "maxMetCategory": 0,
+    }
+    assert list(results["weigh_ins"]) == ["2024-07-02", "2024-07-08"]
+    assert results["weigh_ins"]["2024-07-08"]["latestWeight"]["weight"] == (
+        82372.0
+    )
+    assert results["blood_pressure"] == {}
+    status = results["training_status"]["2024-07-08"]
+    assert status["latestTrainingStatusData"]["3472661486"]["sport"] == (
+        "RUNNING"
+    )
+
+
+def test_account_pool(monkeypatch, tmp_path):
+    for name in ("alice", "bob"):
+        (tmp_path / name).mkdir()
+    logins = []
+
+    def login(self, tokenstore=None, profile_max_age=None):
+        logins.append(os.path.basename(tokenstore))
+        self.display_name = os.path.basename(tokenstore)
+
+    monkeypatch.setattr(garminconnect.Garmin, "login", login)
+    gate = threading.Event()
+    order = []
+
+    def job(api, label):
+        gate.wait(5)
+        order.append(label)
+        return api.display_name
+
+    with garminconnect.AccountPool(
+        str(tmp_path), max_sessions=1, workers=1, per_account=1
+    ) as pool:
+        assert pool.accounts == ["alice", "bob"]
+        futures = [pool.submit("alice", job, f"a{i}") for i in range(4)]
+        futures += [pool.submit("bob", job, f"b{i}") for i in range(2)]
+        gate.set()
+        assert futures[-1].result(5) == "bob"
+        assert pool.submit("alice", "get_full_name").result(5) is None
+        assert pool.stats()["sessions"] == 1
+        with pytest.raises(KeyError):
+            pool.submit("carol", job, "c0")
+
+    # Bob's work is not queued behind all of Alice's.
+    assert order == ["a0", "b0", "a1", "b1", "a2", "a3"]
+    assert logins == ["alice", "bob", "alice", "bob", "alice"]
+
+    shared = garminconnect.Garmin.shared_session()
+    closed = []
+    monkeypatch.setattr(shared, "close", lambda: closed.append(shared))
+    with garminconnect.AccountPool(
+        str(tmp_path), max_sessions=1, session=shared
+    ) as pool:
+        pool.submit("alice", "get_full_name").result(5)
+        pool.submit("bob", "get_full_name").result(5)
+    # Neither closing Alice's session for Bob's nor the pool closes it.
+    assert closed == []
+
+    logged_in = threading.Event()
+    release = threading.Event()
+    logins.clear()
+
+    def slow_login(self, tokenstore=None, profile_max_age=None):
+        if tokenstore.endswith("alice"):
+            logged_in.set()
+            release.wait(5)
+        logins.append(os.path.basename(tokenstore))
+        self.display_name = os.path.basename(tokenstore)
+
+    monkeypatch.setattr(garminconnect.Garmin, "login", slow_login)
+    with garminconnect.AccountPool(str(tmp_path), max_sessions=1) as pool:
+        with ThreadPoolExecutor(1) as executor:
+            alice = executor.submit(pool.session, "alice")
+            assert logged_in.wait(5)
+            bob = pool.submit("bob", "get_full_name")
+            release.set()
+            assert alice.result(5).display_name == "alice"
+            bob.result(5)
+    # Bob's call waited for Alice's session to be logged in to close it.
+    assert logins == ["alice", "bob"]
+
+
+def test_warm_login(monkeypatch, tmp_path):
+    tokenstore = str(tmp_path / "tokens")
+    api = garminconnect.Garmin()
+    fake_tokens(api)
+    api.garth.dump(tokenstore)
+    calls = []
+
+    def connectapi(path, **kwargs):
+        calls.append(path)
+        if path.endswith("socialProfile"):
+            return {"displayName": "display_name", "fullName": "Full Name"}
+        return {"userData": {"measurementSystem": "metric"}}
+
+    def login():
+        api = garminconnect.Garmin()
+        monkeypatch.setattr(api, "connectapi", connectapi)
+        api.login(tokenstore, profile_max_age=3600)
+        return api
+
+    login()
+    assert len(calls) == 2
+    api = login()
+    assert len(calls) == 2
+    assert api.display_name == "display_name"
+    assert api.unit_system == "metric"
+
+    # Refreshed tokens invalidate the saved profile.
+    api.garth.oauth2_token.expires_at += 3600
+    api.garth.dump(tokenstore)
+    login()
+    assert len(calls) == 4
+
+
+def test_lightweight_construction(monkeypatch, tmp_path):
+    statement = (
+        "import sys, garminconnect; print('withings_sync' in sys.modules)"
+    )
+    imported = subprocess.run(
+        [sys.executable, "-c", statement], capture_output=True, text=True
+    )
+    assert imported.stdout.strip() == "False"
+
+    session = garminconnect.Garmin.shared_session(pool_size=4)
+    adapter = session.get_adapter("https://")
+    mounts = []
+    mount = session.mount
+    session.mount = lambda prefix, adapter: (
+        mounts.append(prefix) or mount(prefix, adapter)
+    )
+    apis = [garminconnect.Garmin(session=session) for _ in range(3)]
+    assert all(api.garth.sess is session for api in apis)
+
+    tokens = garminconnect.Garmin()
+    fake_tokens(tokens)
+    tokens.garth.dump(str(tmp_path))
+    profile = {
+        "displayName": "display_name",
+        "fullName": "Full Name",
+        "userData": {"measurementSystem": "metric"},
+    }
+    for api in apis:
+        monkeypatch.setattr(api, "connectapi", lambda path: profile)
+        api.login(str(tmp_path))
+        assert api.garth.oauth2_token.access_token == "access"
+    for _ in range(2):
+        garminconnect.Garmin(session=session, base_url="http://localhost")
+    # The adapter in use is never swapped out, not even for a moment, and
+    # the base url is mounted once.
+    assert mounts == ["http://localhost"]
+    assert session.get_adapter("https://") is adapter
+    assert apis[0].garth.pool_maxsize == 4
+    plain = garminconnect.Garmin(session=requests_lib.Session())
+    assert plain.garth.pool_maxsize == 10
+    assert "garmin_connect_devices_url" not in vars(apis[0])
+
+
+def test_add_body_compositions(monkeypatch):
+    api = garminconnect.Garmin("email", "password")
+    uploads = []
+
+    def request(method, path, /, files=None, **kwargs):
+        uploads.append(files["file"][1])
+        return len(uploads)
+
+    monkeypatch.setattr(api, "request", request)
+
+    @dataclasses.dataclass
+    class Weight:
+        timestamp: str
+        weight: float
+        percent_fat: float
+
+    records = (
+        (
+            Weight(f"2023-07-01T{hour:02}:00:00", 70 + hour / 10, 20.0)
+            if hour % 2
+            else {"timestamp": f"2023-07-01T{hour:02}:00:00", "weight": 70.0}
+        )
+        for hour in range(24)
+    )
+    assert api.add_body_compositions(records) == [1]
+    # Headers (definitions, file and device info) plus 26 bytes per record.
+    assert len(uploads[0]) < 200 + 24 * 26
+
+    uploads.clear()
+    records = ({"timestamp": DATE, "weight": 70.0} for _ in range(100))
+    assert api.add_body_compositions(records, max_size=1024) == [1, 2, 3, 4]
+    assert all(len(content) <= 1024 for content in uploads)
+    assert api.add_body_composition(DATE, 70.0) == 5
+
+
+def test_import_weigh_ins(monkeypatch):
+    api = garminconnect.Garmin("email", "password")
+    windows = []
+    posted = []
+
+    def get_weigh_ins(startdate, enddate):
+        windows.append((startdate, enddate))
+        sample = {"timestampGMT": 1688205600000, "weight": 70000.0}
+        return {"dailyWeightSummaries": [{"allWeightMetrics": [sample]}]}
+
+    def add_weigh_in_with_timestamps(**record):
+        if record["weight"] < 0:
+            raise GarthHTTPError(msg="Error in request", error=None)
+        posted.append(record)
+
+    monkeypatch.setattr(api, "get_weigh_ins", get_weigh_ins)
+    monkeypatch.setattr(
+        api, "add_weigh_in_with_timestamps", add_weigh_in_with_timestamps
+    )
+    gmt = {"gmtTimestamp": "2023-07-01T10:00:00"}
+    records = [
+        {"weight": 70.0, "dateTimestamp": "2023-07-01T12:00:00", **gmt},
+        {"weight": 70.5, "dateTimestamp": "2023-07-01T12:00:00", **gmt},
+        {"weight": 70.5, "dateTimestamp": "2023-07-01T12:00:00", **gmt},
+        {"weight": 154.3, "unitKey": "lbs", "dateTimestamp": "2023-07-05"},
+        {"weight": -1, "dateTimestamp": "2023-07-03T08:00:00"},
+    ]
+    summary = api.import_weigh_ins(records)
+    assert windows == [("2023-06-30", "2023-07-06")]
+    assert summary["created"] == 2
+    assert summary["skipped"] == 2
+    assert list(summary["failed"]) == [4]
+    assert sorted(record["weight"] for record in posted) == [70.5, 154.3]
+
+
+def test_delete_weigh_ins_range(monkeypatch):
+    api = garminconnect.Garmin("email", "password")
+    samples = [
+        {"samplePk": pk, "calendarDate": f"2023-07-0{pk}", "sourceType": s}
+        for pk, s in [(1, "INDEX_SCALE"), (2, "MANUAL"), (3, "INDEX_SCALE")]
+    ]
+    deleted = []
+
+    def delete_weigh_in(weight_pk, cdate):
+        if weight_pk == 3:
+            raise GarthHTTPError(msg="Error in request", error=None)
+        deleted.append((weight_pk, cdate))
+
+    monkeypatch.setattr(
+        api,
+        "get_weigh_ins",
+        lambda *dates: {
+            "dailyWeightSummaries": [{"allWeightMetrics": samples}]
+        },
+    )
+    monkeypatch.setattr(api, "delete_weigh_in", delete_weigh_in)
+
+    def from_scale(sample):
+        return sample["sourceType"] == "INDEX_SCALE"
+
+    report = api.delete_weigh_ins_range(DATE, "2023-07-31", from_scale, True)
+    assert [sample["samplePk"] for sample in report["matched"]] == [1, 3]
+    assert deleted == []
+
+    report = api.delete_weigh_ins_range(DATE, "2023-07-31", from_scale)
+    assert report["deleted"] == 1
+    assert list(report["failed"]) == [3]
+    assert deleted == [(1, DATE)]
+
+
+def test_standin_server(tmp_path):
+    with garminconnect.StandInServer(
+        users=2, end=date(2023, 12, 31), max_page_size=100
+    ) as server:
+        api = server.client(1)
+        api.garth.dump(str(tmp_path))
+        other = garminconnect.Garmin(base_url=server.url + "/")
+        other.login(str(tmp_path))
+        assert other.display_name == "user1"
+
+        assert api.get_user_summary(DATE)["calendarDate"] == DATE
+        assert len(api.get_heart_rates(DATE)["heartRateValues"]) == 720
+        activities = api.get_activities_by_date("2023-01-01", "2023-12-31")
+        assert len(activities) > 100
+        assert activities == api.get_activities_by_date(
+            "2023-01-01", "2023-12-31"
+        )
+        activity_id = activities[-1]["activityId"]
+        assert api.get_activity(activity_id)["activityId"] == activity_id
+        assert api.download_activity(activity_id).startswith(b"<?xml")
+        assert server.client(0).get_activities(0, 1) != activities[:1]
+        assert server.stats()["statuses"][400] > 0
+
+    with garminconnect.StandInServer(
+        throttle_rate=1.0, retry_after=0
+    ) as server:
+        # Without the retries of urllib3, which honors Retry-After too.
+        api = server.client(session=requests_lib.Session())
+        api.max_retries = 1
+        with pytest.raises(garminconnect.GarminConnectTooManyRequestsError):
+            api.get_heart_rates(DATE)
+        assert server.stats() == {
+            "requests": 2,
+            "statuses": {429: 2},
+            "uploads": 0,
+        }
+
+
+def test_concurrent_accounts():
+    with garminconnect.StandInServer(users=2) as server:
+        session = garminconnect.Garmin.shared_session()
+        accounts = [server.client(user, session=session) for user in (0, 1)]
+
+        def profile(api):
+            profile = api.connectapi(api.garmin_connect_social_profile_url)
+            return profile["displayName"], api.display_name
+
+        with ThreadPoolExecutor(16) as executor:
+            seen = list(executor.map(profile, accounts * 100))
+
+    # Each account is answered with its own profile, never the other's.
+    assert all(shown == expected for shown, expected in seen)
+
+
+def test_metrics():
+    assert (
+        garminconnect.endpoint_template(
+            "/weight-service/weight/2023-07-01/byversion/123?x=1"
+        )
+        == "/weight-service/weight/{date}/byversion/{id}"
+    )
+
+    metrics = garminconnect.Metrics()
+    with garminconnect.StandInServer(
+        users=1, end=date(2023, 12, 31), max_page_size=100
+    ) as server:
+        api = server.client(metrics=metrics)
+        api.get_heart_rates(DATE)
+        api.get_heart_rates("2023-07-02")
+        activities = api.get_activities_by_date("2023-01-01", "2023-12-31")
+        api.download_activity(activities[0]["activityId"])
+
+    snapshot = metrics.snapshot()
+    heart_rates = snapshot[
+        "GET /wellness-service/wellness/dailyHeartRate/{display_name}"
+    ]
+    assert heart_rates["calls"] == 2
+    assert heart_rates["statuses"] == {200: 2}
+    assert heart_rates["bytes"] > 10_000
+    assert sum(heart_rates["histogram"].values()) == 2
+    assert 0 < heart_rates["p50"] <= heart_rates["p99"]
+    search = snapshot["GET /activitylist-service/activities/search/activities"]
+    assert search["errors"] == search["statuses"][400] > 0
+    assert "GET /download-service/export/tcx/activity/{id}" in snapshot
+
+    text = metrics.to_prometheus()
+    series = (
+        'method="GET",'
+        'endpoint="/wellness-service/wellness/dailyHeartRate/{display_name}"'
+    )
+    assert f'garminconnect_requests_total{{{series},status="200"}} 2' in text
+    assert (
+        f'garminconnect_request_duration_seconds_bucket{{{series},le="+Inf"}}'
+        " 2" in text
+    )
+
+    metrics.reset()
+    with garminconnect.StandInServer(
+        throttle_rate=1.0, retry_after=0
+    ) as server:
+        api = server.client(session=requests_lib.Session(), metrics=metrics)
+        api.max_retries = 1
+        with pytest.raises(garminconnect.GarminConnectTooManyRequestsError):
+            api.get_heart_rates(DATE)
+    (heart_rates,) = metrics.snapshot().values()
+    assert heart_rates["statuses"] == {429: 2}
+    assert heart_rates["retries"] == 1
+
+
+def test_request_hooks(tmp_path):
+    calls = []
+
+    class Tracer(garminconnect.RequestHook):
+        def before_request(self, request):
+            calls.append(("before", request.endpoint, request.start))
+
+        def after_response(self, request, response):
+            calls.append(
+                (
+                    "after",
+                    request.params,
+                    request.status,
+                    request.request_bytes,
+                    request.response_bytes == len(response.content),
+                    request.seconds > 0,
+                )
+            )
+
+        def on_error(self, request, error):
+            calls.append(("error", request.endpoint, request.status))
+
+    tracer = Tracer()
+    with garminconnect.StandInServer(users=1) as server:
+        api = server.client(hooks=[tracer])
+        api.get_heart_rates(DATE)
+        with pytest.raises(GarthHTTPError):
+            api.get_activity(1)
+        fit = tmp_path / "activity.fit"
+        fit.write_bytes(b"x" * 100)
+        api.upload_activity(str(fit))
+        api.remove_hook(tracer)
+        api.get_heart_rates("2023-07-02")
+
+    endpoint = "/wellness-service/wellness/dailyHeartRate/{display_name}"
+    assert calls[:2] == [
+        ("before", endpoint, 0.0),
+        ("after", {"date": DATE}, 200, 0, True, True),
+    ]
+    assert calls[3] == ("error", "/activity-service/activity/{id}", 404)
+    assert calls[5][0] == "after" and calls[5][3] == 100
+    assert len(calls) == 6